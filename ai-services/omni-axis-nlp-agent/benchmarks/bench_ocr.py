@@ -0,0 +1,102 @@
+"""
+Benchmark the OCR backends on synthetic ID-card scans: pytesseract (one
+tesseract process per image) against the warm tesserocr engine.
+
+Each backend is timed on the whole extract_text_from_image (decode,
+preprocessing, OCR) and on the OCR call alone. The text of both backends is
+compared when both are available.
+
+Usage:
+    python benchmarks/bench_ocr.py [--images 50] [--width 640]
+"""
+import argparse
+import difflib
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr  # noqa: E402
+from extraction import extract_text_from_image  # noqa: E402
+
+NAMES = ["JOHN SMITH", "MARIA GARCIA", "WEI ZHANG", "AMARA OKAFOR", "LUCAS MULLER", "PRIYA SHARMA"]
+
+
+def id_cards(count: int, width: int, rng: np.random.Generator):
+    """PNG-encoded cards with five lines of text and mild sensor noise, plus their grayscale arrays"""
+    height = int(width * 0.63)
+    scale = width / 640
+    cards = []
+    for i in range(count):
+        card = np.full((height, width, 3), 235, np.uint8)
+        lines = [
+            "REPUBLIC OF TESTLAND - IDENTITY CARD",
+            f"Name: {NAMES[i % len(NAMES)]}",
+            f"ID No: {chr(65 + i % 26)}{chr(65 + i * 7 % 26)}{int(rng.integers(100000, 999999))}",
+            f"Date of birth: {int(rng.integers(1, 28)):02d} JAN {int(rng.integers(1950, 2005))}",
+            f"Address: {int(rng.integers(1, 999))} Main Street, Springfield"
+        ]
+        for j, line in enumerate(lines):
+            cv2.putText(card, line, (int(20 * scale), int((50 + 60 * j) * scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7 * scale, (20, 20, 20), max(int(2 * scale), 1))
+        noise = rng.normal(0, 8, card.shape)
+        card = np.clip(card + noise, 0, 255).astype(np.uint8)
+        ok, png = cv2.imencode(".png", card)
+        cards.append((png.tobytes(), cv2.cvtColor(card, cv2.COLOR_BGR2GRAY)))
+    return cards
+
+
+def timed(fn, items):
+    latencies, outputs = [], []
+    for item in items:
+        start = time.perf_counter()
+        outputs.append(fn(item))
+        latencies.append(time.perf_counter() - start)
+    return np.asarray(latencies) * 1e3, outputs
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    cards = id_cards(args.images, args.width, rng)
+    print(f"{args.images} cards of {args.width}x{int(args.width * 0.63)}")
+    print(f"{'backend':<13} {'step':<24} {'p50 ms':>8} {'p95 ms':>8} {'images/s':>9}")
+
+    texts = {}
+    for backend in ["pytesseract", "auto"]:
+        ocr.set_backend(backend)
+        try:
+            # Start-up cost (engine init) stays out of the timings
+            ocr.image_to_string(cards[0][1])
+        except Exception as e:
+            print(f"{backend:<13} skipped: {e}")
+            continue
+        name = "tesserocr" if ocr.get_engine() is not None else "pytesseract"
+        if name in texts:
+            continue
+        for step, fn, items in [
+            ("extract_text_from_image", extract_text_from_image, [png for png, _ in cards]),
+            ("OCR call only", ocr.image_to_string, [gray for _, gray in cards])
+        ]:
+            latencies, outputs = timed(fn, items)
+            print(f"{name:<13} {step:<24} {np.percentile(latencies, 50):>8.1f} {np.percentile(latencies, 95):>8.1f} "
+                  f"{len(items) / latencies.sum() * 1e3:>9.1f}")
+            if step == "extract_text_from_image":
+                texts[name] = outputs
+
+    if len(texts) == 2:
+        similarity = np.mean([
+            difflib.SequenceMatcher(None, a.strip(), b.strip()).ratio()
+            for a, b in zip(texts["pytesseract"], texts["tesserocr"])
+        ])
+        print(f"Text similarity between backends: {similarity:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--width", type=int, default=640)
+    main(parser.parse_args())
@@ -0,0 +1,108 @@
+"""
+Benchmark PDF text extraction throughput against page count: one process
+reading the pages in order versus page ranges spread over the extraction pool.
+
+Synthetic text PDFs are generated with --lines lines per page. Pages/sec
+is reported for both paths, along with the peak RSS of the pool workers, which
+should stay flat as documents grow.
+
+Usage:
+    python benchmarks/bench_pdf_pages.py [--pages 10,50,100,500] [--workers 4] [--pages-per-job 8]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_pdf(path: str, n_pages: int, n_lines: int):
+    """Text-only PDF with Helvetica pages of n_lines lines each"""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{3 + 2 * i} 0 R" for i in range(n_pages)), n_pages)
+    ]
+    font = 3 + 2 * n_pages
+    for page in range(1, n_pages + 1):
+        lines = " ".join(
+            f"(Page {page} line {line}: certificate RE{page:04d}{line:02d} for 123 Main Street, value USD 1,250.00) Tj T*"
+            for line in range(n_lines)
+        )
+        content = f"BT /F1 9 Tf 36 760 Td 11 TL {lines} ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects) + 2} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>")
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    with open(path, "wb") as f:
+        offsets = []
+        f.write(b"%PDF-1.4\n")
+        for i, obj in enumerate(objects):
+            offsets.append(f.tell())
+            f.write(f"{i + 1} 0 obj\n{obj}\nendobj\n".encode())
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        f.write("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def worker_peak_rss_mib(pool) -> float:
+    """Largest VmHWM among the pool's workers (Linux only)"""
+    peak = 0
+    for worker in pool._workers:
+        try:
+            with open(f"/proc/{worker.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except OSError:
+            return float("nan")
+    return peak / 1024
+
+
+async def run(args):
+    import main
+    from extraction import extract_text_from_pdf, join_pages
+
+    main.extraction_pool.start()
+    # Workers load their modules on the first job; keep that out of the timings
+    with tempfile.TemporaryDirectory() as scratch:
+        warmup = os.path.join(scratch, "warmup.pdf")
+        write_pdf(warmup, len(main.extraction_pool._workers), 1)
+        await asyncio.gather(*(main.extract_pdf_text(warmup) for _ in main.extraction_pool._workers))
+
+        print(f"{main.NLP_WORKERS} workers, {main.PDF_PAGES_PER_JOB} pages per job, {args.lines} lines per page")
+        print(f"{'pages':>6} {'serial pages/s':>15} {'pool pages/s':>13} {'speedup':>8} {'worker peak RSS':>16}")
+        for n_pages in args.pages:
+            path = os.path.join(scratch, f"{n_pages}.pdf")
+            write_pdf(path, n_pages, args.lines)
+
+            start = time.perf_counter()
+            serial_text = extract_text_from_pdf(path)
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pages = await main.extract_pdf_text(path)
+            parallel = time.perf_counter() - start
+
+            assert join_pages(pages) == serial_text, "parallel text differs from serial text"
+            assert [number for number, _ in pages] == list(range(1, n_pages + 1))
+            print(f"{n_pages:>6} {n_pages / serial:>15.1f} {n_pages / parallel:>13.1f} {serial / parallel:>7.2f}x "
+                  f"{worker_peak_rss_mib(main.extraction_pool):>12.0f} MiB")
+    await main.extraction_pool.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=lambda s: [int(n) for n in s.split(",")], default=[10, 50, 100, 500])
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--pages-per-job", type=int, default=8)
+    args = parser.parse_args()
+    # main reads its pool settings from the environment at import
+    os.environ["NLP_WORKERS"] = str(args.workers)
+    os.environ["PDF_PAGES_PER_JOB"] = str(args.pages_per_job)
+    asyncio.run(run(args))
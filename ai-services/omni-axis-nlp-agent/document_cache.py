@@ -0,0 +1,198 @@
+"""
+Content-addressed cache of extraction results.
+
+A document is keyed on the SHA-256 of its bytes plus a hash of its content
+type and the extraction pipeline version (extraction code, spaCy model,
+tesseract), so re-uploads of the same file hit and upgrades miss. Results
+are kept in two tiers:
+
+    disk   one JSON file per key in cache_dir, evicted least recently used
+           first once the files exceed max_bytes
+    Redis  optional, shared by all replicas, <prefix><key> with a TTL
+
+A disk miss that hits Redis is copied to disk. Each process keeps its own
+LRU index of the directory, rebuilt from file modification times at start.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(content_sha256: str, content_type: str, pipeline_version: str) -> str:
+    """Cache key for a document's bytes under the given pipeline version"""
+    variant = hashlib.sha256(f"{content_type}\n{pipeline_version}".encode()).hexdigest()[:16]
+    return f"{content_sha256}-{variant}"
+
+
+class DiskLRU:
+    """Size-bounded directory of files, evicted least recently used first"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, least recent first
+        self.size = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self):
+        """Index the files already in the directory, oldest access first"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+        self._evict()
+        logger.info(f"Extraction cache: {len(self.entries)} entries, {self.size / 2 ** 20:.1f} MiB in {self.directory}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The modification time carries recency across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process
+            self.size -= self.entries.pop(key, 0)
+            return None
+        if key not in self.entries:
+            self.size += len(data)
+        self.entries[key] = len(data)
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data) - self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+class DocumentCache:
+    """Disk + optional Redis cache of extraction results with hit and latency counters"""
+
+    def __init__(
+        self,
+        disk: Optional[DiskLRU],
+        redis_client=None,
+        prefix: str = "nlp:extraction:",
+        ttl: int = 7 * 86400
+    ):
+        self.disk = disk
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.disk_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latency_saved = 0.0
+        self.hit_seconds = 0.0
+
+    def start(self):
+        if self.disk is None:
+            return
+        try:
+            self.disk.load()
+        except OSError as e:
+            logger.warning(f"Extraction cache directory unavailable, disk tier disabled: {e}")
+            self.disk = None
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached extraction result for the key, or None on a miss"""
+        started = time.perf_counter()
+        if self.disk is not None:
+            try:
+                data = self.disk.get(key)
+            except OSError as e:
+                self.errors += 1
+                logger.warning(f"Extraction cache disk read failed: {e}")
+                data = None
+            if data is not None:
+                self.disk_hits += 1
+                return self._hit(data, started)
+
+        if self.redis_client is not None:
+            try:
+                data = await self.redis_client.get(f"{self.prefix}{key}")
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Extraction cache Redis read failed: {e}")
+                data = None
+            if data is not None:
+                self.redis_hits += 1
+                self._write_disk(key, data)
+                return self._hit(data, started)
+
+        self.misses += 1
+        return None
+
+    def _hit(self, data: bytes, started: float) -> Dict[str, Any]:
+        value = json.loads(data)
+        elapsed = time.perf_counter() - started
+        self.hit_seconds += elapsed
+        self.latency_saved += max(value["compute_seconds"] - elapsed, 0.0)
+        return value["result"]
+
+    def _write_disk(self, key: str, data: bytes):
+        if self.disk is None:
+            return
+        try:
+            self.disk.put(key, data)
+        except OSError as e:
+            self.errors += 1
+            logger.warning(f"Extraction cache disk write failed: {e}")
+
+    async def set(self, key: str, result: Dict[str, Any], compute_seconds: float):
+        data = json.dumps({"result": result, "compute_seconds": compute_seconds}, separators=(",", ":")).encode()
+        self._write_disk(key, data)
+        if self.redis_client is not None:
+            try:
+                await self.redis_client.set(f"{self.prefix}{key}", data, ex=self.ttl)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Extraction cache Redis write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.disk_hits + self.redis_hits
+        lookups = hits + self.misses
+        return {
+            "disk_entries": len(self.disk.entries) if self.disk is not None else 0,
+            "disk_bytes": self.disk.size if self.disk is not None else 0,
+            "disk_max_bytes": self.disk.max_bytes if self.disk is not None else 0,
+            "disk_evictions": self.disk.evictions if self.disk is not None else 0,
+            "disk_hits": self.disk_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "errors": self.errors,
+            "average_hit_ms": self.hit_seconds / hits * 1000 if hits else 0.0,
+            "latency_saved_seconds": self.latency_saved
+        }
@@ -0,0 +1,411 @@
+"""
+CPU-bound document extraction: PDF text, OCR and entity extraction.
+
+Kept free of the web app so the process pool's workers import only this
+module. Each worker loads the spaCy model once, on its first job. A
+document source is either the uploaded bytes or the path of a file.
+"""
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import io
+import logging
+import re
+import time
+
+import spacy
+import pdfplumber
+import pypdfium2 as pdfium
+import cv2
+import numpy as np
+from pdfminer.pdfpage import PDFPage
+
+from pydantic import BaseModel
+
+import ocr
+import preprocessing
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a change here alters extraction output; it is part of the cache key
+PIPELINE_VERSION = "3"
+SPACY_MODEL = "en_core_web_sm"
+# Only doc.ents is used, so components that NER does not depend on are skipped
+UNUSED_PIPES = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+ENTITY_BATCH_SIZE = 16  # Texts per nlp.pipe batch
+# Streaming NER runs spaCy on chunks of whole sentences up to this many characters,
+# far below spaCy's max_length
+NER_CHUNK_CHARS = 5000
+
+# A PDF page with images and fewer visible characters than this in its text
+# layer is treated as scanned, rendered and OCR'd
+MIN_TEXT_LAYER_CHARS = 20
+# Scanned pages are rendered with their long side at about this many pixels
+# (300 dpi on US Letter), within the DPI bounds below
+OCR_TARGET_LONG_SIDE = 3300
+OCR_MIN_DPI = 100
+OCR_MAX_DPI = 300
+
+_SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s+|\n\s*\n')
+_NON_SPACE = re.compile(r'\S')
+
+_nlp_en = None
+
+
+def get_nlp():
+    """English spaCy pipeline for entity labels, loaded once per process"""
+    global _nlp_en
+    if _nlp_en is None:
+        try:
+            _nlp_en = spacy.load(SPACY_MODEL)
+            _nlp_en.select_pipes(disable=[name for name in UNUSED_PIPES if name in _nlp_en.pipe_names])
+            logger.info(f"English NLP model loaded with {_nlp_en.pipe_names}")
+        except OSError:
+            logger.warning("English NLP model not found, using blank model")
+            _nlp_en = spacy.blank("en")
+    return _nlp_en
+
+
+def pipeline_version() -> str:
+    """Everything that shapes extraction output, without loading the models"""
+    model_version = spacy.util.get_package_version(SPACY_MODEL)
+    model = f"{SPACY_MODEL}-{model_version}" if model_version else "blank"
+    return f"pipeline-{PIPELINE_VERSION}|spacy-{spacy.__version__}|{model}|{ocr.backend_version()}"
+
+
+def warm_up():
+    """Pool worker initializer: load spaCy and start the OCR engine before the first job"""
+    get_nlp()
+    ocr.get_engine()
+
+
+class ExtractedEntities(BaseModel):
+    name: Optional[str] = None
+    address: Optional[str] = None
+    asset_type: Optional[str] = None
+    certificate_id: Optional[str] = None
+    date: Optional[str] = None
+    amount: Optional[str] = None
+    location: Optional[str] = None
+    confidence: float
+
+
+def extract_pdf_pages(
+    source: Union[bytes, str],
+    first: int = 1,
+    last: Optional[int] = None,
+    count_pages: bool = False
+) -> Dict[str, Any]:
+    """
+    Text of pages first..last (1-based, inclusive) as (page number, text) pairs.
+
+    Opens the document itself and parses only the requested pages, so page
+    ranges can run in separate processes. Each page's layout objects are released
+    once its text is out, keeping memory flat on long documents. Pages without a
+    usable text layer are rendered and OCR'd; the others never are. page_count
+    is the document's total page count when count_pages is set, and ocr_pages
+    lists the pages that went through OCR.
+    """
+    pages: List[Tuple[int, str]] = []
+    ocr_pages: List[int] = []
+    page_count = 0
+    page_numbers = range(first, last + 1) if last is not None else None
+    renderer = None  # Opened for the first scanned page
+    try:
+        stream = io.BytesIO(source) if isinstance(source, bytes) else source
+        with pdfplumber.open(stream, pages=page_numbers) as pdf:
+            for page in pdf.pages:
+                if page.page_number >= first:
+                    text = page.extract_text() or ""
+                    if is_scanned_page(page, text):
+                        if renderer is None:
+                            renderer = pdfium.PdfDocument(source)
+                        text = ocr_pdf_page(renderer, page.page_number) or text
+                        ocr_pages.append(page.page_number)
+                    pages.append((page.page_number, text))
+                page.close()
+            if count_pages:
+                page_count = sum(1 for _ in PDFPage.create_pages(pdf.doc))
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF pages {first}-{last or 'end'}: {e}")
+    finally:
+        if renderer is not None:
+            renderer.close()
+    return {"page_count": page_count, "pages": pages, "ocr_pages": ocr_pages}
+
+
+def is_scanned_page(page, text: str) -> bool:
+    """True when a page's text layer is missing or too thin and it has images to OCR"""
+    visible = sum(1 for char in text if not char.isspace())
+    return visible < MIN_TEXT_LAYER_CHARS and len(page.images) > 0
+
+
+def render_dpi(width_pt: float, height_pt: float) -> float:
+    """Rendering resolution that puts a page's long side near OCR_TARGET_LONG_SIDE pixels"""
+    long_side_inches = max(width_pt, height_pt) / 72
+    return min(max(OCR_TARGET_LONG_SIDE / long_side_inches, OCR_MIN_DPI), OCR_MAX_DPI)
+
+
+def ocr_pdf_page(document, page_number: int) -> str:
+    """OCR text of a rendered PDF page; empty if rendering or OCR fails"""
+    page = document[page_number - 1]
+    bitmap = None
+    try:
+        dpi = render_dpi(*page.get_size())
+        bitmap = page.render(scale=dpi / 72, grayscale=True)
+        return ocr_image(bitmap.to_numpy())
+    except Exception as e:
+        logger.error(f"Error running OCR on PDF page {page_number}: {e}")
+        return ""
+    finally:
+        if bitmap is not None:
+            bitmap.close()
+        page.close()
+
+
+def join_pages(pages: List[Tuple[int, str]]) -> str:
+    """Document text from (page number, text) pairs in page order"""
+    return "".join(f"{text}\n" for _, text in pages if text)
+
+
+def extract_text_from_pdf(source: Union[bytes, str]) -> str:
+    """Extract text from PDF file"""
+    return join_pages(extract_pdf_pages(source)["pages"])
+
+
+def ocr_image(image: np.ndarray) -> str:
+    """Preprocess a BGR or grayscale image and OCR it; shared by images and scanned PDF pages"""
+    # Downscale, crop, denoise as needed and binarize (see preprocessing)
+    prepared = preprocessing.preprocess(image)
+    
+    # Extract text using Tesseract (a warm engine per worker when available)
+    started = time.perf_counter()
+    text = ocr.image_to_string(prepared.image)
+    logger.debug(f"OCR of {image.shape[1]}x{image.shape[0]} image: {prepared.describe()}, "
+                  f"ocr={(time.perf_counter() - started) * 1000:.0f}ms")
+    return text
+
+
+def extract_text_from_image(source: Union[bytes, str]) -> str:
+    """Extract text from image using OCR"""
+    try:
+        # Load image; bytes are decoded in place, without a temporary file
+        if isinstance(source, bytes):
+            image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(source)
+        if image is None:
+            raise ValueError("Unreadable image")
+        
+        return ocr_image(image)
+    except Exception as e:
+        logger.error(f"Error extracting text from image: {e}")
+        return ""
+
+
+def extract_entities_from_text(text: str, doc=None) -> ExtractedEntities:
+    """Extract entities from text using NLP and regex patterns; doc is the text already run through spaCy"""
+    try:
+        # Process with spaCy
+        if doc is None:
+            doc = get_nlp()(text)
+        
+        # Initialize extracted data
+        entities = {
+            "name": None,
+            "address": None,
+            "asset_type": None,
+            "certificate_id": None,
+            "date": None,
+            "amount": None,
+            "location": None,
+            "confidence": 0.0
+        }
+        
+        # Extract named entities
+        names = []
+        locations = []
+        dates = []
+        
+        for ent in doc.ents:
+            if ent.label_ == "PERSON":
+                names.append(ent.text)
+            elif ent.label_ in ["GPE", "LOC"]:
+                locations.append(ent.text)
+            elif ent.label_ == "DATE":
+                dates.append(ent.text)
+        
+        # Use regex patterns for specific extractions
+        
+        # Certificate/ID patterns
+        cert_patterns = [
+            r'(?:certificate|cert|id|number|no\.?)\s*:?\s*([A-Z0-9\-]+)',
+            r'([A-Z]{2,}\d{4,})',
+            r'(\d{4,}[A-Z]{2,})'
+        ]
+        
+        for pattern in cert_patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match and not entities["certificate_id"]:
+                entities["certificate_id"] = match.group(1)
+                break
+        
+        # Amount patterns (currency)
+        amount_patterns = [
+            r'(?:USD|EUR|GBP|\$|€|£)\s*([0-9,]+(?:\.[0-9]{2})?)',
+            r'([0-9,]+(?:\.[0-9]{2})?)\s*(?:USD|EUR|GBP|dollars?|euros?|pounds?)'
+        ]
+        
+        for pattern in amount_patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match and not entities["amount"]:
+                entities["amount"] = match.group(1)
+                break
+        
+        # Asset type patterns
+        asset_types = [
+            "real estate", "property", "land", "building", "house", "apartment",
+            "art", "painting", "sculpture", "artwork", "collectible",
+            "gold", "silver", "commodity", "oil", "gas",
+            "watch", "jewelry", "luxury", "vintage"
+        ]
+        
+        text_lower = text.lower()
+        for asset_type in asset_types:
+            if asset_type in text_lower and not entities["asset_type"]:
+                entities["asset_type"] = asset_type
+                break
+        
+        # Address pattern (simple)
+        address_pattern = r'(\d+\s+[A-Za-z\s]+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr|Lane|Ln)[^,\n]*(?:,\s*[A-Za-z\s]+)*)'
+        address_match = re.search(address_pattern, text, re.IGNORECASE)
+        if address_match:
+            entities["address"] = address_match.group(1).strip()
+        
+        # Assign extracted entities
+        if names and not entities["name"]:
+            entities["name"] = names[0]
+        
+        if locations and not entities["location"]:
+            entities["location"] = locations[0]
+        
+        if dates and not entities["date"]:
+            entities["date"] = dates[0]
+        
+        # Calculate confidence based on number of extracted entities
+        entities["confidence"] = entity_confidence(entities)
+        
+        return ExtractedEntities(**entities)
+        
+    except Exception as e:
+        logger.error(f"Error extracting entities: {e}")
+        return ExtractedEntities(confidence=0.0)
+
+
+def entity_confidence(entities: Dict[str, Any]) -> float:
+    """Confidence based on number of extracted entities"""
+    extracted_count = sum(1 for v in entities.values() if v is not None and v != "")
+    return min(extracted_count / 6.0, 1.0)  # 6 main fields
+
+
+def sentence_chunks(text: str, max_chars: int = NER_CHUNK_CHARS) -> Iterator[Tuple[int, int]]:
+    """
+    (start, end) offsets of consecutive chunks of whole sentences, each at
+    most max_chars long; a longer sentence is split at the last space that
+    fits. Blank chunks are skipped.
+    """
+    chunk_start = 0
+    last_break = 0  # End of the last sentence seen
+    boundaries = [match.end() for match in _SENTENCE_END.finditer(text)] + [len(text)]
+    for boundary in boundaries:
+        while boundary - chunk_start > max_chars:
+            if last_break > chunk_start:
+                end = last_break
+            else:
+                space = max(text.rfind(" ", chunk_start, chunk_start + max_chars),
+                            text.rfind("\n", chunk_start, chunk_start + max_chars))
+                end = space + 1 if space > chunk_start else chunk_start + max_chars
+            if _NON_SPACE.search(text, chunk_start, end):
+                yield chunk_start, end
+            chunk_start = end
+        last_break = boundary
+    if _NON_SPACE.search(text, chunk_start):
+        yield chunk_start, len(text)
+
+
+def extract_entities_chunks(pages: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """
+    Pool job: entities of each sentence-aligned chunk of the pages. Each
+    result has the chunk's page, its index on the page, its start and end
+    offsets in the page text, the fields found in it and its spaCy entities
+    with offsets in the page text.
+    """
+    nlp = get_nlp()
+    chunks = [
+        (number, index, start, end, text[start:end])
+        for number, text in pages
+        for index, (start, end) in enumerate(sentence_chunks(text))
+    ]
+    try:
+        docs = list(nlp.pipe([chunk[4] for chunk in chunks], batch_size=ENTITY_BATCH_SIZE))
+    except Exception as e:
+        logger.warning(f"Batched entity extraction failed, retrying chunks one by one: {e}")
+        docs = []
+        for chunk in chunks:
+            try:
+                docs.append(nlp(chunk[4]))
+            except Exception:
+                # Regex fields only
+                docs.append(nlp.make_doc(chunk[4]))
+
+    results = []
+    for (number, index, start, end, text), doc in zip(chunks, docs):
+        fields = extract_entities_from_text(text, doc).model_dump(exclude={"confidence"})
+        results.append({
+            "page": number,
+            "chunk": index,
+            "start": start,
+            "end": end,
+            "fields": {field: value for field, value in fields.items() if value is not None and value != ""},
+            "entities": [
+                {"label": ent.label_, "text": ent.text, "start": start + ent.start_char, "end": start + ent.end_char}
+                for ent in doc.ents
+            ]
+        })
+    return results
+
+
+def merge_chunk_fields(chunk_fields: List[Dict[str, Any]]) -> ExtractedEntities:
+    """Document entities from the fields of each chunk in document order; the first value found wins"""
+    entities: Dict[str, Any] = {field: None for field in ExtractedEntities.model_fields}
+    entities["confidence"] = 0.0
+    for fields in chunk_fields:
+        for field, value in fields.items():
+            if entities[field] is None:
+                entities[field] = value
+    entities["confidence"] = entity_confidence(entities)
+    return ExtractedEntities(**entities)
+
+
+def extract_entities_batch(texts: List[str]) -> List[Dict[str, Any]]:
+    """Pool job: entities of many texts, run through spaCy in batches"""
+    try:
+        docs = list(get_nlp().pipe(texts, batch_size=ENTITY_BATCH_SIZE))
+    except Exception as e:
+        # One bad text fails the whole batch; go one by one so only that text fails
+        logger.warning(f"Batched entity extraction failed, retrying texts one by one: {e}")
+        docs = [None] * len(texts)
+    return [extract_entities_from_text(text, doc).model_dump() for text, doc in zip(texts, docs)]
+
+
+def process_document(source: Union[bytes, str], content_type: str, with_entities: bool = True) -> Dict[str, Any]:
+    """Pool job: extract the text of a document, its pages and, optionally, its entities"""
+    if content_type == "application/pdf":
+        pages = extract_pdf_pages(source)["pages"]
+        text = join_pages(pages)
+    else:
+        text = extract_text_from_image(source)
+        pages = [(1, text)]
+
+    entities = None
+    if with_entities and text.strip():
+        entities = extract_entities_from_text(text).model_dump()
+    return {"text": text, "pages": pages, "entities": entities}
@@ -0,0 +1,779 @@
+"""
+Asynchronous extraction jobs.
+
+POST /jobs stores the upload and returns a job id at once, so a long OCR
+run holds neither the HTTP connection nor the gateway's 60 s timeout.
+Every agent process runs `concurrency` background tasks that take queued
+jobs in priority order, run them through the extraction pool and store
+the result for GET /jobs/{id}.
+
+Lower priorities run first, and jobs of equal priority run in submission
+order. KYC documents go in as "high", and bulk re-verification goes in as
+"low".
+
+RedisJobQueue is shared by all replicas:
+
+    <prefix>queue         sorted set of queued job ids, by priority then submission time
+    <prefix>running       sorted set of running job ids, by lease deadline
+    <prefix>leases        hash of running job id to the token of the pop that holds it
+    <prefix>delayed       sorted set of "<queue score>:<id>" for deferred jobs, by the time they are due
+    <prefix>wakeup        list with a token per push, for idle workers to block on
+    <prefix>job:<id>      the job as JSON, kept for ttl seconds
+    <prefix>payload:<id>  the uploaded bytes, deleted once the job finishes
+    <prefix>payload_sizes hash of job id to the size of its stored payload
+    <prefix>payload_bytes total size of the stored payloads
+
+A job moves from queue to running in one script call, so it is always in
+one of the two sets. While a job runs, its process renews the lease every
+lease/3 seconds. A job whose lease runs out is assumed to belong to a
+process that died, and it is queued again whatever its stored status says
+(a process can die before it marks the job running). The running status,
+renewals, results and requeues are written by scripts that first check
+the job's lease token is still the one its process popped, so a process
+that lost its lease (e.g. stalled past it) cannot overwrite the job
+another replica has taken over.
+A process that shuts down cleanly requeues its jobs at once.
+
+A job that finds no free extraction worker (JobDeferred) is not failed and
+does not use an attempt. It waits defer_delay seconds, doubled on each
+deferral up to max_defer_delay, before it is queued again. In Redis it
+waits in delayed, and each pop first moves the jobs that are due to the
+queue.
+
+Queued and running payloads are bounded by max_payload_bytes as well as
+by max_queued, so a queue of large uploads cannot fill Redis (or the local
+disk): a submission that would pass the limit gets JobQueueFull. In Redis
+the check and the write are one script call. The scripts derive payload
+keys from the prefix, so on Redis Cluster the prefix needs a hash tag
+(e.g. "{nlp:jobs}:").
+
+LocalJobQueue is the in-process fallback for when no Redis is configured
+or Redis does not answer at start-up. Its jobs live in memory and are lost
+on restart.
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+import uuid
+
+from uploads import Upload
+
+logger = logging.getLogger(__name__)
+
+JOB_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+_SCORE_PRIORITY = 10 ** 13  # Queue score: priority * this + submission time in ms
+
+JobHandler = Callable[[Dict[str, Any], Upload], Awaitable[Dict[str, Any]]]
+
+# KEYS: queue, running, leases, delayed. ARGV: lease deadline, lease token, now.
+# Queues the delayed jobs that are due, then moves the first queued job to
+# running, held by the token.
+POP_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[3], 'LIMIT', 0, 100)
+for _, member in ipairs(due) do
+    local sep = string.find(member, ':', 1, true)
+    redis.call('ZADD', KEYS[1], string.sub(member, 1, sep - 1), string.sub(member, sep + 1))
+end
+if #due > 0 then
+    redis.call('ZREM', KEYS[4], unpack(due))
+end
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then
+    return false
+end
+redis.call('ZADD', KEYS[2], ARGV[1], popped[1])
+redis.call('HSET', KEYS[3], popped[1], ARGV[2])
+return popped[1]
+"""
+WAKEUP_TOKENS = 1000  # Cap on unconsumed wakeup tokens
+
+# KEYS: running, leases. ARGV: job id, lease token, new lease deadline.
+RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+# Lua helper: delete a payload and take its size off the payload total
+DELETE_PAYLOAD_LUA = """
+local function delete_payload(payload_key, sizes_key, bytes_key, job_id)
+    local size = redis.call('HGET', sizes_key, job_id)
+    if size then
+        redis.call('HDEL', sizes_key, job_id)
+        redis.call('DECRBY', bytes_key, size)
+    end
+    redis.call('DEL', payload_key)
+end
+"""
+
+# KEYS: payload, payload sizes, payload bytes. ARGV: job id, data, size, max
+# payload bytes, ttl, payload key prefix. Stores the payload unless the total
+# would pass the limit; returns 1 if stored.
+STORE_PAYLOAD_SCRIPT = """
+local size = tonumber(ARGV[3])
+local max_bytes = tonumber(ARGV[4])
+if tonumber(redis.call('GET', KEYS[3]) or '0') + size > max_bytes then
+    -- Recount without the payloads that expired instead of being deleted
+    local sizes = redis.call('HGETALL', KEYS[2])
+    local total = 0
+    for i = 1, #sizes, 2 do
+        if redis.call('EXISTS', ARGV[6] .. sizes[i]) == 1 then
+            total = total + tonumber(sizes[i + 1])
+        else
+            redis.call('HDEL', KEYS[2], sizes[i])
+        end
+    end
+    redis.call('SET', KEYS[3], total)
+    if total + size > max_bytes then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[5])
+redis.call('HSET', KEYS[2], ARGV[1], size)
+redis.call('INCRBY', KEYS[3], size)
+return 1
+"""
+
+# KEYS: payload, payload sizes, payload bytes. ARGV: job id.
+DELETE_PAYLOAD_SCRIPT = DELETE_PAYLOAD_LUA + """
+delete_payload(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+return 1
+"""
+
+# KEYS: leases, job. ARGV: job id, lease token, job JSON, ttl.
+# Stores the job (as running) if the token still holds it.
+MARK_RUNNING_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+# KEYS: running, leases, job, payload, payload sizes, payload bytes. ARGV: job
+# id, lease token, job JSON, ttl.
+# Stores a finished job and drops its payload if the token still holds the job.
+FINISH_SCRIPT = DELETE_PAYLOAD_LUA + """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[4])
+delete_payload(KEYS[4], KEYS[5], KEYS[6], ARGV[1])
+return 1
+"""
+
+# KEYS: running, leases, job, queue, wakeup, delayed. ARGV: job id, lease token
+# ("" for a reclaim), latest lease deadline of a reclaim, job JSON, ttl, queue
+# score, wakeup token cap, time the job is due (0 for now).
+# Moves a running job back to the queue, or to delayed until it is due, if the
+# token still holds it, or for a reclaim, if its lease ran out by the given time.
+REQUEUE_SCRIPT = """
+if ARGV[2] ~= '' then
+    if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+        return 0
+    end
+else
+    local deadline = redis.call('ZSCORE', KEYS[1], ARGV[1])
+    if not deadline or tonumber(deadline) > tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[4], 'EX', ARGV[5])
+if tonumber(ARGV[8]) > 0 then
+    redis.call('ZADD', KEYS[6], ARGV[8], ARGV[6] .. ':' .. ARGV[1])
+    return 1
+end
+redis.call('ZADD', KEYS[4], ARGV[6], ARGV[1])
+redis.call('LPUSH', KEYS[5], 1)
+redis.call('LTRIM', KEYS[5], 0, tonumber(ARGV[7]) - 1)
+return 1
+"""
+
+
+class JobQueueFull(Exception):
+    """The queue already holds max_queued jobs, or max_payload_bytes of uploads"""
+
+
+class JobFailed(Exception):
+    """A job failed with an HTTP-style status; retry=True queues it again while attempts remain"""
+
+    def __init__(self, status_code: int, detail: str, retry: bool = False):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry = retry
+
+
+class JobDeferred(Exception):
+    """No capacity to run the job now; it is queued again after a backoff without using an attempt"""
+
+
+class JobQueue(ABC):
+    """Background job runner shared by both backends; the storage methods are the backend's"""
+
+    backend = ""
+    renew_interval: Optional[float] = None  # Seconds between lease renewals of a running job
+
+    def __init__(
+        self,
+        handler: JobHandler,
+        concurrency: int,
+        max_queued: int = 1000,
+        max_payload_bytes: int = 1024 * 2 ** 20,
+        ttl: int = 86400,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+        defer_delay: float = 2.0,
+        max_defer_delay: float = 60.0
+    ):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_payload_bytes = max_payload_bytes  # Stored uploads of queued and running jobs
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.defer_delay = defer_delay  # First backoff of a deferred job, doubled per deferral
+        self.max_defer_delay = max_defer_delay
+        self._tasks: List[asyncio.Task] = []
+        self._active: Dict[str, Dict[str, Any]] = {}  # Jobs this process is running
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.discarded = 0  # Runs whose lease had passed to another process
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        logger.info(f"Job queue ({self.backend}) started with {self.concurrency} tasks")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in list(self._active.values()):
+            await self._requeue(job)
+        self._active.clear()
+
+    async def submit(self, upload: Upload, mode: str, priority: str) -> Dict[str, Any]:
+        """Store the upload as a new queued job and return the job"""
+        if await self.depth() >= self.max_queued:
+            self.rejected += 1
+            raise JobQueueFull(f"{self.max_queued} jobs already queued")
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "mode": mode,
+            "priority": priority,
+            "filename": upload.filename,
+            "content_type": upload.content_type,
+            "submitted_at": now,
+            "queued_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "attempts": 0,
+            "deferrals": 0,
+            "result": None,
+            "error": None
+        }
+        try:
+            await self._store_payload(job, upload)
+        except JobQueueFull:
+            self.rejected += 1
+            raise
+        await self.save(job)
+        await self._push(job)
+        self.submitted += 1
+        return job
+
+    async def _work(self):
+        while True:
+            try:
+                job_id = await self._pop()
+                if job_id is not None:
+                    await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job queue task error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _process(self, job_id: str):
+        job = await self.load(job_id)
+        if job is None:
+            # Expired while queued
+            await self._release(job_id)
+            await self._delete_payload(job_id)
+            return
+        upload = await self._load_payload(job)
+        started = time.time()
+        wait = max(started - job["queued_at"], 0.0)
+        self.started += 1
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        job.update(status="running", started_at=started, attempts=job["attempts"] + 1)
+        if not await self._mark_running(job):
+            self._discard(job_id)
+            return
+        self._active[job_id] = job
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id)) if self.renew_interval else None
+
+        try:
+            if upload is None:
+                raise JobFailed(410, "The uploaded document expired before the job ran")
+            job["result"] = await self.handler(job, upload)
+            job["status"] = "completed"
+            self.completed += 1
+        except asyncio.CancelledError:
+            # Shutting down; stop() queues it again
+            raise
+        except JobDeferred:
+            # Busy, not broken: give the attempt back and back off (jobs from before
+            # deferrals were tracked have no count)
+            deferrals = job.get("deferrals", 0)
+            delay = min(self.defer_delay * 2 ** deferrals, self.max_defer_delay)
+            job.update(attempts=job["attempts"] - 1, deferrals=deferrals + 1)
+            self.deferred += 1
+            self._active.pop(job_id, None)
+            logger.info(f"Job {job_id} deferred for {delay:g}s")
+            if not await self._requeue(job, delay=delay):
+                self._discard(job_id)
+            return
+        except Exception as e:
+            if not isinstance(e, JobFailed):
+                logger.error(f"Job {job_id} failed: {e}")
+                e = JobFailed(500, "Failed to process document")
+            if e.retry and job["attempts"] < self.max_attempts:
+                self.retried += 1
+                self._active.pop(job_id, None)
+                if not await self._requeue(job):
+                    self._discard(job_id)
+                return
+            job["status"] = "failed"
+            job["error"] = {"status_code": e.status_code, "detail": e.detail}
+            self.failed += 1
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+        self._active.pop(job_id, None)
+        job["finished_at"] = time.time()
+        self.run_seconds += job["finished_at"] - started
+        if not await self._finish(job):
+            self._discard(job_id)
+
+    def _discard(self, job_id: str):
+        self.discarded += 1
+        logger.warning(f"Job {job_id} lease passed to another process, discarding this run")
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                if not await self._renew(job_id):
+                    return
+            except Exception as e:
+                logger.warning(f"Failed to renew the lease of job {job_id}: {e}")
+
+    async def _finish(self, job: Dict[str, Any]) -> bool:
+        """Store the finished job and drop its payload; False if the job is no longer this process's"""
+        await self.save(job)
+        await self._delete_payload(job["id"])
+        await self._release(job["id"])
+        return True
+
+    async def _requeue(self, job: Dict[str, Any], delay: float = 0.0) -> bool:
+        """Queue the job again, due in delay seconds; False if it is no longer this process's"""
+        job.update(status="queued", queued_at=time.time() + delay, started_at=None)
+        await self.save(job)
+        await self._release(job["id"])
+        await self._push(job, delay)
+        return True
+
+    def _score(self, job: Dict[str, Any]) -> float:
+        return JOB_PRIORITIES[job["priority"]] * _SCORE_PRIORITY + int(job["queued_at"] * 1000)
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "concurrency": self.concurrency,
+            "queue_depth": await self.depth(),
+            "queue_depth_by_priority": await self.depth_by_priority(),
+            "oldest_queued_seconds": await self.oldest_queued_seconds(),
+            "max_queued": self.max_queued,
+            "payload_bytes": await self.payload_bytes(),
+            "max_payload_bytes": self.max_payload_bytes,
+            "running": len(self._active),
+            "submitted": self.submitted,
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "deferred": self.deferred,
+            "rejected": self.rejected,
+            "discarded": self.discarded,
+            "average_wait_ms": self.wait_seconds / self.started * 1000 if self.started else 0.0,
+            "max_wait_ms": self.max_wait_seconds * 1000,
+            "average_run_ms": self.run_seconds / (self.completed + self.failed) * 1000
+            if self.completed + self.failed else 0.0
+        }
+
+    # Backend storage
+
+    @abstractmethod
+    async def save(self, job: Dict[str, Any]):
+        """Store the job record"""
+
+    @abstractmethod
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The job record, or None once it expired"""
+
+    @abstractmethod
+    async def depth(self) -> int:
+        """Queued jobs, deferred ones included"""
+
+    @abstractmethod
+    async def depth_by_priority(self) -> Dict[str, int]:
+        """Queued jobs per priority name"""
+
+    @abstractmethod
+    async def oldest_queued_seconds(self) -> float:
+        """Seconds the oldest queued job has waited"""
+
+    @abstractmethod
+    async def payload_bytes(self) -> int:
+        """Total size of the stored payloads"""
+
+    @abstractmethod
+    async def _push(self, job: Dict[str, Any], delay: float = 0.0):
+        """Queue the job, or hold it for delay seconds first"""
+
+    @abstractmethod
+    async def _pop(self) -> Optional[str]:
+        """Next job id in priority order, or None after poll_interval without one"""
+
+    async def _mark_running(self, job: Dict[str, Any]) -> bool:
+        """Store the job as running; False if it is no longer this process's"""
+        await self.save(job)
+        return True
+
+    async def _release(self, job_id: str):
+        """The job is no longer running here"""
+
+    async def _renew(self, job_id: str) -> bool:
+        """Extend the running job's lease; False once it has passed to another process"""
+        return True
+
+    @abstractmethod
+    async def _store_payload(self, job: Dict[str, Any], upload: Upload):
+        """Store the job's upload; raises JobQueueFull if it would pass max_payload_bytes"""
+
+    @abstractmethod
+    async def _load_payload(self, job: Dict[str, Any]) -> Optional[Upload]:
+        """The job's upload; it stays stored, for retries, until _delete_payload"""
+
+    @abstractmethod
+    async def _delete_payload(self, job_id: str):
+        """Drop the job's upload"""
+
+
+class RedisJobQueue(JobQueue):
+    """Jobs in Redis, shared by every replica"""
+
+    backend = "redis"
+
+    def __init__(self, redis_client, handler: JobHandler, concurrency: int, prefix: str = "nlp:jobs:",
+                 lease: float = 900.0, **options):
+        super().__init__(handler, concurrency, **options)
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.lease = lease
+        self.renew_interval = lease / 3
+        self.reclaimed = 0
+        self._next_reclaim = 0.0
+        self._leases: Dict[str, str] = {}  # Lease token of each job this process popped
+        self.pop_script = redis_client.register_script(POP_SCRIPT)
+        self.renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self.mark_running_script = redis_client.register_script(MARK_RUNNING_SCRIPT)
+        self.finish_script = redis_client.register_script(FINISH_SCRIPT)
+        self.store_payload_script = redis_client.register_script(STORE_PAYLOAD_SCRIPT)
+        self.delete_payload_script = redis_client.register_script(DELETE_PAYLOAD_SCRIPT)
+        self.requeue_script = redis_client.register_script(REQUEUE_SCRIPT)
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}{name}"
+
+    async def save(self, job: Dict[str, Any]):
+        await self.redis_client.set(self._key(f"job:{job['id']}"), json.dumps(job, separators=(",", ":")), ex=self.ttl)
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        data = await self.redis_client.get(self._key(f"job:{job_id}"))
+        return json.loads(data) if data is not None else None
+
+    async def depth(self) -> int:
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zcard(self._key("queue"))
+        pipe.zcard(self._key("delayed"))
+        return sum(await pipe.execute())
+
+    async def depth_by_priority(self) -> Dict[str, int]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        for priority in JOB_PRIORITIES.values():
+            pipe.zcount(self._key("queue"), priority * _SCORE_PRIORITY, (priority + 1) * _SCORE_PRIORITY - 1)
+        return dict(zip(JOB_PRIORITIES, await pipe.execute()))
+
+    async def oldest_queued_seconds(self) -> float:
+        # The oldest job is the lowest score modulo the priority band; one ZRANGE per band
+        pipe = self.redis_client.pipeline(transaction=False)
+        for priority in JOB_PRIORITIES.values():
+            pipe.zrangebyscore(self._key("queue"), priority * _SCORE_PRIORITY, (priority + 1) * _SCORE_PRIORITY - 1,
+                               start=0, num=1, withscores=True)
+        oldest = [entries[0][1] % _SCORE_PRIORITY for entries in await pipe.execute() if entries]
+        return max(time.time() - min(oldest) / 1000, 0.0) if oldest else 0.0
+
+    async def payload_bytes(self) -> int:
+        return int(await self.redis_client.get(self._key("payload_bytes")) or 0)
+
+    async def _push(self, job: Dict[str, Any], delay: float = 0.0):
+        if delay > 0:
+            # The next pop after it is due moves it to the queue
+            await self.redis_client.zadd(self._key("delayed"), {f"{self._score(job)}:{job['id']}": time.time() + delay})
+            return
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.zadd(self._key("queue"), {job["id"]: self._score(job)})
+        pipe.lpush(self._key("wakeup"), 1)
+        pipe.ltrim(self._key("wakeup"), 0, WAKEUP_TOKENS - 1)
+        await pipe.execute()
+
+    async def _pop(self) -> Optional[str]:
+        await self._reclaim()
+        keys = [self._key("queue"), self._key("running"), self._key("leases"), self._key("delayed")]
+        token = uuid.uuid4().hex
+        now = time.time()
+        job_id = await self.pop_script(keys=keys, args=[now + self.lease, token, now])
+        if job_id is None:
+            # Woken by the next push, or try again after poll_interval
+            await self.redis_client.blpop(self._key("wakeup"), timeout=self.poll_interval)
+            now = time.time()
+            job_id = await self.pop_script(keys=keys, args=[now + self.lease, token, now])
+        if job_id is None:
+            return None
+        job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+        self._leases[job_id] = token
+        return job_id
+
+    async def _release(self, job_id: str):
+        self._leases.pop(job_id, None)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.zrem(self._key("running"), job_id)
+        pipe.hdel(self._key("leases"), job_id)
+        await pipe.execute()
+
+    async def _mark_running(self, job: Dict[str, Any]) -> bool:
+        marked = bool(await self.mark_running_script(
+            keys=[self._key("leases"), self._key(f"job:{job['id']}")],
+            args=[job["id"], self._leases.get(job["id"], ""), json.dumps(job, separators=(",", ":")), self.ttl]
+        ))
+        if not marked:
+            self._leases.pop(job["id"], None)
+        return marked
+
+    async def _renew(self, job_id: str) -> bool:
+        return bool(await self.renew_script(
+            keys=[self._key("running"), self._key("leases")],
+            args=[job_id, self._leases.get(job_id, ""), time.time() + self.lease]
+        ))
+
+    async def _finish(self, job: Dict[str, Any]) -> bool:
+        return bool(await self.finish_script(
+            keys=[self._key("running"), self._key("leases"), self._key(f"job:{job['id']}"),
+                  self._key(f"payload:{job['id']}"), self._key("payload_sizes"), self._key("payload_bytes")],
+            args=[job["id"], self._leases.pop(job["id"], ""), json.dumps(job, separators=(",", ":")), self.ttl]
+        ))
+
+    async def _requeue(self, job: Dict[str, Any], delay: float = 0.0, expired_by: Optional[float] = None) -> bool:
+        """Queue a job running here again, or with expired_by, one whose lease ran out by then"""
+        job.update(status="queued", queued_at=time.time() + delay, started_at=None)
+        token = self._leases.pop(job["id"], "") if expired_by is None else ""
+        if expired_by is None and not token:
+            return False
+        return bool(await self.requeue_script(
+            keys=[self._key("running"), self._key("leases"), self._key(f"job:{job['id']}"),
+                  self._key("queue"), self._key("wakeup"), self._key("delayed")],
+            args=[job["id"], token, expired_by or 0, json.dumps(job, separators=(",", ":")), self.ttl,
+                  self._score(job), WAKEUP_TOKENS, job["queued_at"] if delay > 0 else 0]
+        ))
+
+    async def _reclaim(self):
+        """Queue again the jobs whose lease ran out, at most once per lease/10"""
+        now = time.time()
+        if now < self._next_reclaim:
+            return
+        self._next_reclaim = now + self.lease / 10
+        for job_id in await self.redis_client.zrangebyscore(self._key("running"), 0, now):
+            job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+            job = await self.load(job_id)
+            if job is None or job["finished_at"] is not None:
+                # Expired, or finished without being released
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.zrem(self._key("running"), job_id)
+                pipe.hdel(self._key("leases"), job_id)
+                removed, _ = await pipe.execute()
+                if removed and job is None:
+                    await self._delete_payload(job_id)
+            # "queued" too: the process died between the pop and marking it running.
+            # Only one process wins the move, and not if the lease was renewed meanwhile.
+            elif await self._requeue(job, expired_by=now):
+                self.reclaimed += 1
+                logger.warning(f"Job {job_id} lease expired, queueing it again")
+
+    async def _store_payload(self, job: Dict[str, Any], upload: Upload):
+        if upload.size > self.max_payload_bytes:
+            raise JobQueueFull(f"Upload larger than the {self.max_payload_bytes} byte payload limit")
+        # A spilled upload is read back from disk off the event loop
+        data = await asyncio.to_thread(upload.read) if upload.path is not None else upload.data
+        stored = await self.store_payload_script(
+            keys=[self._key(f"payload:{job['id']}"), self._key("payload_sizes"), self._key("payload_bytes")],
+            args=[job["id"], data, len(data), self.max_payload_bytes, self.ttl, self._key("payload:")]
+        )
+        if not stored:
+            raise JobQueueFull(f"{self.max_payload_bytes} bytes of uploads already queued")
+
+    async def _load_payload(self, job: Dict[str, Any]) -> Optional[Upload]:
+        data = await self.redis_client.get(self._key(f"payload:{job['id']}"))
+        return Upload.from_bytes(job["filename"], job["content_type"], data) if data is not None else None
+
+    async def _delete_payload(self, job_id: str):
+        await self.delete_payload_script(
+            keys=[self._key(f"payload:{job_id}"), self._key("payload_sizes"), self._key("payload_bytes")],
+            args=[job_id]
+        )
+
+    async def stats(self) -> Dict[str, Any]:
+        stats = await super().stats()
+        stats["reclaimed"] = self.reclaimed
+        return stats
+
+
+class LocalJobQueue(JobQueue):
+    """Jobs in this process's memory, for running without Redis"""
+
+    backend = "local"
+
+    def __init__(self, handler: JobHandler, concurrency: int, **options):
+        super().__init__(handler, concurrency, **options)
+        self._heap: List[Tuple[float, int, str]] = []  # (score, order, job id)
+        self._available = asyncio.Semaphore(0)  # One permit per queued job
+        self._order = itertools.count()  # Tie-break for jobs queued in the same millisecond
+        self._delayed = 0  # Deferred jobs not yet due
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._payloads: Dict[str, Upload] = {}
+        self._payload_bytes = 0
+        self._expiry: Deque[Tuple[float, str]] = deque()  # (expiry, job id) of finished jobs, oldest first
+
+    async def save(self, job: Dict[str, Any]):
+        self._jobs[job["id"]] = job
+        if job["finished_at"] is not None:
+            self._expiry.append((job["finished_at"] + self.ttl, job["id"]))
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            self._jobs.pop(self._expiry.popleft()[1], None)
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    async def depth(self) -> int:
+        return len(self._heap) + self._delayed
+
+    async def depth_by_priority(self) -> Dict[str, int]:
+        names = {value: name for name, value in JOB_PRIORITIES.items()}
+        counts = dict.fromkeys(JOB_PRIORITIES, 0)
+        for score, _, _ in self._heap:
+            counts[names[int(score // _SCORE_PRIORITY)]] += 1
+        return counts
+
+    async def oldest_queued_seconds(self) -> float:
+        oldest = [score % _SCORE_PRIORITY for score, _, _ in self._heap]
+        return max(time.time() - min(oldest) / 1000, 0.0) if oldest else 0.0
+
+    async def payload_bytes(self) -> int:
+        return self._payload_bytes
+
+    async def _push(self, job: Dict[str, Any], delay: float = 0.0):
+        if delay > 0:
+            self._delayed += 1
+            asyncio.get_running_loop().call_later(delay, self._enqueue, job, True)
+        else:
+            self._enqueue(job)
+
+    def _enqueue(self, job: Dict[str, Any], delayed: bool = False):
+        if delayed:
+            self._delayed -= 1
+        heapq.heappush(self._heap, (self._score(job), next(self._order), job["id"]))
+        self._available.release()
+
+    async def _pop(self) -> Optional[str]:
+        # Not wait_for: on 3.11 it can drop a permit taken just as the timeout fires
+        acquire = asyncio.ensure_future(self._available.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=self.poll_interval)
+        except asyncio.CancelledError:
+            if acquire.done() and not acquire.cancelled():
+                # Cancelled after the permit was taken: give it back
+                self._available.release()
+            raise
+        finally:
+            if not acquire.done():
+                acquire.cancel()
+        if not acquire.done() or acquire.cancelled():
+            return None
+        return heapq.heappop(self._heap)[2]
+
+    async def _store_payload(self, job: Dict[str, Any], upload: Upload):
+        if self._payload_bytes + upload.size > self.max_payload_bytes:
+            raise JobQueueFull(f"{self.max_payload_bytes} bytes of uploads already queued")
+        # Takes over the request's upload, spilled file included
+        self._payloads[job["id"]] = upload.detach()
+        self._payload_bytes += upload.size
+
+    async def _load_payload(self, job: Dict[str, Any]) -> Optional[Upload]:
+        return self._payloads.get(job["id"])
+
+    async def _delete_payload(self, job_id: str):
+        upload = self._payloads.pop(job_id, None)
+        if upload is not None:
+            self._payload_bytes -= upload.size
+            upload.close()
+
+
+async def open_job_queue(redis_client, handler: JobHandler, concurrency: int, **options) -> JobQueue:
+    """RedisJobQueue when the client answers, LocalJobQueue otherwise"""
+    lease = options.pop("lease", 900.0)
+    if redis_client is not None:
+        try:
+            await redis_client.ping()
+            return RedisJobQueue(redis_client, handler, concurrency, lease=lease, **options)
+        except Exception as e:
+            logger.warning(f"Job queue Redis unavailable, using the in-process queue: {e}")
+    return LocalJobQueue(handler, concurrency, **options)
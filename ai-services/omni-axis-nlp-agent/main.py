@@ -1,21 +1,25 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+from contextlib import contextmanager
 import os
+import asyncio
+import json
 import logging
 from datetime import datetime
-import tempfile
-import shutil
+import time
 
-import spacy
-import pdfplumber
-import pytesseract
-from PIL import Image
-import cv2
-import numpy as np
-import re
+from document_cache import DiskLRU, DocumentCache, cache_key
+from extraction import (
+    ExtractedEntities, extract_entities_batch, extract_entities_chunks, extract_entities_from_text, extract_pdf_pages,
+    join_pages, merge_chunk_fields, pipeline_version, process_document, warm_up
+)
+from job_queue import JOB_PRIORITIES, JobDeferred, JobFailed, JobQueue, JobQueueFull, open_job_queue
+from process_pool import JobTimeout, PoolSaturated, ProcessPool, QueueTimeout, WorkerCrashed
+from uploads import InvalidUpload, Upload, UploadTooLarge, read_uploads
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -39,31 +43,96 @@ app.add_middleware(
 # Security
 security = HTTPBearer()
 
-# Load spaCy models
-try:
-    nlp_en = spacy.load("en_core_web_sm")
-    logger.info("English NLP model loaded")
-except OSError:
-    logger.warning("English NLP model not found, using blank model")
-    nlp_en = spacy.blank("en")
+# OCR, PDF and spaCy work runs in worker processes (see process_pool.py),
+# so one large scan never blocks the event loop
+NLP_WORKERS = int(os.getenv("NLP_WORKERS", str(os.cpu_count() or 1)))
+NLP_MAX_QUEUE = int(os.getenv("NLP_MAX_QUEUE", str(NLP_WORKERS * 4)))  # Waiting jobs before 429
+NLP_QUEUE_TIMEOUT = float(os.getenv("NLP_QUEUE_TIMEOUT", "30"))  # Seconds waiting for a worker before 503
+EXTRACTION_JOB_TIMEOUT = float(os.getenv("EXTRACTION_JOB_TIMEOUT", "120"))  # Seconds before the worker is killed
+extraction_pool = ProcessPool(
+    NLP_WORKERS, max_queue=NLP_MAX_QUEUE, queue_timeout=NLP_QUEUE_TIMEOUT, initializer=warm_up
+)
+# PDFs are split into page ranges of this size, extracted in parallel workers
+PDF_PAGES_PER_JOB = int(os.getenv("PDF_PAGES_PER_JOB", "8"))
+# /extract/stream sends consecutive pages of about this much text to each NER job
+NER_CHARS_PER_JOB = int(os.getenv("NER_CHARS_PER_JOB", "50000"))
 
-# Pydantic models
-class ExtractedEntities(BaseModel):
-    name: Optional[str] = None
-    address: Optional[str] = None
-    asset_type: Optional[str] = None
-    certificate_id: Optional[str] = None
-    date: Optional[str] = None
-    amount: Optional[str] = None
-    location: Optional[str] = None
-    confidence: float
+# Uploads stay in memory up to the spool size and are rejected mid-stream past the maximum
+NLP_MAX_UPLOAD_MB = int(os.getenv("NLP_MAX_UPLOAD_MB", "50"))
+NLP_UPLOAD_SPOOL_MB = int(os.getenv("NLP_UPLOAD_SPOOL_MB", "8"))
+NLP_BATCH_MAX_FILES = int(os.getenv("NLP_BATCH_MAX_FILES", "20"))
+
+ALLOWED_CONTENT_TYPES = [
+    "application/pdf",
+    "image/jpeg",
+    "image/png",
+    "image/tiff",
+    "image/bmp"
+]
+
+# Extraction results keyed on the upload's SHA-256 and the pipeline version
+EXTRACTION_PIPELINE_VERSION = pipeline_version()
+NLP_CACHE_DIR = os.getenv("NLP_CACHE_DIR", "/app/cache/extraction")  # Empty disables the disk tier
+NLP_CACHE_MAX_MB = int(os.getenv("NLP_CACHE_MAX_MB", "1024"))
+NLP_CACHE_REDIS_URL = os.getenv("NLP_CACHE_REDIS_URL")  # Optional tier shared by all replicas
+NLP_CACHE_REDIS_TTL = int(os.getenv("NLP_CACHE_REDIS_TTL", str(7 * 86400)))
+cache_redis_client = None
+if NLP_CACHE_REDIS_URL:
+    import redis.asyncio as aioredis
+    cache_redis_client = aioredis.from_url(NLP_CACHE_REDIS_URL)
+document_cache = DocumentCache(
+    DiskLRU(NLP_CACHE_DIR, NLP_CACHE_MAX_MB * 2 ** 20) if NLP_CACHE_DIR else None,
+    redis_client=cache_redis_client,
+    ttl=NLP_CACHE_REDIS_TTL
+)
+
+# Asynchronous jobs (POST /jobs): Redis-backed when reachable, in-process otherwise
+NLP_JOBS_REDIS_URL = os.getenv("NLP_JOBS_REDIS_URL", NLP_CACHE_REDIS_URL or "")
+NLP_JOB_CONCURRENCY = int(os.getenv("NLP_JOB_CONCURRENCY", str(NLP_WORKERS)))  # Jobs run at once per process
+NLP_JOB_MAX_QUEUED = int(os.getenv("NLP_JOB_MAX_QUEUED", "1000"))  # Queued jobs before 429
+NLP_JOB_MAX_PAYLOAD_MB = int(os.getenv("NLP_JOB_MAX_PAYLOAD_MB", "1024"))  # Stored uploads of queued jobs before 429
+NLP_JOB_TTL = int(os.getenv("NLP_JOB_TTL", "86400"))  # Seconds a job and its result are kept
+NLP_JOB_LEASE = float(os.getenv("NLP_JOB_LEASE", "900"))  # Seconds before a dead process's job is requeued
+JOB_MODES = ["extract", "extract-text"]
+jobs_redis_client = None
+if NLP_JOBS_REDIS_URL:
+    import redis.asyncio as aioredis
+    jobs_redis_client = aioredis.from_url(NLP_JOBS_REDIS_URL)
+job_queue: Optional[JobQueue] = None
 
+# Pydantic models
 class ExtractionResponse(BaseModel):
     entities: ExtractedEntities
     raw_text: str
     processing_time: float
     timestamp: datetime
 
+class BatchDocumentResult(BaseModel):
+    filename: str
+    status_code: int
+    entities: Optional[ExtractedEntities] = None
+    raw_text: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchExtractionResponse(BaseModel):
+    results: List[BatchDocumentResult]
+    processing_time: float
+    throughput: float
+    timestamp: datetime
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    mode: str
+    priority: str
+    filename: str
+    submitted_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    attempts: int
+    result: Optional[Dict] = None
+    error: Optional[Dict] = None
+
 class HealthResponse(BaseModel):
     status: str
     timestamp: datetime
@@ -77,140 +146,285 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
     return credentials.credentials
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from PDF file"""
+@contextmanager
+def pool_errors():
+    """Map extraction pool limits to HTTP errors"""
     try:
-        text = ""
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text
-    except Exception as e:
-        logger.error(f"Error extracting text from PDF: {e}")
-        return ""
+        yield
+    except PoolSaturated:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many documents in progress, retry later",
+            headers={"Retry-After": "5"}
+        )
+    except QueueTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No extraction worker available, retry later",
+            headers={"Retry-After": "10"}
+        )
+    except JobTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Document processing exceeded {EXTRACTION_JOB_TIMEOUT:g}s"
+        )
+    except WorkerCrashed:
+        # The worker is replaced, but the same document may well crash it again
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Extraction worker crashed while processing the document"
+        )
+
+async def extract_pdf_text(source: Union[bytes, str], admit: bool = True) -> List[Tuple[int, str]]:
+    """
+    (page number, text) for every page of a PDF, in page order. The first job
+    reads the first range and counts the pages; the other ranges then run in
+    parallel, each worker opening the document on its own.
+    """
+    first = await extraction_pool.run(
+        extract_pdf_pages, source, 1, PDF_PAGES_PER_JOB, count_pages=True, timeout=EXTRACTION_JOB_TIMEOUT,
+        admit=admit
+    )
+    page_count = first["page_count"]
+    ranges = [
+        (source, start, min(start + PDF_PAGES_PER_JOB - 1, page_count))
+        for start in range(PDF_PAGES_PER_JOB + 1, page_count + 1, PDF_PAGES_PER_JOB)
+    ]
+    chunks = [first["pages"]] + [None] * len(ranges)
+    async for index, result in extraction_pool.map_unordered(
+        extract_pdf_pages, ranges, timeout=EXTRACTION_JOB_TIMEOUT
+    ):
+        chunks[index + 1] = result["pages"]
+    return [page for chunk in chunks for page in chunk]
+
+async def extract_in_pool(source: Union[bytes, str], content_type: str, with_entities: bool, admit: bool) -> Dict:
+    """Text, pages and, optionally, entities of a document, extracted in the pool"""
+    if content_type != "application/pdf":
+        return await extraction_pool.run(
+            process_document, source, content_type, with_entities, timeout=EXTRACTION_JOB_TIMEOUT, admit=admit
+        )
 
-def extract_text_from_image(file_path: str) -> str:
-    """Extract text from image using OCR"""
+    pages = await extract_pdf_text(source, admit)
+    text = join_pages(pages)
+    entities = None
+    if with_entities and text.strip():
+        entities = (await extraction_pool.run(
+            extract_entities_from_text, text, timeout=EXTRACTION_JOB_TIMEOUT, admit=False
+        )).model_dump()
+    return {"text": text, "pages": pages, "entities": entities}
+
+def page_groups(pages: List[Tuple[int, str]], max_chars: int) -> List[List[Tuple[int, str]]]:
+    """Consecutive runs of non-empty pages with up to max_chars of text each (a longer page is a run of its own)"""
+    groups: List[List[Tuple[int, str]]] = []
+    group_chars = max_chars
+    for number, text in pages:
+        if not text:
+            continue
+        if group_chars + len(text) > max_chars:
+            groups.append([])
+            group_chars = 0
+        groups[-1].append((number, text))
+        group_chars += len(text)
+    return groups
+
+def ndjson_line(event: Dict) -> bytes:
+    return json.dumps(event, separators=(",", ":")).encode() + b"\n"
+
+async def stream_chunk_entities(filename: str, pages: List[Tuple[int, str]], start_time: datetime) -> AsyncIterator[bytes]:
+    """
+    NDJSON events of /extract/stream. Chunk events come in the order jobs
+    finish; the summary merges their fields in document order.
+    """
+    # Offsets of each page's text in the document text (see join_pages)
+    page_offsets = {}
+    offset = 0
+    for number, text in pages:
+        if text:
+            page_offsets[number] = offset
+            offset += len(text) + 1
+    groups = page_groups(pages, NER_CHARS_PER_JOB)
+    yield ndjson_line({"type": "document", "filename": filename, "pages": len(pages), "characters": offset})
+
+    chunk_fields: Dict[Tuple[int, int], Dict] = {}
     try:
-        # Load image
-        image = cv2.imread(file_path)
-        
-        # Preprocess image for better OCR
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply denoising
-        denoised = cv2.fastNlMeansDenoising(gray)
-        
-        # Apply threshold to get binary image
-        _, thresh = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Extract text using Tesseract
-        text = pytesseract.image_to_string(thresh, config='--psm 6')
-        
-        return text
+        # Pool errors carry the status /extract would have returned, so clients can tell retry-later apart
+        with pool_errors():
+            async for _, chunks in extraction_pool.map_unordered(
+                extract_entities_chunks, [(group,) for group in groups], timeout=EXTRACTION_JOB_TIMEOUT
+            ):
+                for chunk in chunks:
+                    chunk_fields[(chunk["page"], chunk["chunk"])] = chunk["fields"]
+                    yield ndjson_line({"type": "chunk", "offset": page_offsets[chunk["page"]] + chunk["start"], **chunk})
+    except HTTPException as e:
+        yield ndjson_line({"type": "error", "status_code": e.status_code, "detail": e.detail})
+        return
     except Exception as e:
-        logger.error(f"Error extracting text from image: {e}")
-        return ""
+        logger.error(f"Error streaming entities of {filename}: {e}")
+        yield ndjson_line({
+            "type": "error",
+            "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            "detail": "Failed to extract entities"
+        })
+        return
 
-def extract_entities_from_text(text: str) -> ExtractedEntities:
-    """Extract entities from text using NLP and regex patterns"""
-    try:
-        # Process with spaCy
-        doc = nlp_en(text)
-        
-        # Initialize extracted data
-        entities = {
-            "name": None,
-            "address": None,
-            "asset_type": None,
-            "certificate_id": None,
-            "date": None,
-            "amount": None,
-            "location": None,
-            "confidence": 0.0
+    entities = merge_chunk_fields([chunk_fields[key] for key in sorted(chunk_fields)])
+    yield ndjson_line({
+        "type": "summary",
+        "entities": entities.model_dump(),
+        "chunks": len(chunk_fields),
+        "processing_time": (datetime.now() - start_time).total_seconds()
+    })
+
+# The upload is read by receive_upload rather than a File() parameter; describe it for the docs
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}}
+                }
+            }
         }
-        
-        # Extract named entities
-        names = []
-        locations = []
-        dates = []
-        
-        for ent in doc.ents:
-            if ent.label_ == "PERSON":
-                names.append(ent.text)
-            elif ent.label_ in ["GPE", "LOC"]:
-                locations.append(ent.text)
-            elif ent.label_ == "DATE":
-                dates.append(ent.text)
-        
-        # Use regex patterns for specific extractions
-        
-        # Certificate/ID patterns
-        cert_patterns = [
-            r'(?:certificate|cert|id|number|no\.?)\s*:?\s*([A-Z0-9\-]+)',
-            r'([A-Z]{2,}\d{4,})',
-            r'(\d{4,}[A-Z]{2,})'
-        ]
-        
-        for pattern in cert_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match and not entities["certificate_id"]:
-                entities["certificate_id"] = match.group(1)
-                break
-        
-        # Amount patterns (currency)
-        amount_patterns = [
-            r'(?:USD|EUR|GBP|\$|€|£)\s*([0-9,]+(?:\.[0-9]{2})?)',
-            r'([0-9,]+(?:\.[0-9]{2})?)\s*(?:USD|EUR|GBP|dollars?|euros?|pounds?)'
-        ]
-        
-        for pattern in amount_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match and not entities["amount"]:
-                entities["amount"] = match.group(1)
-                break
-        
-        # Asset type patterns
-        asset_types = [
-            "real estate", "property", "land", "building", "house", "apartment",
-            "art", "painting", "sculpture", "artwork", "collectible",
-            "gold", "silver", "commodity", "oil", "gas",
-            "watch", "jewelry", "luxury", "vintage"
-        ]
-        
-        text_lower = text.lower()
-        for asset_type in asset_types:
-            if asset_type in text_lower and not entities["asset_type"]:
-                entities["asset_type"] = asset_type
-                break
-        
-        # Address pattern (simple)
-        address_pattern = r'(\d+\s+[A-Za-z\s]+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Drive|Dr|Lane|Ln)[^,\n]*(?:,\s*[A-Za-z\s]+)*)'
-        address_match = re.search(address_pattern, text, re.IGNORECASE)
-        if address_match:
-            entities["address"] = address_match.group(1).strip()
-        
-        # Assign extracted entities
-        if names and not entities["name"]:
-            entities["name"] = names[0]
-        
-        if locations and not entities["location"]:
-            entities["location"] = locations[0]
-        
-        if dates and not entities["date"]:
-            entities["date"] = dates[0]
-        
-        # Calculate confidence based on number of extracted entities
-        extracted_count = sum(1 for v in entities.values() if v is not None and v != "")
-        entities["confidence"] = min(extracted_count / 6.0, 1.0)  # 6 main fields
-        
-        return ExtractedEntities(**entities)
-        
-    except Exception as e:
-        logger.error(f"Error extracting entities: {e}")
-        return ExtractedEntities(confidence=0.0)
+    }
+}
+
+BATCH_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["files"],
+                    "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}}
+                }
+            }
+        }
+    }
+}
+
+async def read_request_uploads(request: Request, max_files: int) -> List[Upload]:
+    try:
+        uploads = await read_uploads(
+            request,
+            max_file_bytes=NLP_MAX_UPLOAD_MB * 2 ** 20,
+            spool_bytes=NLP_UPLOAD_SPOOL_MB * 2 ** 20,
+            max_files=max_files
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except InvalidUpload as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not uploads:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No file uploaded")
+    return uploads
+
+async def receive_upload(request: Request):
+    """The request's uploaded file, streamed into memory; removed after the response"""
+    uploads = await read_request_uploads(request, max_files=1)
+    try:
+        yield uploads[0]
+    finally:
+        uploads[0].close()
+
+async def receive_uploads(request: Request):
+    """Up to NLP_BATCH_MAX_FILES uploaded files; removed after the response"""
+    uploads = await read_request_uploads(request, max_files=NLP_BATCH_MAX_FILES)
+    try:
+        yield uploads
+    finally:
+        for upload in uploads:
+            upload.close()
+
+def upload_cache_key(upload: Upload) -> str:
+    return cache_key(upload.sha256, upload.content_type, EXTRACTION_PIPELINE_VERSION)
+
+async def run_extraction(upload: Upload, with_entities: bool, admit: bool = True) -> Dict:
+    """
+    Extraction result from the cache or the pool, mapping pool limits to HTTP
+    errors. Documents with no text are not cached.
+    """
+    key = upload_cache_key(upload)
+    result = await document_cache.get(key)
+    if result is not None and (result["entities"] is not None or not with_entities):
+        return result
+
+    started = time.perf_counter()
+    with pool_errors():
+        if result is None:
+            result = await extract_in_pool(upload.source, upload.content_type, with_entities, admit)
+        else:
+            # Cached by /extract-text, which skips entities
+            result["entities"] = (await extraction_pool.run(
+                extract_entities_from_text, result["text"], timeout=EXTRACTION_JOB_TIMEOUT, admit=admit
+            )).model_dump()
+
+    if result["text"].strip():
+        await document_cache.set(key, result, time.perf_counter() - started)
+    return result
+
+async def process_job(job: Dict, upload: Upload) -> Dict:
+    """Job handler: the body /extract or /extract-text would have returned"""
+    with_entities = job["mode"] == "extract"
+    try:
+        # Waits for a worker like a follow-up job; jobs are bounded by NLP_JOB_CONCURRENCY instead
+        result = await run_extraction(upload, with_entities=with_entities, admit=False)
+    except HTTPException as e:
+        if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+            # No worker free in time: the pool is busy, not the document bad; queue it again later
+            raise JobDeferred(e.detail)
+        raise JobFailed(e.status_code, e.detail)
+    if not result["text"].strip():
+        raise JobFailed(status.HTTP_422_UNPROCESSABLE_ENTITY, "No text could be extracted from the document")
+    if with_entities:
+        return {"entities": result["entities"], "raw_text": result["text"][:1000]}
+    return {
+        "text": result["text"],
+        "pages": [{"page": number, "text": text} for number, text in result["pages"]]
+    }
+
+def job_response(job: Dict) -> JobResponse:
+    def timestamp(value: Optional[float]) -> Optional[datetime]:
+        return datetime.fromtimestamp(value) if value is not None else None
+
+    return JobResponse(
+        job_id=job["id"],
+        status=job["status"],
+        mode=job["mode"],
+        priority=job["priority"],
+        filename=job["filename"],
+        submitted_at=timestamp(job["submitted_at"]),
+        started_at=timestamp(job["started_at"]),
+        finished_at=timestamp(job["finished_at"]),
+        attempts=job["attempts"],
+        result=job["result"],
+        error=job["error"]
+    )
+
+@app.on_event("startup")
+async def start_extraction_pool():
+    global job_queue
+    document_cache.start()
+    extraction_pool.start()
+    job_queue = await open_job_queue(
+        jobs_redis_client, process_job, NLP_JOB_CONCURRENCY,
+        max_queued=NLP_JOB_MAX_QUEUED, max_payload_bytes=NLP_JOB_MAX_PAYLOAD_MB * 2 ** 20,
+        ttl=NLP_JOB_TTL, lease=NLP_JOB_LEASE
+    )
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_extraction_pool():
+    if job_queue is not None:
+        await job_queue.stop()
+    await extraction_pool.stop()
+    if cache_redis_client is not None:
+        await cache_redis_client.aclose()
+    if jobs_redis_client is not None:
+        await jobs_redis_client.aclose()
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
@@ -220,10 +434,10 @@ async def health_check():
         timestamp=datetime.now()
     )
 
-@app.post("/extract", response_model=ExtractionResponse)
+@app.post("/extract", response_model=ExtractionResponse, openapi_extra=UPLOAD_REQUEST_BODY)
 async def extract_document(
-    file: UploadFile = File(...),
-    token: str = Depends(verify_token)
+    token: str = Depends(verify_token),
+    upload: Upload = Depends(receive_upload)
 ):
     """
     Extract entities from uploaded document (PDF or image)
@@ -231,58 +445,37 @@ async def extract_document(
     start_time = datetime.now()
     
     try:
-        logger.info(f"Processing document: {file.filename}")
+        logger.info(f"Processing document: {upload.filename}")
         
         # Validate file type
-        allowed_types = [
-            "application/pdf",
-            "image/jpeg",
-            "image/png",
-            "image/tiff",
-            "image/bmp"
-        ]
-        
-        if file.content_type not in allowed_types:
+        if upload.content_type not in ALLOWED_CONTENT_TYPES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Unsupported file type: {file.content_type}"
+                detail=f"Unsupported file type: {upload.content_type}"
             )
         
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_file_path = tmp_file.name
+        # Extract text and entities in a worker process
+        result = await run_extraction(upload, with_entities=True)
+        raw_text = result["text"]
         
-        try:
-            # Extract text based on file type
-            if file.content_type == "application/pdf":
-                raw_text = extract_text_from_pdf(tmp_file_path)
-            else:
-                raw_text = extract_text_from_image(tmp_file_path)
-            
-            if not raw_text.strip():
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="No text could be extracted from the document"
-                )
-            
-            # Extract entities
-            entities = extract_entities_from_text(raw_text)
-            
-            processing_time = (datetime.now() - start_time).total_seconds()
-            
-            logger.info(f"Document processed successfully in {processing_time:.2f}s")
-            
-            return ExtractionResponse(
-                entities=entities,
-                raw_text=raw_text[:1000],  # Limit raw text length
-                processing_time=processing_time,
-                timestamp=datetime.now()
+        if not raw_text.strip():
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="No text could be extracted from the document"
             )
-            
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
+        
+        entities = ExtractedEntities(**result["entities"])
+        
+        processing_time = (datetime.now() - start_time).total_seconds()
+        
+        logger.info(f"Document processed successfully in {processing_time:.2f}s")
+        
+        return ExtractionResponse(
+            entities=entities,
+            raw_text=raw_text[:1000],  # Limit raw text length
+            processing_time=processing_time,
+            timestamp=datetime.now()
+        )
             
     except HTTPException:
         raise
@@ -293,32 +486,25 @@ async def extract_document(
             detail="Failed to process document"
         )
 
-@app.post("/extract-text")
+@app.post("/extract-text", openapi_extra=UPLOAD_REQUEST_BODY)
 async def extract_text_only(
-    file: UploadFile = File(...),
-    token: str = Depends(verify_token)
+    token: str = Depends(verify_token),
+    upload: Upload = Depends(receive_upload)
 ):
     """
     Extract raw text from document without entity extraction
     """
     try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_file_path = tmp_file.name
+        result = await run_extraction(upload, with_entities=False)
         
-        try:
-            # Extract text based on file type
-            if file.content_type == "application/pdf":
-                raw_text = extract_text_from_pdf(tmp_file_path)
-            else:
-                raw_text = extract_text_from_image(tmp_file_path)
-            
-            return {"text": raw_text, "timestamp": datetime.now()}
-            
-        finally:
-            os.unlink(tmp_file_path)
+        return {
+            "text": result["text"],
+            "pages": [{"page": number, "text": text} for number, text in result["pages"]],
+            "timestamp": datetime.now()
+        }
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error extracting text: {e}")
         raise HTTPException(
@@ -326,6 +512,190 @@ async def extract_text_only(
             detail="Failed to extract text"
         )
 
+@app.post("/extract/stream", openapi_extra=UPLOAD_REQUEST_BODY)
+async def extract_stream(
+    token: str = Depends(verify_token),
+    upload: Upload = Depends(receive_upload)
+):
+    """
+    Extract entities from a long document chunk by chunk, as NDJSON: a
+    "document" event, a "chunk" event with the fields and entities of each
+    sentence-aligned chunk as soon as it is processed, then a "summary" event
+    with the merged entities (or an "error" event).
+    """
+    start_time = datetime.now()
+    if upload.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported file type: {upload.content_type}"
+        )
+
+    # Text extraction errors still get a status code; the stream starts after it
+    try:
+        result = await run_extraction(upload, with_entities=False)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing document: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to process document"
+        )
+    if not result["text"].strip():
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="No text could be extracted from the document"
+        )
+
+    return StreamingResponse(
+        stream_chunk_entities(upload.filename, result["pages"], start_time),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/extract/batch", response_model=BatchExtractionResponse, openapi_extra=BATCH_REQUEST_BODY)
+async def extract_batch(
+    token: str = Depends(verify_token),
+    uploads: List[Upload] = Depends(receive_uploads)
+):
+    """
+    Extract entities from several documents (PDF or image) in one request.
+    Text is extracted concurrently and entities go through spaCy in batches;
+    a document that fails gets its own status code and error.
+    """
+    start_time = datetime.now()
+    # The batch is admitted once; its jobs then never get 429 half-way
+    with pool_errors():
+        extraction_pool.admit()
+
+    results: List[Optional[BatchDocumentResult]] = [None] * len(uploads)
+    extracted: Dict[int, Dict] = {}
+    concurrency = asyncio.Semaphore(NLP_WORKERS)
+
+    def failed(index: int, status_code: int, error: str):
+        results[index] = BatchDocumentResult(filename=uploads[index].filename, status_code=status_code, error=error)
+
+    async def extract_text(index: int, upload: Upload):
+        if upload.content_type not in ALLOWED_CONTENT_TYPES:
+            failed(index, status.HTTP_400_BAD_REQUEST, f"Unsupported file type: {upload.content_type}")
+            return
+        try:
+            async with concurrency:
+                result = await run_extraction(upload, with_entities=False, admit=False)
+        except HTTPException as e:
+            failed(index, e.status_code, e.detail)
+            return
+        except Exception as e:
+            logger.error(f"Error processing document {upload.filename}: {e}")
+            failed(index, status.HTTP_500_INTERNAL_SERVER_ERROR, "Failed to process document")
+            return
+        if not result["text"].strip():
+            failed(index, status.HTTP_422_UNPROCESSABLE_ENTITY, "No text could be extracted from the document")
+            return
+        extracted[index] = result
+
+    await asyncio.gather(*(extract_text(index, upload) for index, upload in enumerate(uploads)))
+
+    # Entities not already cached, one nlp.pipe batch per worker
+    pending = [index for index in sorted(extracted) if extracted[index]["entities"] is None]
+    if pending:
+        group_size = -(-len(pending) // NLP_WORKERS)
+        groups = [pending[i:i + group_size] for i in range(0, len(pending), group_size)]
+        started = time.perf_counter()
+
+        async def extract_group(indices: List[int]):
+            # A failed group fails only its own documents
+            try:
+                with pool_errors():
+                    entities = await extraction_pool.run(
+                        extract_entities_batch, [extracted[index]["text"] for index in indices],
+                        timeout=EXTRACTION_JOB_TIMEOUT, admit=False
+                    )
+            except HTTPException as e:
+                status_code, error = e.status_code, e.detail
+            except Exception as e:
+                logger.error(f"Error extracting entities of a batch group: {e}")
+                status_code, error = status.HTTP_500_INTERNAL_SERVER_ERROR, "Failed to process document"
+            else:
+                for index, document_entities in zip(indices, entities):
+                    extracted[index]["entities"] = document_entities
+                return
+            for index in indices:
+                failed(index, status_code, error)
+                del extracted[index]
+
+        await asyncio.gather(*(extract_group(indices) for indices in groups))
+        compute_seconds = (time.perf_counter() - started) / len(pending)
+        for index in pending:
+            if index in extracted:
+                await document_cache.set(upload_cache_key(uploads[index]), extracted[index], compute_seconds)
+
+    for index, result in extracted.items():
+        results[index] = BatchDocumentResult(
+            filename=uploads[index].filename,
+            status_code=status.HTTP_200_OK,
+            entities=ExtractedEntities(**result["entities"]),
+            raw_text=result["text"][:1000]  # Limit raw text length
+        )
+
+    processing_time = (datetime.now() - start_time).total_seconds()
+    logger.info(f"Batch of {len(uploads)} documents processed in {processing_time:.2f}s")
+    return BatchExtractionResponse(
+        results=results,
+        processing_time=processing_time,
+        throughput=len(uploads) / processing_time if processing_time > 0 else 0.0,
+        timestamp=datetime.now()
+    )
+
+@app.post("/jobs", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED, openapi_extra=UPLOAD_REQUEST_BODY)
+async def submit_job(
+    mode: str = Query("extract", description="extract (entities) or extract-text"),
+    priority: str = Query("normal", description="high (e.g. KYC), normal or low (e.g. bulk re-verification)"),
+    token: str = Depends(verify_token),
+    upload: Upload = Depends(receive_upload)
+):
+    """
+    Queue a document for extraction and return its job id at once; poll
+    GET /jobs/{job_id} for the result
+    """
+    if mode not in JOB_MODES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown mode: {mode}")
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown priority: {priority}")
+    if upload.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported file type: {upload.content_type}"
+        )
+    try:
+        job = await job_queue.submit(upload, mode, priority)
+    except JobQueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many jobs queued, retry later",
+            headers={"Retry-After": "30"}
+        )
+    logger.info(f"Queued job {job['id']} for {upload.filename} ({mode}, {priority})")
+    return job_response(job)
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, token: str = Depends(verify_token)):
+    """Status of a job and, once it has finished, its result or error"""
+    job = await job_queue.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found or expired")
+    return job_response(job)
+
+@app.get("/metrics")
+async def get_metrics(token: str = Depends(verify_token)):
+    """Extraction pool counters for this worker"""
+    return {
+        "extraction_pool": extraction_pool.stats(),
+        "extraction_cache": document_cache.stats(),
+        "jobs": await job_queue.stats() if job_queue is not None else None,
+        "pipeline_version": EXTRACTION_PIPELINE_VERSION,
+        "timestamp": datetime.now()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""
+OCR backends for the extraction workers.
+
+pytesseract runs the tesseract binary once per image. Each call forks,
+round-trips the image through temporary files and loads the language data
+from scratch, which dominates the latency of small ID-card scans. When
+tesserocr (the C API binding) is installed, each worker process instead
+keeps one Tesseract engine open for its lifetime and hands it NumPy arrays
+directly. pytesseract remains the fallback, and OCR_BACKEND=pytesseract
+forces it.
+
+Both backends use the same language and page segmentation mode (--psm 6: a
+single uniform block of text).
+"""
+from typing import Optional
+import logging
+import os
+
+import numpy as np
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logger = logging.getLogger(__name__)
+
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")  # "auto" (tesserocr when installed) or "pytesseract"
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+OCR_PSM = 6
+
+_engine = None  # TesseractEngine once started, False when unavailable
+
+
+class TesseractEngine:
+    """One Tesseract instance, initialized once and reused for every image"""
+
+    def __init__(self, language: str = OCR_LANGUAGE, psm: int = OCR_PSM):
+        self.api = tesserocr.PyTessBaseAPI(lang=language, psm=psm)
+
+    def image_to_string(self, image: np.ndarray) -> str:
+        """Text of an 8-bit grayscale, BGR or BGRA image"""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        if channels >= 3:
+            # Tesseract expects RGB(A) byte order; OpenCV arrays are BGR(A)
+            image = np.ascontiguousarray(image[:, :, [2, 1, 0] + list(range(3, channels))])
+        try:
+            self.api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+            return self.api.GetUTF8Text()
+        finally:
+            self.api.Clear()
+
+    def close(self):
+        self.api.End()
+
+
+def get_engine() -> Optional[TesseractEngine]:
+    """This process's Tesseract engine, started on first use; None when falling back to pytesseract"""
+    global _engine
+    if _engine is None:
+        _engine = False
+        if OCR_BACKEND == "pytesseract":
+            pass
+        elif tesserocr is None:
+            logger.info("tesserocr not installed, using pytesseract")
+        else:
+            try:
+                _engine = TesseractEngine()
+                logger.info(f"Tesseract engine started ({OCR_LANGUAGE}, psm {OCR_PSM})")
+            except RuntimeError as e:
+                logger.warning(f"Tesseract engine unavailable, using pytesseract: {e}")
+    return _engine or None
+
+
+def image_to_string(image: np.ndarray) -> str:
+    """OCR text of an image array, through the warm engine when available"""
+    engine = get_engine()
+    if engine is not None:
+        return engine.image_to_string(image)
+    return pytesseract.image_to_string(image, lang=OCR_LANGUAGE, config=f"--psm {OCR_PSM}")
+
+
+def set_backend(backend: str):
+    """Switch this process to "auto" or "pytesseract", dropping any running engine"""
+    global OCR_BACKEND, _engine
+    if _engine:
+        _engine.close()
+    OCR_BACKEND = backend
+    _engine = None
+
+
+def backend_version() -> str:
+    """OCR backend and tesseract version, without starting an engine"""
+    if OCR_BACKEND != "pytesseract" and tesserocr is not None:
+        return f"tesserocr-{tesserocr.tesseract_version().split()[1]}-{OCR_LANGUAGE}"
+    try:
+        return f"tesseract-{pytesseract.get_tesseract_version()}-{OCR_LANGUAGE}"
+    except Exception:
+        return "tesseract-none"
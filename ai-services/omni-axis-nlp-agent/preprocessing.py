@@ -0,0 +1,155 @@
+"""
+Adaptive image preprocessing for OCR.
+
+Denoising every image at full resolution with non-local means takes seconds
+on a 12-megapixel phone photo and used to dominate OCR time. preprocess()
+instead sizes each step to the image:
+
+    measure    binarize a reduced copy with a local threshold and take the
+               median height and bounding box of the character-sized blobs
+    downscale  shrink so that text is about TARGET_TEXT_HEIGHT pixels tall,
+               the size Tesseract reads best; images are never enlarged
+    crop       keep the text region plus a margin, so the background around
+               the document costs no denoising and does not skew Otsu
+    denoise    estimate the noise level and skip denoising on clean images,
+               median-filter mildly noisy ones and keep non-local means for
+               noisy ones
+    threshold  Otsu, as before
+
+Each step is timed. preprocess(image, downscale=False, denoise="nlmeans",
+crop=False) is the original full-resolution pipeline.
+"""
+from typing import Dict, Optional, Tuple
+import time
+
+import cv2
+import numpy as np
+
+ANALYSIS_LONG_SIDE = 1600  # Text is measured on a copy no larger than this
+TARGET_TEXT_HEIGHT = 32  # Median character blob height to downscale to, in pixels
+MIN_TEXT_BLOBS = 8  # With fewer character-sized blobs, text is not measured
+CROP_MARGIN = 2.0  # Margin around the text region, in text heights
+CLEAN_NOISE_SIGMA = 2.0  # Below this, no denoising
+NOISY_SIGMA = 6.0  # From this, non-local means; in between, a 3x3 median filter
+
+# Immerkaer's noise estimation kernel; on pure Gaussian noise of std sigma the
+# response has std 6 * sigma
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+class Preprocessed:
+    """A binarized image ready for OCR, the decisions that produced it and the milliseconds per step"""
+
+    def __init__(self):
+        self.image: Optional[np.ndarray] = None
+        self.text_height: Optional[float] = None  # Median blob height at full resolution
+        self.scale = 1.0
+        self.crop: Optional[Tuple[int, int, int, int]] = None  # x, y, width, height after scaling
+        self.noise_sigma: Optional[float] = None
+        self.denoise = "none"
+        self.timings: Dict[str, float] = {}
+
+    def describe(self) -> str:
+        steps = " ".join(f"{step}={ms:.0f}ms" for step, ms in self.timings.items())
+        noise = f"noise {self.noise_sigma:.1f} " if self.noise_sigma is not None else ""
+        return f"scale {self.scale:.2f}, crop {self.crop}, {noise}denoise {self.denoise}, {steps}"
+
+
+class _Timer:
+    def __init__(self, timings: Dict[str, float]):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def lap(self, step: str):
+        now = time.perf_counter()
+        self.timings[step] = (now - self.last) * 1000
+        self.last = now
+
+
+def measure_text(gray: np.ndarray) -> Optional[Tuple[float, Tuple[int, int, int, int]]]:
+    """
+    Median character blob height and text bounding box (x, y, width, height)
+    of a grayscale image, in its own pixels; None when too little text shows.
+    """
+    height, width = gray.shape
+    factor = min(ANALYSIS_LONG_SIDE / max(height, width), 1.0)
+    small = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA) if factor < 1.0 else gray
+    small = cv2.medianBlur(small, 3)
+    # A local threshold finds dark strokes on paper under uneven light, where a
+    # global one would split paper from desk instead
+    binary = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    small_h, small_w = binary.shape
+    x, y, w, h, area = (stats[1:, i] for i in range(5))
+    blobs = (
+        (h >= 4) & (h <= small_h / 8) & (w <= small_w / 2) & (area >= 12)
+        # Blobs touching the border are document edges, shadows or desk, not text
+        & (x > 0) & (y > 0) & (x + w < small_w) & (y + h < small_h)
+    )
+    if np.count_nonzero(blobs) < MIN_TEXT_BLOBS:
+        return None
+    left, top = x[blobs].min(), y[blobs].min()
+    right, bottom = (x + w)[blobs].max(), (y + h)[blobs].max()
+    box = tuple(int(round(v / factor)) for v in (left, top, right - left, bottom - top))
+    return float(np.median(h[blobs])) / factor, box
+
+
+def estimate_noise(gray: np.ndarray) -> float:
+    """Standard deviation of the image's Gaussian noise (Immerkaer), robust to text edges"""
+    response = cv2.filter2D(gray.astype(np.float32), -1, _NOISE_KERNEL, borderType=cv2.BORDER_REFLECT)
+    # Median absolute response of N(0, (6 sigma)^2) is 0.6745 * 6 sigma; edges are few enough not to move it
+    return float(np.median(np.abs(response[1:-1:2, 1:-1:2]))) / (0.6745 * 6)
+
+
+def preprocess(image: np.ndarray, downscale: bool = True, denoise: str = "auto", crop: bool = True) -> Preprocessed:
+    """
+    Binarize a BGR or grayscale image for OCR. denoise is "auto" (by the
+    estimated noise level), "nlmeans", "median" or "none".
+    """
+    result = Preprocessed()
+    timer = _Timer(result.timings)
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    timer.lap("grayscale")
+
+    measured = measure_text(gray) if downscale or crop else None
+    if downscale or crop:
+        timer.lap("measure")
+
+    if measured is not None:
+        result.text_height, box = measured
+        if downscale and result.text_height > TARGET_TEXT_HEIGHT * 1.25:
+            result.scale = TARGET_TEXT_HEIGHT / result.text_height
+            gray = cv2.resize(gray, None, fx=result.scale, fy=result.scale, interpolation=cv2.INTER_AREA)
+            timer.lap("downscale")
+        if crop:
+            margin = CROP_MARGIN * result.text_height
+            height, width = gray.shape
+            left = max(int((box[0] - margin) * result.scale), 0)
+            top = max(int((box[1] - margin) * result.scale), 0)
+            right = min(int((box[0] + box[2] + margin) * result.scale) + 1, width)
+            bottom = min(int((box[1] + box[3] + margin) * result.scale) + 1, height)
+            if (right - left) * (bottom - top) < 0.9 * width * height:
+                gray = gray[top:bottom, left:right]
+                result.crop = (left, top, right - left, bottom - top)
+            timer.lap("crop")
+
+    if denoise == "auto":
+        result.noise_sigma = estimate_noise(gray)
+        timer.lap("noise_estimate")
+        if result.noise_sigma >= NOISY_SIGMA:
+            denoise = "nlmeans"
+        elif result.noise_sigma >= CLEAN_NOISE_SIGMA:
+            denoise = "median"
+        else:
+            denoise = "none"
+    result.denoise = denoise
+    if denoise == "nlmeans":
+        gray = cv2.fastNlMeansDenoising(gray)
+    elif denoise == "median":
+        gray = cv2.medianBlur(gray, 3)
+    timer.lap("denoise")
+
+    _, result.image = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    timer.lap("threshold")
+    return result
@@ -0,0 +1,298 @@
+"""
+Bounded process pool for CPU-bound extraction jobs.
+
+Each worker is a separate process that runs one job at a time, so OCR and
+spaCy never block the event loop and throughput scales with cores. Jobs
+wait for a free worker in an admission queue of bounded length: a full
+queue rejects new jobs at once (PoolSaturated), and a job that cannot get
+a worker within queue_timeout gives up (QueueTimeout). Follow-up jobs of a
+request that was already admitted (admit=False, map_unordered) are never
+rejected, so a large document is not abandoned half-way.
+
+A job that runs past its timeout has its worker killed and replaced. Each
+worker leads its own process group, and the kill goes to the whole group,
+so tesseract subprocesses die with it. concurrent.futures cannot do this:
+killing one of its workers breaks the whole executor.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    """The admission queue is full"""
+
+
+class QueueTimeout(Exception):
+    """No worker became free within the queue timeout"""
+
+
+class JobTimeout(Exception):
+    """A job ran past its timeout and its worker was killed"""
+
+
+class WorkerCrashed(Exception):
+    """A worker died while running a job"""
+
+
+def _worker_main(conn, initializer: Optional[Callable], initargs: tuple):
+    # Own process group, so a kill also reaches tesseract children
+    os.setsid()
+    # One OCR thread per worker; the pool provides the parallelism
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    logging.basicConfig(level=logging.INFO)
+    if initializer is not None:
+        initializer(*initargs)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        fn, args, kwargs = job
+        try:
+            reply = (True, fn(*args, **kwargs))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # Unpicklable result or exception
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class _Worker:
+    def __init__(self, context, initializer: Optional[Callable], initargs: tuple):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, initializer, initargs), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def call(self, fn: Callable, args: tuple, kwargs: Dict[str, Any], timeout: float):
+        """Run one job and return (ok, result or exception); blocks the calling thread"""
+        self.conn.send((fn, args, kwargs))
+        if not self.conn.poll(timeout):
+            raise JobTimeout(f"Job exceeded {timeout:g}s")
+        return self.conn.recv()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, EOFError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+
+
+class ProcessPool:
+    """Fixed set of worker processes with bounded admission and per-job timeouts"""
+
+    def __init__(
+        self,
+        workers: int,
+        max_queue: int,
+        queue_timeout: float = 30.0,
+        initializer: Optional[Callable] = None,
+        initargs: tuple = ()
+    ):
+        self.size = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.context = multiprocessing.get_context("spawn")
+        self._idle: Optional[asyncio.Queue] = None
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._workers: List[_Worker] = []
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.job_timeouts = 0
+        self.restarts = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self.context, self.initializer, self.initargs)
+
+    def start(self):
+        self._idle = asyncio.Queue()
+        # One thread per worker waits on that worker's pipe
+        self._threads = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="pool-io")
+        for _ in range(self.size):
+            worker = self._spawn()
+            self._workers.append(worker)
+            self._idle.put_nowait(worker)
+
+    async def stop(self):
+        if self._threads is None:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._threads, worker.close) for worker in self._workers))
+        self._threads.shutdown(wait=False)
+        self._threads = None
+        self._workers = []
+
+    def admit(self):
+        """
+        Admission check for a request that will run its jobs with admit=False;
+        raises PoolSaturated when the queue is full
+        """
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise PoolSaturated(f"{self.waiting} jobs already waiting")
+
+    async def run(self, fn: Callable, *args, timeout: float, admit: bool = True, **kwargs) -> Any:
+        """
+        Run fn(*args, **kwargs) in a worker process and return its result.
+        admit=False skips the admission limit, for follow-up jobs of a request
+        that was already admitted.
+        """
+        return await self._run(fn, args, kwargs, timeout, admit)
+
+    async def map_unordered(
+        self,
+        fn: Callable,
+        arg_tuples: Iterable[tuple],
+        timeout: float,
+        concurrency: Optional[int] = None
+    ) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Run fn(*args) for each args tuple, at most concurrency (default: pool size)
+        at a time, and yield (index, result) as the jobs finish. These jobs skip
+        the admission limit; call it after an admitted run() for the same request.
+        """
+        jobs = enumerate(arg_tuples)
+        pending = set()
+
+        async def job(index: int, args: tuple):
+            return index, await self._run(fn, args, {}, timeout, admit=False)
+
+        def submit(count: int):
+            for index, args in itertools.islice(jobs, count):
+                pending.add(asyncio.ensure_future(job(index, args)))
+
+        submit(concurrency or self.size)
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                submit(len(done))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _run(self, fn: Callable, args: tuple, kwargs: Dict[str, Any], timeout: float, admit: bool) -> Any:
+        if self._idle is None:
+            raise RuntimeError("Process pool is not started")
+        queued = time.perf_counter()
+        if self.waiting == 0 and not self._idle.empty():
+            worker = self._idle.get_nowait()
+        else:
+            worker = await self._wait_for_worker(admit)
+        self.wait_seconds += time.perf_counter() - queued
+
+        # Shielded: a cancelled caller must not hand back a worker that is still busy
+        job = asyncio.ensure_future(self._execute(worker, fn, args, kwargs, timeout))
+        return await asyncio.shield(job)
+
+    async def _wait_for_worker(self, admit: bool) -> _Worker:
+        if admit:
+            self.admit()
+
+        self.waiting += 1
+        # Not wait_for: on 3.11 it can drop a worker taken just as the timeout fires
+        getter = asyncio.ensure_future(self._idle.get())
+        try:
+            await asyncio.wait({getter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if getter.done() and not getter.cancelled():
+                # Cancelled after the worker was handed over: give it back
+                self._idle.put_nowait(getter.result())
+            raise
+        finally:
+            self.waiting -= 1
+            if not getter.done():
+                # A cancelled get leaves the worker in the queue
+                getter.cancel()
+        if not getter.done():
+            self.queue_timeouts += 1
+            raise QueueTimeout(f"No worker free within {self.queue_timeout:g}s")
+        return getter.result()
+
+    async def _execute(self, worker: _Worker, fn: Callable, args: tuple, kwargs: Dict[str, Any], timeout: float):
+        started = time.perf_counter()
+        self.running += 1
+        loop = asyncio.get_running_loop()
+        try:
+            ok, value = await loop.run_in_executor(self._threads, worker.call, fn, args, kwargs, timeout)
+        except (JobTimeout, EOFError, OSError) as e:
+            # The worker is stuck or gone: kill it and start a replacement
+            self.failed += 1
+            dead = worker
+            worker = await loop.run_in_executor(self._threads, self._replace, dead)
+            if isinstance(e, JobTimeout):
+                self.job_timeouts += 1
+                raise
+            raise WorkerCrashed(f"Worker exited with code {dead.process.exitcode}") from e
+        finally:
+            self.running -= 1
+            self.run_seconds += time.perf_counter() - started
+            self._idle.put_nowait(worker)
+
+        if not ok:
+            self.failed += 1
+            raise value
+        self.completed += 1
+        return value
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        worker.kill()
+        replacement = self._spawn()
+        self._workers[self._workers.index(worker)] = replacement
+        self.restarts += 1
+        logger.warning(f"Replaced worker {worker.process.pid} with {replacement.process.pid}")
+        return replacement
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.size,
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queue_timeouts": self.queue_timeouts,
+            "job_timeouts": self.job_timeouts,
+            "worker_restarts": self.restarts,
+            "average_wait_ms": self.wait_seconds / finished * 1000 if finished else 0.0,
+            "average_run_ms": self.run_seconds / finished * 1000 if finished else 0.0
+        }
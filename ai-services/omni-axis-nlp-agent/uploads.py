@@ -0,0 +1,207 @@
+"""
+Streaming multipart reader for document uploads.
+
+Starlette's form parser copies every file past 1 MB into an anonymous
+temporary file, and an endpoint can only check a file's size once the whole
+body has been written. This reader parses the request stream itself:
+
+- each file part is kept in memory as the chunks arrive, and is moved to a
+  named temporary file once it passes spool_bytes;
+- a file that passes max_file_bytes aborts the request as soon as the byte
+  that crosses the limit arrives;
+- the bytes are hashed on the way in, for the extraction cache.
+
+Extraction functions take either form of an Upload's source: the bytes, or
+the path of the spilled file.
+"""
+from typing import List, Optional, Union
+import hashlib
+import os
+import tempfile
+
+try:
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart before 0.0.13 installs the package as "multipart"
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+MAX_FIELD_BYTES = 64 * 1024  # Non-file form fields are read and discarded up to this size
+
+
+class UploadTooLarge(Exception):
+    """A file part passed the size limit"""
+
+
+class InvalidUpload(Exception):
+    """The request body is not a usable multipart/form-data upload"""
+
+
+class Upload:
+    """One uploaded file, in memory until it passes spool_bytes"""
+
+    def __init__(self, field_name: str, filename: str, content_type: Optional[str], spool_bytes: int):
+        self.field_name = field_name
+        self.filename = filename
+        self.content_type = content_type
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.sha256 = ""
+        self.path: Optional[str] = None
+        self.data: Optional[bytes] = None
+        self._chunks: List[memoryview] = []
+        self._file = None
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk: memoryview):
+        self.size += len(chunk)
+        self._hash.update(chunk)
+        if self._file is None and self.size > self.spool_bytes:
+            self._file = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(self.filename)[1])
+            self.path = self._file.name
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def finish(self):
+        self.sha256 = self._hash.hexdigest()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        else:
+            self.data = b"".join(self._chunks)
+            self._chunks = []
+
+    @classmethod
+    def from_bytes(cls, filename: str, content_type: Optional[str], data: bytes) -> "Upload":
+        """A finished in-memory upload of the given bytes, e.g. a stored job's document"""
+        upload = cls("file", filename, content_type, spool_bytes=len(data))
+        upload.write(memoryview(data))
+        upload.finish()
+        return upload
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """The file's bytes, or the path of its spilled copy"""
+        return self.path if self.path is not None else self.data
+
+    def read(self) -> bytes:
+        """The file's bytes, read back from disk if it was spilled"""
+        if self.path is None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def detach(self) -> "Upload":
+        """A copy that owns the file from now on; closing this one no longer removes it"""
+        owner = Upload(self.field_name, self.filename, self.content_type, self.spool_bytes)
+        owner.size, owner.sha256, owner.path, owner.data = self.size, self.sha256, self.path, self.data
+        self.path = None
+        self.data = None
+        return owner
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self.data = None
+        self._chunks = []
+
+
+async def read_uploads(request, max_file_bytes: int, spool_bytes: int, max_files: int = 1) -> List[Upload]:
+    """
+    File parts of a multipart/form-data request, in the order sent. Raises
+    UploadTooLarge once a file passes max_file_bytes and InvalidUpload for a
+    malformed body or more than max_files files. Close the uploads when done.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise InvalidUpload("Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > max_files * max_file_bytes + MAX_FIELD_BYTES:
+        raise UploadTooLarge(f"Upload exceeds {max_file_bytes / 2 ** 20:g} MB")
+
+    uploads: List[Upload] = []
+    current: Optional[Upload] = None
+    headers = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    field_bytes = 0
+
+    def on_part_begin():
+        nonlocal current
+        current = None
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        nonlocal current
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return
+        if len(uploads) >= max_files:
+            raise InvalidUpload(f"At most {max_files} files per request")
+        part_type = headers.get(b"content-type")
+        current = Upload(
+            field_name=options.get(b"name", b"").decode("latin-1"),
+            filename=options[b"filename"].decode("utf-8", "replace"),
+            content_type=part_type.decode("latin-1").strip() if part_type else None,
+            spool_bytes=spool_bytes
+        )
+        uploads.append(current)
+
+    def on_part_data(data: bytes, start: int, end: int):
+        nonlocal field_bytes
+        if current is None:
+            field_bytes += end - start
+            if field_bytes > MAX_FIELD_BYTES:
+                raise InvalidUpload("Form fields too large")
+            return
+        current.write(memoryview(data)[start:end])
+        if current.size > max_file_bytes:
+            raise UploadTooLarge(f"{current.filename} exceeds {max_file_bytes / 2 ** 20:g} MB")
+
+    def on_part_end():
+        if current is not None:
+            current.finish()
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except BaseException as e:
+        for upload in uploads:
+            upload.close()
+        if isinstance(e, FormParserError):
+            raise InvalidUpload("Invalid multipart data") from e
+        raise
+    return uploads
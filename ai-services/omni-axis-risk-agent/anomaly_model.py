@@ -0,0 +1,265 @@
+"""
+IsolationForest anomaly model for transaction scoring.
+
+Training (offline) builds a feature matrix from the transaction history
+stored in Redis, fits a StandardScaler and an IsolationForest, and writes a
+versioned artifact directory:
+
+    <model_dir>/<version>/model.joblib     compiled arrays, loaded with mmap_mode
+    <model_dir>/<version>/sklearn.joblib   fitted scaler and forest, for reference
+    <model_dir>/<version>/metadata.json
+    <model_dir>/LATEST                     name of the version to serve
+
+The service never calls into sklearn at request time: the fitted trees are
+flattened into node arrays and evaluated for a whole batch at once
+with NumPy, which gives the same scores as IsolationForest.score_samples.
+Memory-mapping the arrays lets every worker share one copy of the trees.
+
+Usage:
+    REDIS_URL=redis://... python anomaly_model.py train [--model-dir /app/models/anomaly]
+"""
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FEATURE_NAMES = [
+    "log_amount",
+    "hour_sin",
+    "hour_cos",
+    "weekday",
+    "cross_border",
+    "high_risk_payment",
+    "high_risk_asset",
+]
+
+# history_codec.FLAG_BITS for the rule outcomes used as features
+CROSS_BORDER_BIT = 1 << 2
+HIGH_RISK_PAYMENT_BIT = 1 << 4
+HIGH_RISK_ASSET_BIT = 1 << 5
+
+US_PER_HOUR = 3_600_000_000
+US_PER_DAY = 24 * US_PER_HOUR
+
+
+def transaction_features(amounts, epoch_us, cross_border, high_risk_payment, high_risk_asset) -> np.ndarray:
+    """Feature matrix shared by training and inference, one row per transaction"""
+    amounts = np.asarray(amounts, dtype=np.float64)
+    epoch_us = np.asarray(epoch_us, dtype=np.int64)
+    hour_angle = 2 * np.pi * ((epoch_us // US_PER_HOUR) % 24) / 24
+    weekday = ((epoch_us // US_PER_DAY) + 3) % 7  # 1970-01-01 was a Thursday
+
+    return np.column_stack([
+        np.log1p(np.maximum(amounts, 0.0)),
+        np.sin(hour_angle),
+        np.cos(hour_angle),
+        weekday.astype(np.float64),
+        np.asarray(cross_border, dtype=np.float64),
+        np.asarray(high_risk_payment, dtype=np.float64),
+        np.asarray(high_risk_asset, dtype=np.float64),
+    ])
+
+
+def features_from_records(records: np.ndarray) -> np.ndarray:
+    """Feature matrix for packed history records (history_codec.RECORD_DTYPE)"""
+    flags = records["flags"].astype(np.int64)
+    return transaction_features(
+        records["amount"],
+        records["epoch_us"],
+        (flags & CROSS_BORDER_BIT) != 0,
+        (flags & HIGH_RISK_PAYMENT_BIT) != 0,
+        (flags & HIGH_RISK_ASSET_BIT) != 0,
+    )
+
+
+def average_path_length(n_samples: np.ndarray) -> np.ndarray:
+    """Expected path length of an unsuccessful BST search, c(n) in the iForest paper"""
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros_like(n_samples)
+    result[n_samples == 2] = 1.0
+    large = n_samples > 2
+    n = n_samples[large]
+    result[large] = 2.0 * (np.log(n - 1.0) + np.euler_gamma) - 2.0 * (n - 1.0) / n
+    return result
+
+
+def compile_forest(scaler, forest) -> Dict[str, np.ndarray]:
+    """Flatten a fitted scaler + IsolationForest into arrays for batched evaluation"""
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    total_nodes = int(offsets[-1])
+
+    left = np.empty(total_nodes, dtype=np.int32)
+    right = np.empty(total_nodes, dtype=np.int32)
+    feature = np.zeros(total_nodes, dtype=np.int32)
+    threshold = np.zeros(total_nodes, dtype=np.float64)
+    path_length = np.zeros(total_nodes, dtype=np.float64)
+    max_depth = 0
+
+    for tree, tree_features, offset in zip(trees, forest.estimators_features_, offsets):
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+
+        # Leaves point at themselves so a fixed number of steps is always safe
+        left[offset + nodes] = np.where(is_leaf, nodes, tree.children_left) + offset
+        right[offset + nodes] = np.where(is_leaf, nodes, tree.children_right) + offset
+        feature[offset + nodes] = np.where(is_leaf, 0, tree_features[np.maximum(tree.feature, 0)])
+        threshold[offset + nodes] = tree.threshold
+
+        depth = np.zeros(tree.node_count, dtype=np.float64)
+        for node in nodes:  # Parents always precede their children
+            if not is_leaf[node]:
+                depth[tree.children_left[node]] = depth[node] + 1
+                depth[tree.children_right[node]] = depth[node] + 1
+        path_length[offset + nodes] = np.where(
+            is_leaf, depth + average_path_length(tree.n_node_samples), 0.0
+        )
+        max_depth = max(max_depth, int(depth.max()))
+
+    return {
+        "scaler_mean": np.asarray(scaler.mean_, dtype=np.float64),
+        "scaler_scale": np.asarray(scaler.scale_, dtype=np.float64),
+        "roots": offsets[:-1].astype(np.int32),
+        "left": left,
+        "right": right,
+        "feature": feature,
+        "threshold": threshold,
+        "path_length": path_length,
+        "max_depth": np.array(max_depth),
+        "normalizer": average_path_length(np.array([forest.max_samples_]))[:1],
+        # score_samples() below -offset_ is what sklearn labels an outlier
+        "anomaly_threshold": np.array(-forest.offset_),
+    }
+
+
+class AnomalyModel:
+    """Compiled IsolationForest served from memory-mapped arrays"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray], version: str):
+        self.version = version
+        self.scaler_mean = arrays["scaler_mean"]
+        self.scaler_scale = arrays["scaler_scale"]
+        self.roots = arrays["roots"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.feature = arrays["feature"]
+        self.threshold_values = arrays["threshold"]
+        self.path_length = arrays["path_length"]
+        self.max_depth = int(arrays["max_depth"])
+        self.normalizer = float(arrays["normalizer"][0])
+        self.anomaly_threshold = float(arrays["anomaly_threshold"])
+
+    def score(self, features: np.ndarray) -> np.ndarray:
+        """Anomaly score in (0, 1] per row; ~0.5 is normal, near 1 is anomalous"""
+        X = (np.asarray(features, dtype=np.float64) - self.scaler_mean) / self.scaler_scale
+        X = X.astype(np.float32)  # sklearn trees split on float32 inputs
+        n_samples = X.shape[0]
+        rows = np.arange(n_samples)[:, None]
+
+        # Walk every (sample, tree) pair down one level per step
+        nodes = np.broadcast_to(self.roots, (n_samples, len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold_values[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        # Row-wise reduction keeps each sample's result independent of batch size
+        mean_path_length = self.path_length[nodes].sum(axis=1) / len(self.roots)
+        return 2.0 ** (-mean_path_length / self.normalizer)
+
+
+def load_latest(model_dir: str) -> Optional[AnomalyModel]:
+    """Load the version named in <model_dir>/LATEST, or None if there isn't one"""
+    try:
+        with open(os.path.join(model_dir, "LATEST")) as f:
+            version = f.read().strip()
+        arrays = joblib.load(os.path.join(model_dir, version, "model.joblib"), mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    return AnomalyModel(arrays, version)
+
+
+def save_version(model_dir: str, scaler, forest, metadata: Dict) -> str:
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    version_dir = os.path.join(model_dir, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    joblib.dump(compile_forest(scaler, forest), os.path.join(version_dir, "model.joblib"))
+    joblib.dump({"scaler": scaler, "isolation_forest": forest}, os.path.join(version_dir, "sklearn.joblib"))
+    with open(os.path.join(version_dir, "metadata.json"), "w") as f:
+        json.dump({"version": version, "features": FEATURE_NAMES, **metadata}, f, indent=2)
+
+    # Publish by renaming the pointer into place
+    latest_tmp = os.path.join(model_dir, "LATEST.tmp")
+    with open(latest_tmp, "w") as f:
+        f.write(version)
+    os.replace(latest_tmp, os.path.join(model_dir, "LATEST"))
+    return version
+
+
+async def load_training_matrix(redis_client, capacity: int, scan_count: int = 1000) -> np.ndarray:
+    """Feature matrix over every user's stored transaction history"""
+    from history_codec import RING_KEY_PREFIX, load_history
+
+    chunks = []
+    async for key in redis_client.scan_iter(match=f"{RING_KEY_PREFIX}*", count=scan_count):
+        user_id = key.decode()[len(RING_KEY_PREFIX):]
+        records = await load_history(redis_client, user_id, capacity)
+        if len(records):
+            chunks.append(features_from_records(records))
+    if not chunks:
+        return np.empty((0, len(FEATURE_NAMES)))
+    return np.vstack(chunks)
+
+
+def train(X: np.ndarray, contamination: float, n_estimators: int, random_state: int = 42):
+    from sklearn.ensemble import IsolationForest
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler().fit(X)
+    forest = IsolationForest(
+        n_estimators=n_estimators,
+        contamination=contamination,
+        random_state=random_state
+    ).fit(scaler.transform(X))
+    return scaler, forest
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Train the transaction anomaly model")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--model-dir", default=os.getenv("ANOMALY_MODEL_DIR", "/app/models/anomaly"))
+    parser.add_argument("--contamination", type=float, default=0.1)
+    parser.add_argument("--n-estimators", type=int, default=100)
+    args = parser.parse_args()
+
+    import redis.asyncio as aioredis
+    from risk_models import HISTORY_MAX_LENGTH
+
+    async def build_matrix():
+        client = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
+        try:
+            return await load_training_matrix(client, HISTORY_MAX_LENGTH)
+        finally:
+            await client.aclose()
+
+    X = asyncio.run(build_matrix())
+    if len(X) < 100:
+        raise SystemExit(f"Not enough stored transactions to train on ({len(X)})")
+
+    scaler, forest = train(X, args.contamination, args.n_estimators)
+    version = save_version(args.model_dir, scaler, forest, {
+        "training_rows": int(len(X)),
+        "contamination": args.contamination,
+        "n_estimators": args.n_estimators
+    })
+    print(f"Saved anomaly model {version} trained on {len(X)} transactions")
@@ -0,0 +1,261 @@
+"""
+Offline backfill: re-score historical transactions with the current rules.
+
+Reads a CSV or Parquet file of transactions (the TransactionRiskData fields:
+transaction_id, user_id, amount, asset_type, timestamp, ip_address,
+payment_method, is_cross_border and optionally device_fingerprint) and
+writes a Parquet dataset of assessments, one part file per time partition:
+
+    transaction_id, user_id, timestamp, risk_score, risk_level, flags, rules_version
+
+Scoring goes through risk_rules.evaluate_transactions, the same code the
+service uses. Velocity state is rebuilt in memory in timestamp order
+instead of being read from Redis.
+
+The input is streamed in chunks and split by timestamp into partition files
+(one day by default) in a scratch directory (the system temp directory
+unless --scratch is given). A process pool then scores the partitions.
+Each partition is loaded together with the preceding 24 hours so the
+velocity windows are warm. Memory is bounded by the chunk size and by the
+largest partition plus its warm-up rows, never by the input size.
+
+Part files are written to a staging directory next to the output
+directory, which is renamed into place once every partition is scored, so
+readers of the output never see a partial or mixed dataset. The output
+directory must not exist or be empty.
+
+Timestamps are read as UTC (naive ones are taken as UTC). The hour-of-day
+factor gets the hour as submitted, in the timestamp's own offset, like the
+service's rule table.
+
+Usage:
+    python backfill.py transactions.parquet scores/ [--workers 8] [--rules risk_rules.json] [--scratch /mnt/tmp]
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional
+import argparse
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from anomaly_model import load_latest as load_anomaly_model
+from risk_rules import DEFAULT_RULES_PATH, RuleSet, evaluate_transactions
+from velocity import DIMENSIONS, VELOCITY_WINDOWS, window_velocity
+
+logger = logging.getLogger("backfill")
+
+INPUT_COLUMNS = [
+    "transaction_id", "user_id", "amount", "asset_type", "timestamp",
+    "ip_address", "payment_method", "is_cross_border", "device_fingerprint"
+]
+DIMENSION_COLUMNS = {"user": "user_id", "ip": "ip_address", "device": "device_fingerprint"}
+EPOCH = pd.Timestamp(0, tz="UTC")
+MS_PER_HOUR = 3_600_000
+WARMUP_MS = VELOCITY_WINDOWS[-1][1] * 1000
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    if path.endswith(".parquet") or os.path.isdir(path):
+        dataset = pq.ParquetFile(path) if os.path.isfile(path) else None
+        if dataset is not None:
+            for batch in dataset.iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+        else:
+            for file_path in sorted(glob.glob(os.path.join(path, "*.parquet"))):
+                yield from read_chunks(file_path, chunk_size)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype={
+            "transaction_id": str, "user_id": str, "ip_address": str,
+            "device_fingerprint": str, "asset_type": str, "payment_method": str
+        })
+
+
+def submitted_hours(timestamps: pd.Series) -> np.ndarray:
+    """Hour of each timestamp in its own offset (tx.timestamp.hour in the service)"""
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps.dt.hour.to_numpy(dtype=np.int64)
+    # ISO 8601 text: the hour is written in the submitted offset
+    hours = timestamps.astype(str).str.extract(r"[T ](\d{1,2}):", expand=False)
+    return hours.fillna(0).astype(np.int64).to_numpy()
+
+
+def normalize(chunk: pd.DataFrame, first_row: int) -> pd.DataFrame:
+    """Typed columns plus epoch times and a global row number for stable ordering"""
+    missing = set(INPUT_COLUMNS) - set(chunk.columns) - {"device_fingerprint", "is_cross_border"}
+    if missing:
+        raise ValueError(f"Input is missing columns: {sorted(missing)}")
+
+    timestamps = pd.to_datetime(chunk["timestamp"], utc=True, format="ISO8601")
+    frame = pd.DataFrame({
+        "row": np.arange(first_row, first_row + len(chunk), dtype=np.int64),
+        "transaction_id": chunk["transaction_id"].astype(str),
+        "user_id": chunk["user_id"].astype(str),
+        "amount": chunk["amount"].astype(np.float64),
+        "asset_type": chunk["asset_type"].astype(str),
+        "epoch_us": (timestamps - EPOCH) // pd.Timedelta(microseconds=1),
+        "hour": submitted_hours(chunk["timestamp"]),
+        "ip_address": chunk["ip_address"].fillna("").astype(str),
+        "payment_method": chunk["payment_method"].astype(str),
+        "is_cross_border": chunk.get("is_cross_border", pd.Series(False, index=chunk.index)).fillna(False).astype(bool),
+        "device_fingerprint": chunk.get("device_fingerprint", pd.Series("", index=chunk.index)).fillna("").astype(str),
+    })
+    frame["epoch_ms"] = frame["epoch_us"] // 1000
+    return frame
+
+
+def split_input(path: str, scratch: str, chunk_size: int, partition_ms: int) -> Dict[int, List[str]]:
+    """Stream the input into per-partition Parquet files; returns partition -> files"""
+    partitions: Dict[int, List[str]] = {}
+    rows = 0
+    for chunk_number, chunk in enumerate(read_chunks(path, chunk_size)):
+        frame = normalize(chunk, rows)
+        rows += len(frame)
+        for partition, part in frame.groupby(frame["epoch_ms"] // partition_ms, sort=False):
+            file_path = os.path.join(scratch, f"partition-{partition}-{chunk_number}.parquet")
+            part.to_parquet(file_path, index=False)
+            partitions.setdefault(int(partition), []).append(file_path)
+        logger.info(f"Split {rows} rows into {len(partitions)} partitions")
+    return partitions
+
+
+# Worker state, loaded once per process
+_rules: Optional[RuleSet] = None
+_anomaly_model = None
+_max_events = 1000
+
+
+def _init_worker(rules_path: str, model_dir: Optional[str], max_events: int):
+    global _rules, _anomaly_model, _max_events
+    _rules = RuleSet.from_file(rules_path)
+    _anomaly_model = load_anomaly_model(model_dir) if model_dir else None
+    _max_events = max_events
+
+
+def score_partition(partition: int, files: List[str], warmup_files: List[str], output_dir: str,
+                    partition_ms: int) -> int:
+    """Score one partition and write its part file; returns rows written"""
+    start_ms = partition * partition_ms
+    frames = [pd.read_parquet(file_path) for file_path in files]
+    for file_path in warmup_files:
+        warmup = pd.read_parquet(file_path)
+        frames.append(warmup[warmup["epoch_ms"] >= start_ms - WARMUP_MS])
+    frame = pd.concat(frames, ignore_index=True).sort_values(["epoch_us", "row"], kind="stable", ignore_index=True)
+
+    n = len(frame)
+    epoch_ms = frame["epoch_ms"].to_numpy()
+    amounts = frame["amount"].to_numpy()
+    counts = np.zeros((n, len(DIMENSIONS), len(VELOCITY_WINDOWS)), dtype=np.int64)
+    sums = np.zeros((n, len(DIMENSIONS), len(VELOCITY_WINDOWS)), dtype=np.float64)
+    for d, dimension in enumerate(DIMENSIONS):
+        values = frame[DIMENSION_COLUMNS[dimension]]
+        codes, _ = pd.factorize(values.where(values != ""))
+        counts[:, d], sums[:, d] = window_velocity(codes, epoch_ms, amounts, _max_events)
+
+    # Warm-up rows only feed the velocity windows
+    scored = np.flatnonzero(epoch_ms >= start_ms)
+    frame = frame.iloc[scored].reset_index(drop=True)
+
+    evaluation = evaluate_transactions(
+        _rules,
+        {
+            "amount": frame["amount"].to_numpy(),
+            "is_cross_border": frame["is_cross_border"].to_numpy(),
+            "hour": frame["hour"].to_numpy(),
+            "payment_method": frame["payment_method"].to_numpy(dtype=object),
+            "asset_type": frame["asset_type"].to_numpy(dtype=object)
+        },
+        frame["epoch_us"].to_numpy(),
+        counts[scored],
+        sums[scored],
+        _anomaly_model
+    )
+
+    table = pa.table({
+        "transaction_id": frame["transaction_id"],
+        "user_id": frame["user_id"],
+        "timestamp": pd.to_datetime(frame["epoch_us"], unit="us", utc=True),
+        "risk_score": evaluation.scores,
+        "risk_level": evaluation.risk_levels.astype(str),
+        "flags": pa.array(evaluation.flag_lists(), type=pa.list_(pa.string())),
+        "rules_version": pa.array([_rules.version] * len(frame), type=pa.string()),
+    })
+    pq.write_table(table, os.path.join(output_dir, f"part-{partition:08d}.parquet"))
+    return len(frame)
+
+
+def backfill(input_path: str, output_dir: str, rules_path: str, model_dir: Optional[str],
+             workers: int, chunk_size: int, partition_hours: int, max_events: int,
+             scratch_dir: Optional[str] = None) -> int:
+    partition_ms = partition_hours * MS_PER_HOUR
+    if partition_ms < WARMUP_MS:
+        raise ValueError("Partitions must span at least the longest velocity window (24h)")
+    output_dir = os.path.abspath(output_dir)
+    if os.path.isdir(output_dir) and os.listdir(output_dir):
+        raise ValueError(f"Output directory {output_dir} is not empty")
+    # Staging sits next to the output so the final rename stays on one filesystem
+    parent = os.path.dirname(output_dir)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{os.path.basename(output_dir)}-staging-", dir=parent)
+    scratch = tempfile.mkdtemp(prefix="backfill-", dir=scratch_dir or tempfile.gettempdir())
+    started = time.perf_counter()
+
+    try:
+        partitions = split_input(input_path, scratch, chunk_size, partition_ms)
+        split_seconds = time.perf_counter() - started
+        logger.info(f"Input split in {split_seconds:.1f}s")
+
+        written = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(rules_path, model_dir, max_events)) as pool:
+            pending = set()
+            for partition in sorted(partitions):
+                # Keep at most two partitions per worker in flight to bound memory
+                while len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    written += sum(future.result() for future in done)
+                pending.add(pool.submit(
+                    score_partition, partition, partitions[partition],
+                    partitions.get(partition - 1, []), staging, partition_ms
+                ))
+            for future in pending:
+                written += future.result()
+
+        if os.path.isdir(output_dir):
+            os.rmdir(output_dir)  # Empty, checked above
+        os.rename(staging, output_dir)
+        elapsed = time.perf_counter() - started
+        logger.info(f"Scored {written} rows in {elapsed:.1f}s ({written / elapsed:,.0f} rows/s, "
+                    f"{len(partitions)} partitions, {workers} workers)")
+        return written
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Re-score historical transactions offline")
+    parser.add_argument("input", help="CSV file, Parquet file or directory of Parquet files")
+    parser.add_argument("output", help="Directory for the Parquet output dataset (must not exist or be empty)")
+    parser.add_argument("--rules", default=os.getenv("RISK_RULES_PATH", DEFAULT_RULES_PATH))
+    parser.add_argument("--model-dir", default=os.getenv("ANOMALY_MODEL_DIR"),
+                        help="Anomaly model directory (omit to score without the model)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=500_000)
+    parser.add_argument("--partition-hours", type=int, default=24)
+    parser.add_argument("--scratch", default=None,
+                        help="Directory for the intermediate partition files (default: system temp directory)")
+    parser.add_argument("--max-events", type=int, default=int(os.getenv("VELOCITY_MAX_EVENTS", "1000")))
+    args = parser.parse_args()
+
+    backfill(args.input, args.output, args.rules, args.model_dir, args.workers,
+             args.chunk_size, args.partition_hours, args.max_events, args.scratch)
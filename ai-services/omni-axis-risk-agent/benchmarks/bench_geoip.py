@@ -0,0 +1,74 @@
+"""
+Benchmark offline GeoIP lookups over a synthetic range database.
+
+Usage:
+    python benchmarks/bench_geoip.py [--ranges 2000000] [--lookups 200000]
+"""
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geoip_db import GeoIPDatabase, compile_csv  # noqa: E402
+
+
+def write_ranges(path: str, n_ranges: int, n_locations: int = 50000):
+    """Contiguous IPv4 ranges over the whole space plus an equal-sized IPv6 block"""
+    n4 = n_ranges // 2
+    n6 = n_ranges - n4
+    v4_step = (2 ** 32) // n4
+    v6_base = int(ipaddress.IPv6Address("2000::"))
+    v6_step = 2 ** 80
+
+    with open(path, "w") as f:
+        f.write("start_ip,end_ip,country_code,country,region,city,latitude,longitude\n")
+        for i in range(n4):
+            loc = i % n_locations
+            f.write(f"{ipaddress.IPv4Address(i * v4_step)},{ipaddress.IPv4Address((i + 1) * v4_step - 1)},"
+                    f"C{loc % 250},Country {loc % 250},Region {loc % 5000},City {loc},0.0,0.0\n")
+        for i in range(n6):
+            loc = i % n_locations
+            f.write(f"{ipaddress.IPv6Address(v6_base + i * v6_step)},{ipaddress.IPv6Address(v6_base + (i + 1) * v6_step - 1)},"
+                    f"C{loc % 250},Country {loc % 250},Region {loc % 5000},City {loc},0.0,0.0\n")
+    return n4, v4_step, n6, v6_base, v6_step
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ranges", type=int, default=2_000_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "ranges.csv")
+        db_path = os.path.join(tmp, "geoip.bin")
+
+        start = time.perf_counter()
+        n4, v4_step, n6, v6_base, v6_step = write_ranges(csv_path, args.ranges)
+        counts = compile_csv(csv_path, db_path)
+        print(f"Compiled {counts['ipv4_ranges']:,} IPv4 + {counts['ipv6_ranges']:,} IPv6 ranges "
+              f"in {time.perf_counter() - start:.1f}s, {os.path.getsize(db_path) / 2 ** 20:.1f} MiB on disk")
+
+        db = GeoIPDatabase(db_path)
+        rng = random.Random(42)
+        queries = {
+            "ipv4": [str(ipaddress.IPv4Address(rng.randrange(n4 * v4_step))) for _ in range(args.lookups)],
+            "ipv6": [str(ipaddress.IPv6Address(v6_base + rng.randrange(n6 * v6_step))) for _ in range(args.lookups)],
+        }
+
+        for family, ips in queries.items():
+            for ip in ips[:1000]:  # Warm the page cache
+                db.lookup(ip)
+            start = time.perf_counter()
+            found = sum(db.lookup(ip) is not None for ip in ips)
+            elapsed = time.perf_counter() - start
+            print(f"{family}: {len(ips):,} lookups, {found:,} hits, {elapsed / len(ips) * 1e6:.2f} us/lookup")
+
+
+if __name__ == "__main__":
+    main()
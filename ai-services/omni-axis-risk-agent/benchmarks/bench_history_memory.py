@@ -0,0 +1,89 @@
+"""
+Estimate Redis memory for per-user transaction history, legacy JSON list vs
+packed ring buffer, extrapolated to --users (default 1M).
+
+Without --redis only the encoded payload sizes are compared; with --redis,
+--sample users are written in both formats and measured with MEMORY USAGE
+(keys include Redis' own per-key overhead).
+
+Usage:
+    python benchmarks/bench_history_memory.py [--redis redis://localhost:6379] [--sample 1000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_codec import HEADER_SIZE, RECORD_SIZE, pack_record  # noqa: E402
+
+HISTORY_LENGTH = 20  # main.HISTORY_MAX_LENGTH
+
+
+def sample_history(rng: random.Random):
+    start = datetime(2024, 1, 1)
+    for _ in range(HISTORY_LENGTH):
+        yield (
+            round(rng.uniform(10, 100000), 2),
+            start + timedelta(seconds=rng.randrange(86400 * 365), microseconds=rng.randrange(10 ** 6)),
+            rng.random()
+        )
+
+
+def legacy_entries(history):
+    return [json.dumps({"amount": a, "timestamp": t.isoformat(), "risk_score": r}) for a, t, r in history]
+
+
+def ring_value(history):
+    return f"{len(history):08x}".encode() + b"".join(pack_record(a, t, r) for a, t, r in history)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--sample", type=int, default=1000)
+    parser.add_argument("--redis", default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    histories = [list(sample_history(rng)) for _ in range(args.sample)]
+
+    legacy_bytes = sum(len(e) for h in histories for e in legacy_entries(h)) / len(histories)
+    ring_bytes = HEADER_SIZE + HISTORY_LENGTH * RECORD_SIZE
+    print(f"Payload per user ({HISTORY_LENGTH} records): legacy JSON {legacy_bytes:.0f} B, ring {ring_bytes} B")
+    print(f"Payload at {args.users:,} users: legacy {legacy_bytes * args.users / 2 ** 30:.2f} GiB, "
+          f"ring {ring_bytes * args.users / 2 ** 30:.2f} GiB")
+
+    if not args.redis:
+        return
+
+    import redis
+    client = redis.from_url(args.redis)
+    pipe = client.pipeline(transaction=False)
+    for i, history in enumerate(histories):
+        pipe.rpush(f"bench_legacy:{i}", *legacy_entries(history))
+        pipe.set(f"bench_ring:{i}", ring_value(history))
+    pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for i in range(len(histories)):
+        pipe.memory_usage(f"bench_legacy:{i}", samples=0)
+        pipe.memory_usage(f"bench_ring:{i}", samples=0)
+    usage = pipe.execute()
+    legacy_usage = sum(usage[0::2]) / len(histories)
+    ring_usage = sum(usage[1::2]) / len(histories)
+
+    client.delete(*[f"bench_legacy:{i}" for i in range(len(histories))],
+                  *[f"bench_ring:{i}" for i in range(len(histories))])
+
+    print(f"MEMORY USAGE per user: legacy {legacy_usage:.0f} B, ring {ring_usage:.0f} B")
+    print(f"At {args.users:,} users: legacy {legacy_usage * args.users / 2 ** 30:.2f} GiB, "
+          f"ring {ring_usage * args.users / 2 ** 30:.2f} GiB "
+          f"({(1 - ring_usage / legacy_usage) * 100:.0f}% saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Load a synthetic identity graph into the linking index against a live Redis
+and check that link and cluster-read latency stays flat as the graph grows.
+
+Every account links through its own device plus a household IP shared
+with two neighbours. A share of the accounts belong to fraud rings of about
+--ring-size accounts that reuse three devices, and a few carrier-NAT IPs are
+shared by far more accounts than the linking cap.
+Latency percentiles are reported per --report-every edges, and Redis memory
+is reported at the end.
+
+Usage:
+    REDIS_URL=redis://localhost:6379 python benchmarks/bench_identity_links.py [--edges 10000000] [--concurrency 64]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import redis.asyncio as aioredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from identity_links import IdentityLinks  # noqa: E402
+
+PREFIX = "bench:identity:"
+
+
+def account_nodes(i: int, rng: np.random.Generator, ring_share: float, ring_size: int):
+    """User id and (device, IP) nodes for account i"""
+    if rng.random() < ring_share:
+        ring = int(rng.integers(0, max(int(i * ring_share) // ring_size, 1)))
+        device = f"d:ring-{ring}-{int(rng.integers(0, 3))}"
+    else:
+        device = f"d:device-{i}"
+    if rng.random() < 0.01:
+        ip = f"i:nat-{int(rng.integers(0, 100))}"  # Shared far beyond the cap
+    else:
+        ip = f"i:household-{i // 3}"
+    return f"user-{i}", [device, ip]
+
+
+def report(label: str, latencies):
+    latencies = np.sort(np.asarray(latencies)) * 1e3
+    print(f"{label:<26} p50 {np.percentile(latencies, 50):7.3f} ms   p99 {np.percentile(latencies, 99):7.3f} ms   "
+          f"max {latencies[-1]:8.3f} ms")
+
+
+async def load_graph(client, links: IdentityLinks, args):
+    rng = np.random.default_rng(0)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 4)
+    latencies = []
+    edges = 0
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            user_id, nodes = item
+            start = time.perf_counter()
+            await links.link(user_id, nodes)
+            latencies.append(time.perf_counter() - start)
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    slice_start = start
+    next_report = args.report_every
+    i = 0
+    while edges < args.edges:
+        user_id, nodes = account_nodes(i, rng, args.ring_share, args.ring_size)
+        await queue.put((user_id, nodes))
+        i += 1
+        edges += len(nodes)
+        if edges >= next_report:
+            now = time.perf_counter()
+            report(f"up to {edges:,} edges", latencies)
+            print(f"{'':<26} {len(latencies) / (now - slice_start):9.0f} links/s")
+            latencies.clear()
+            slice_start = now
+            next_report += args.report_every
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - start
+    print(f"Loaded {edges:,} edges for {i:,} accounts in {elapsed:.1f}s ({edges / elapsed:,.0f} edges/s)")
+    return i
+
+
+async def read_clusters(links: IdentityLinks, accounts: int, samples: int):
+    rng = np.random.default_rng(1)
+    latencies = []
+    sizes = []
+    for i in rng.integers(0, accounts, samples):
+        start = time.perf_counter()
+        cluster = await links.cluster(f"user-{i}", limit=100)
+        latencies.append(time.perf_counter() - start)
+        sizes.append(cluster["cluster_size"])
+    report("cluster read (limit 100)", latencies)
+    print(f"Sampled cluster sizes: median {int(np.median(sizes))}, max {max(sizes)}")
+
+
+async def cleanup(client):
+    batch = []
+    async for key in client.scan_iter(match=f"{PREFIX}*", count=10000):
+        batch.append(key)
+        if len(batch) >= 10000:
+            await client.unlink(*batch)
+            batch.clear()
+    if batch:
+        await client.unlink(*batch)
+
+
+async def run(args):
+    client = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"), max_connections=args.concurrency)
+    links = IdentityLinks(client, prefix=PREFIX, max_shared_accounts=args.max_shared_accounts)
+    await cleanup(client)
+    memory_before = (await client.info("memory"))["used_memory"]
+
+    accounts = await load_graph(client, links, args)
+    await read_clusters(links, accounts, args.samples)
+
+    memory = (await client.info("memory"))["used_memory"] - memory_before
+    print(f"Redis memory: {memory / 2 ** 20:,.0f} MiB ({memory / args.edges:.0f} bytes/edge)")
+    print(links.stats())
+    if not args.keep:
+        await cleanup(client)
+    await client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--edges", type=int, default=10_000_000)
+    parser.add_argument("--report-every", type=int, default=1_000_000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--ring-share", type=float, default=0.05)
+    parser.add_argument("--ring-size", type=int, default=20)
+    parser.add_argument("--max-shared-accounts", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--keep", action="store_true", help="Leave the benchmark keys in Redis")
+    asyncio.run(run(parser.parse_args()))
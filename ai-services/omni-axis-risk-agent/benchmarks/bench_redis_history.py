@@ -0,0 +1,141 @@
+"""
+Compare the per-transaction Redis history update paths against a live Redis.
+
+    legacy:   LRANGE, LPUSH, LTRIM, EXPIRE as separate synchronous calls
+    script:   one EVALSHA appending to the ring buffer and the aggregates
+    velocity: the velocity script, which replaced the LRANGE frequency
+              read, then the append script (current service path)
+
+Both through the async pooled client. Only the history read and append are
+timed. Scoring is left out on both sides: every transaction is recorded
+with the same precomputed risk score. Every key family either path writes
+is deleted before each run and at the end.
+
+Usage:
+    REDIS_URL=redis://localhost:6379 python benchmarks/bench_redis_history.py [--transactions 5000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from history_codec import LEGACY_KEY_PREFIX, RING_KEY_PREFIX, pack_record  # noqa: E402
+from velocity import DIMENSIONS, entity_keys  # noqa: E402
+
+LEGACY_READ_COUNT = 10  # Recent transactions the legacy path read back for frequency
+RISK_SCORE = 0.3  # Recorded for every transaction on both paths
+
+
+def make_transaction(i: int, users: int) -> main.TransactionRiskData:
+    return main.TransactionRiskData(
+        transaction_id=f"bench-{i}",
+        user_id=f"bench-user-{i % users}",
+        amount=float(i % 60000),
+        asset_type="real estate",
+        timestamp=datetime.now(),
+        ip_address=f"10.0.{i % users // 256}.{i % users % 256}",  # One per user, no shared hot key
+        payment_method="bank_transfer"
+    )
+
+
+def bench_keys(transactions):
+    """Every key either path writes for these transactions"""
+    keys = set()
+    for tx in transactions:
+        keys.update((f"{LEGACY_KEY_PREFIX}{tx.user_id}", f"{RING_KEY_PREFIX}{tx.user_id}",
+                     f"user_risk_stats:{tx.user_id}"))
+        for dimension, entity_id in zip(DIMENSIONS, (tx.user_id, tx.ip_address, tx.device_fingerprint)):
+            if entity_id:
+                keys.update(entity_keys(dimension, entity_id))
+    return keys
+
+
+def legacy_update(client: redis.Redis, tx: main.TransactionRiskData):
+    key = f"{LEGACY_KEY_PREFIX}{tx.user_id}"
+    client.lrange(key, 0, LEGACY_READ_COUNT - 1)
+    client.lpush(key, json.dumps({"amount": tx.amount, "timestamp": tx.timestamp.isoformat(),
+                                  "risk_score": RISK_SCORE}))
+    client.ltrim(key, 0, main.HISTORY_MAX_LENGTH - 1)
+    client.expire(key, main.HISTORY_TTL)
+
+
+async def velocity_update(tx: main.TransactionRiskData, record: bytes, high_threshold: float):
+    await main.velocity_counters.observe([
+        (tx.transaction_id, tx.user_id, tx.ip_address, tx.device_fingerprint, tx.amount, tx.timestamp)
+    ])
+    await script_update(tx, record, high_threshold)
+
+
+async def script_update(tx: main.TransactionRiskData, record: bytes, high_threshold: float):
+    await main.record_transaction_script(
+        keys=[f"{RING_KEY_PREFIX}{tx.user_id}", f"user_risk_stats:{tx.user_id}"],
+        args=[main.HISTORY_MAX_LENGTH, main.HISTORY_TTL, high_threshold, record, repr(RISK_SCORE)]
+    )
+
+
+def report(name: str, latencies, elapsed: float):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<24} p50 {statistics.median(latencies) * 1e3:7.3f} ms   p99 {p99 * 1e3:7.3f} ms   "
+          f"{len(latencies) / elapsed:9.0f} tx/s")
+
+
+async def run_async_path(update, transactions, records, concurrency: int):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    high_threshold = main.rule_engine.current().thresholds["high"]
+
+    async def one(tx, record):
+        async with semaphore:
+            start = time.perf_counter()
+            await update(tx, record, high_threshold)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(tx, record) for tx, record in zip(transactions, records)))
+    return latencies, time.perf_counter() - start
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    transactions = [make_transaction(i, args.users) for i in range(args.transactions)]
+    records = [pack_record(tx.amount, tx.timestamp, RISK_SCORE) for tx in transactions]
+    keys = list(bench_keys(transactions))
+    sync_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
+    sync_client.delete(*keys)
+
+    latencies = []
+    start = time.perf_counter()
+    for tx in transactions:
+        tx_start = time.perf_counter()
+        legacy_update(sync_client, tx)
+        latencies.append(time.perf_counter() - tx_start)
+    report("legacy, 4 calls", latencies, time.perf_counter() - start)
+
+    async def script_benchmarks():
+        for name, update in (("script", script_update), ("velocity", velocity_update)):
+            for concurrency in (1, args.concurrency):
+                sync_client.delete(*keys)
+                latencies, elapsed = await run_async_path(update, transactions, records, concurrency)
+                report(f"{name}, concurrency {concurrency}", latencies, elapsed)
+
+    # One event loop for both runs; the pooled client is bound to it
+    asyncio.run(script_benchmarks())
+    sync_client.delete(*keys)
+
+if __name__ == "__main__":
+    main_benchmark()
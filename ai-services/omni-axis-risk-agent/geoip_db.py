@@ -0,0 +1,238 @@
+"""
+Offline IP geolocation database.
+
+A CSV of IP ranges is compiled into a compact binary file of sorted range
+arrays. Lookups memory-map that file and bisect it with np.searchsorted,
+so every worker on a host shares one copy of the pages.
+
+CSV columns (header required):
+    start_ip,end_ip,country_code,country,region,city,latitude,longitude
+
+Usage:
+    python geoip_db.py compile ranges.csv geoip.bin
+    python geoip_db.py lookup geoip.bin 8.8.8.8
+"""
+from typing import Dict, List, Optional, Tuple
+import csv
+import ipaddress
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"OAGEOIP1"
+FORMAT_VERSION = 1
+# magic, version, IPv4 ranges, IPv6 ranges, locations, string blob size
+HEADER = struct.Struct("<8sIQQQQ")
+
+LOCATION_FIELDS = ["country_code", "country", "region", "city", "latitude", "longitude"]
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _section_layout(n4: int, n6: int, n_locations: int) -> List[Tuple[str, int, str, int]]:
+    """(name, offset, dtype, count) for every array section in the file"""
+    sections = [
+        ("v4_start", "<u4", n4),
+        ("v4_end", "<u4", n4),
+        ("v4_location", "<u4", n4),
+        ("v6_start", "S16", n6),
+        ("v6_end", "S16", n6),
+        ("v6_location", "<u4", n6),
+        ("location_offsets", "<u8", n_locations + 1),
+    ]
+    layout = []
+    offset = _align(HEADER.size)
+    for name, dtype, count in sections:
+        layout.append((name, offset, dtype, count))
+        offset = _align(offset + np.dtype(dtype).itemsize * count)
+    layout.append(("blob", offset, "u1", 0))
+    return layout
+
+
+def compile_csv(csv_path: str, output_path: str) -> Dict[str, int]:
+    """Compile a CSV of IP ranges into the binary lookup format"""
+    v4_ranges = []
+    v6_ranges = []
+    locations: Dict[str, int] = {}
+
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            start = ipaddress.ip_address(row["start_ip"].strip())
+            end = ipaddress.ip_address(row["end_ip"].strip())
+            if start.version != end.version or int(start) > int(end):
+                raise ValueError(f"Invalid range {row['start_ip']} - {row['end_ip']}")
+
+            location = "\t".join((row.get(field) or "").strip() for field in LOCATION_FIELDS)
+            location_id = locations.setdefault(location, len(locations))
+
+            if start.version == 4:
+                v4_ranges.append((int(start), int(end), location_id))
+            else:
+                v6_ranges.append((start.packed, end.packed, location_id))
+
+    for ranges in (v4_ranges, v6_ranges):
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] <= previous[1]:
+                raise ValueError("Overlapping IP ranges in input")
+
+    blob = bytearray()
+    location_offsets = [0]
+    for location in locations:
+        blob += location.encode("utf-8")
+        location_offsets.append(len(blob))
+
+    arrays = {
+        "v4_start": np.array([r[0] for r in v4_ranges], dtype="<u4"),
+        "v4_end": np.array([r[1] for r in v4_ranges], dtype="<u4"),
+        "v4_location": np.array([r[2] for r in v4_ranges], dtype="<u4"),
+        "v6_start": np.array([r[0] for r in v6_ranges], dtype="S16"),
+        "v6_end": np.array([r[1] for r in v6_ranges], dtype="S16"),
+        "v6_location": np.array([r[2] for r in v6_ranges], dtype="<u4"),
+        "location_offsets": np.array(location_offsets, dtype="<u8"),
+    }
+
+    # Write next to the target and rename, so readers never see a partial file
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(v4_ranges), len(v6_ranges), len(locations), len(blob)))
+            for name, offset, _, _ in _section_layout(len(v4_ranges), len(v6_ranges), len(locations)):
+                out.write(b"\0" * (offset - out.tell()))
+                out.write(bytes(blob) if name == "blob" else arrays[name].tobytes())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return {"ipv4_ranges": len(v4_ranges), "ipv6_ranges": len(v6_ranges), "locations": len(locations)}
+
+
+def _pack_ip(ip_address: str) -> Optional[bytes]:
+    """Packed network-order bytes, with IPv4-mapped IPv6 folded to IPv4"""
+    ip_address = ip_address.strip()
+    try:
+        return socket.inet_pton(socket.AF_INET, ip_address)
+    except OSError:
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip_address.split("%", 1)[0])
+    except OSError:
+        return None
+    if packed[:12] == b"\0" * 10 + b"\xff\xff":
+        return packed[12:]
+    return packed
+
+
+class _MappedTables:
+    """Read-only NumPy views over one memory-mapped database file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n4, n6, n_locations, blob_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a GeoIP database (version {FORMAT_VERSION})")
+
+        for name, offset, dtype, count in _section_layout(n4, n6, n_locations):
+            if name == "blob":
+                self.blob_offset = offset
+            else:
+                setattr(self, name, np.frombuffer(self.mm, dtype=dtype, count=count, offset=offset))
+        self.blob_size = blob_size
+
+    def location(self, location_id: int) -> Dict[str, str]:
+        start = self.blob_offset + int(self.location_offsets[location_id])
+        end = self.blob_offset + int(self.location_offsets[location_id + 1])
+        values = self.mm[start:end].decode("utf-8").split("\t")
+        return dict(zip(LOCATION_FIELDS, values))
+
+
+class GeoIPDatabase:
+    """Memory-mapped range database that reloads itself when the file is replaced"""
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._tables = _MappedTables(path)
+        self._next_check = time.monotonic() + check_interval
+        self._reload_lock = threading.Lock()
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            stat = os.stat(self.path)
+            current = self._tables.stat
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != (current.st_ino, current.st_mtime_ns, current.st_size):
+                # Swap in one assignment; in-flight lookups keep the old mapping alive
+                self._tables = _MappedTables(self.path)
+                self.reloads += 1
+                logger.info(f"Reloaded GeoIP database {self.path}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"GeoIP database reload failed, keeping current copy: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def lookup(self, ip_address: str) -> Optional[Dict[str, str]]:
+        """Return the location record for an IP, or None if no range covers it"""
+        self._maybe_reload()
+        tables = self._tables
+
+        packed = _pack_ip(ip_address)
+        if packed is None:
+            return None
+
+        if len(packed) == 4:
+            key = np.uint32(int.from_bytes(packed, "big"))
+            starts, ends, location_ids = tables.v4_start, tables.v4_end, tables.v4_location
+        else:
+            key = np.array(packed, dtype="S16")
+            starts, ends, location_ids = tables.v6_start, tables.v6_end, tables.v6_location
+
+        index = int(np.searchsorted(starts, key, side="right")) - 1
+        if index < 0 or bool(key > ends[index]):
+            return None
+        return tables.location(int(location_ids[index]))
+
+    def stats(self) -> Dict[str, int]:
+        tables = self._tables
+        return {
+            "ipv4_ranges": len(tables.v4_start),
+            "ipv6_ranges": len(tables.v6_start),
+            "locations": len(tables.location_offsets) - 1,
+            "file_size": tables.stat.st_size,
+            "reloads": self.reloads
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) == 4 and sys.argv[1] == "compile":
+        counts = compile_csv(sys.argv[2], sys.argv[3])
+        print(f"Compiled {counts['ipv4_ranges']} IPv4 and {counts['ipv6_ranges']} IPv6 ranges "
+              f"({counts['locations']} locations) into {sys.argv[3]}")
+    elif len(sys.argv) == 4 and sys.argv[1] == "lookup":
+        print(GeoIPDatabase(sys.argv[2]).lookup(sys.argv[3]))
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,196 @@
+"""
+Compact binary encoding for per-user transaction history.
+
+Each user's history is one Redis string used as a fixed-capacity ring buffer:
+
+    [8-byte ASCII hex write cursor][capacity x 24-byte records]
+
+Records are little-endian (amount float64, epoch_us int64, risk_score float32,
+flags uint32), so a raw value decodes zero-copy with np.frombuffer. The
+cursor counts writes (wrapped to stay below 2 x capacity); slot = cursor %
+capacity and the number of valid records is min(cursor, capacity).
+
+The previous format (a list of JSON dicts under user_tx_history:{user_id})
+is still read until it expires; `python history_codec.py migrate` converts
+it eagerly.
+"""
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+import asyncio
+import json
+import os
+import sys
+
+import numpy as np
+
+RECORD_DTYPE = np.dtype([
+    ("amount", "<f8"),
+    ("epoch_us", "<i8"),
+    ("risk_score", "<f4"),
+    ("flags", "<u4"),
+])
+RECORD_SIZE = RECORD_DTYPE.itemsize
+HEADER_SIZE = 8
+
+RING_KEY_PREFIX = "user_tx_ring:"
+LEGACY_KEY_PREFIX = "user_tx_history:"
+
+# Bit per transaction flag stored with each record
+FLAG_BITS = {
+    "Large transaction amount": 1 << 0,
+    "High transaction frequency": 1 << 1,
+    "Cross-border transaction": 1 << 2,
+    "Transaction outside business hours": 1 << 3,
+    "High-risk payment method": 1 << 4,
+    "High-risk asset type": 1 << 5,
+    "High IP address velocity": 1 << 6,
+    "High device velocity": 1 << 7,
+    "High transaction volume": 1 << 8,
+}
+
+# Lua helper: write one packed record into the ring at ring_key.
+# Returns the number of records that were in the ring before the write.
+APPEND_RECORD_LUA = """
+local function append_record(ring_key, record, capacity)
+    local header = redis.call('GETRANGE', ring_key, 0, %d)
+    local cursor = 0
+    if #header == %d then
+        cursor = tonumber(header, 16)
+    end
+    redis.call('SETRANGE', ring_key, %d + (cursor %% capacity) * %d, record)
+    local next_cursor = cursor + 1
+    if next_cursor >= 2 * capacity then
+        next_cursor = next_cursor - capacity
+    end
+    redis.call('SETRANGE', ring_key, 0, string.format('%%08x', next_cursor))
+    return math.min(cursor, capacity)
+end
+""" % (HEADER_SIZE - 1, HEADER_SIZE, HEADER_SIZE, RECORD_SIZE)
+
+
+def to_epoch_us(timestamp: datetime) -> int:
+    """Microseconds since the epoch; naive timestamps are taken as UTC"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1_000_000)
+
+
+def flags_to_bits(flags: Iterable[str]) -> int:
+    bits = 0
+    for flag in flags:
+        bits |= FLAG_BITS.get(flag, 0)
+    return bits
+
+
+def pack_record(amount: float, timestamp: datetime, risk_score: float, flags: int = 0) -> bytes:
+    record = np.empty(1, dtype=RECORD_DTYPE)
+    record[0] = (amount, to_epoch_us(timestamp), risk_score, flags)
+    return record.tobytes()
+
+
+def ring_length(header: Optional[bytes], capacity: int) -> int:
+    """Valid records in a ring, from its header (None/empty for a missing key)"""
+    if not header or len(header) < HEADER_SIZE:
+        return 0
+    return min(int(header[:HEADER_SIZE], 16), capacity)
+
+
+def decode_ring(raw: Optional[bytes], capacity: int) -> np.ndarray:
+    """Records in a ring buffer value, newest first"""
+    if not raw or len(raw) < HEADER_SIZE:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    cursor = int(raw[:HEADER_SIZE], 16)
+    count = min(cursor, capacity)
+    slots = np.frombuffer(raw, dtype=RECORD_DTYPE, count=min(count, (len(raw) - HEADER_SIZE) // RECORD_SIZE),
+                          offset=HEADER_SIZE)
+    if cursor <= capacity:
+        return slots[::-1]
+    # Full ring: oldest record sits at the write position
+    head = cursor % capacity
+    return np.concatenate((slots[head:], slots[:head]))[::-1]
+
+
+def decode_legacy(entries: List[bytes]) -> np.ndarray:
+    """JSON list entries (newest first) in the packed record layout"""
+    records = np.empty(len(entries), dtype=RECORD_DTYPE)
+    for i, entry in enumerate(entries):
+        tx = json.loads(entry)
+        records[i] = (
+            tx.get("amount", 0.0),
+            to_epoch_us(datetime.fromisoformat(tx["timestamp"])) if tx.get("timestamp") else 0,
+            tx.get("risk_score", 0.0),
+            0
+        )
+    return records
+
+
+def merge_history(raw: Optional[bytes], legacy: List[bytes], capacity: int) -> np.ndarray:
+    """Records of a ring value and a legacy JSON list, newest first"""
+    records = decode_ring(raw, capacity)
+    if legacy:
+        records = np.concatenate((records, decode_legacy(legacy)))
+    return records[:capacity]
+
+
+async def load_history(redis_client, user_id: str, capacity: int) -> np.ndarray:
+    """A user's transaction history from both formats, newest first"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(f"{RING_KEY_PREFIX}{user_id}")
+    pipe.lrange(f"{LEGACY_KEY_PREFIX}{user_id}", 0, -1)
+    raw, legacy = await pipe.execute()
+    return merge_history(raw, legacy, capacity)
+
+
+async def migrate(redis_client, capacity: int, ttl: int, batch_size: int = 500) -> int:
+    """
+    Convert every legacy JSON history list into a ring buffer. Both keys are
+    watched from the read to the write, so a transaction appended meanwhile
+    (the service keeps running) makes the user's conversion start over
+    instead of being lost.
+    """
+    from redis.exceptions import WatchError
+
+    migrated = 0
+    async for key in redis_client.scan_iter(match=f"{LEGACY_KEY_PREFIX}*", count=batch_size):
+        user_id = key.decode()[len(LEGACY_KEY_PREFIX):]
+        ring_key = f"{RING_KEY_PREFIX}{user_id}"
+        async with redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(ring_key, key)
+                    raw = await pipe.get(ring_key)
+                    legacy = await pipe.lrange(key, 0, -1)
+                    if not legacy:
+                        # Expired or converted since the scan
+                        await pipe.unwatch()
+                        break
+                    records = merge_history(raw, legacy, capacity)
+
+                    # Oldest record in slot 0, cursor = number of records written
+                    ring = f"{len(records):08x}".encode() + records[::-1].tobytes()
+                    pipe.multi()
+                    pipe.set(ring_key, ring, ex=ttl)
+                    pipe.delete(key)
+                    await pipe.execute()
+                    migrated += 1
+                    break
+                except WatchError:
+                    continue
+    return migrated
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] != "migrate":
+        print("Usage: REDIS_URL=redis://... python history_codec.py migrate")
+        sys.exit(1)
+
+    import redis.asyncio as aioredis
+    from risk_models import HISTORY_MAX_LENGTH, HISTORY_TTL
+
+    async def run():
+        client = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
+        count = await migrate(client, HISTORY_MAX_LENGTH, HISTORY_TTL)
+        await client.aclose()
+        print(f"Migrated {count} legacy histories")
+
+    asyncio.run(run())
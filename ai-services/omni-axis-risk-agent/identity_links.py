@@ -0,0 +1,295 @@
+"""
+Incremental identity linking: accounts that share a device fingerprint or a
+public IP address are joined into one cluster.
+
+The graph is a union-find over user, device and IP nodes ("u:<user_id>",
+"d:<fingerprint>", "i:<ip>") kept in Redis:
+
+    <prefix>parent             hash  node -> parent (roots have no entry)
+    <prefix>cluster:<root>     hash  nodes, users, scored, risk_sum, high
+    <prefix>members:<root>     set   user ids in the cluster
+    <prefix>accounts:<node>    set   users seen on a device/IP, capped
+    <prefix>user_risk          hash  user id -> "<risk micro-units>|<high 0/1>"
+    <prefix>id_key             str   secret key of the opaque cluster ids
+
+Every call is one Lua script. Find uses path halving and union goes by node
+count, with the smaller member set folded into the larger one, so adding an
+edge and reading a cluster's size and risk is near-constant time however
+big the graph grows. Risk sums are kept in integer micro-units so repeated
+updates never drift.
+
+A device or IP shared by more than max_shared_accounts users (carrier NAT,
+public Wi-Fi, a shared office) stops linking further accounts; otherwise
+one busy hub would merge unrelated clusters.
+
+The parent and user_risk hashes and the accounts sets of the nodes being
+linked are passed to the scripts in KEYS. The cluster and members keys of
+a root are only known once find() has walked to it, so the scripts derive
+them from the prefix. On Redis Cluster the prefix must therefore carry a
+hash tag (e.g. "{identity}:") so that every key of the index lives in the
+same slot; with a plain prefix the index needs a single Redis node.
+"""
+from typing import Any, Dict, List, Optional
+import hashlib
+import hmac
+import ipaddress
+import logging
+import secrets
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFIX = "identity:"
+RISK_SCALE = 1_000_000  # risk_sum units per 1.0 of risk score
+
+# Shared helpers. KEYS[1]: parent hash. ARGV[1]: key prefix
+CLUSTER_LUA = """
+local parent_key = KEYS[1]
+local prefix = ARGV[1]
+
+local function cluster_key(root)
+    return prefix .. 'cluster:' .. root
+end
+
+local function members_key(root)
+    return prefix .. 'members:' .. root
+end
+
+-- Root of node, halving the path on the way up
+local function find(node)
+    while true do
+        local parent = redis.call('HGET', parent_key, node)
+        if not parent then
+            return node
+        end
+        local grandparent = redis.call('HGET', parent_key, parent)
+        if not grandparent then
+            return parent
+        end
+        redis.call('HSET', parent_key, node, grandparent)
+        node = grandparent
+    end
+end
+
+local function cluster_stats(root)
+    local stats = redis.call('HMGET', cluster_key(root), 'users', 'scored', 'risk_sum', 'high')
+    return {root, tonumber(stats[1]) or 0, tonumber(stats[2]) or 0, tonumber(stats[3]) or 0, tonumber(stats[4]) or 0}
+end
+"""
+
+# KEYS: parent, user_risk, accounts set per node. ARGV: prefix, max shared
+# accounts, user id, nodes (in the order of their accounts sets)...
+# Returns root, users, scored, risk_sum, high, own risk value, merges, saturated
+LINK_SCRIPT = CLUSTER_LUA + """
+local max_shared = tonumber(ARGV[2])
+local user = ARGV[3]
+
+-- Root of node, creating a singleton cluster for a node seen for the first time
+local function root_of(node)
+    local root = find(node)
+    if root == node and redis.call('EXISTS', cluster_key(node)) == 0 then
+        if string.sub(node, 1, 2) == 'u:' then
+            redis.call('HSET', cluster_key(node), 'nodes', 1, 'users', 1, 'scored', 0, 'risk_sum', 0, 'high', 0)
+            redis.call('SADD', members_key(node), string.sub(node, 3))
+        else
+            redis.call('HSET', cluster_key(node), 'nodes', 1, 'users', 0, 'scored', 0, 'risk_sum', 0, 'high', 0)
+        end
+    end
+    return root
+end
+
+-- Merge two clusters; the one with fewer nodes is folded into the other
+local function union(a, b)
+    if tonumber(redis.call('HGET', cluster_key(a), 'nodes')) < tonumber(redis.call('HGET', cluster_key(b), 'nodes')) then
+        a, b = b, a
+    end
+    redis.call('HSET', parent_key, b, a)
+    local stats = redis.call('HGETALL', cluster_key(b))
+    for i = 1, #stats, 2 do
+        redis.call('HINCRBY', cluster_key(a), stats[i], stats[i + 1])
+    end
+    local members = redis.call('SMEMBERS', members_key(b))
+    for i = 1, #members, 1000 do
+        redis.call('SADD', members_key(a), unpack(members, i, math.min(i + 999, #members)))
+    end
+    redis.call('DEL', cluster_key(b), members_key(b))
+    return a
+end
+
+local root = root_of('u:' .. user)
+local merges = 0
+local saturated = 0
+for i = 4, #ARGV do
+    local node = ARGV[i]
+    local accounts_key = KEYS[i - 1]
+    local linked = redis.call('SISMEMBER', accounts_key, user) == 1
+    if not linked and redis.call('SCARD', accounts_key) < max_shared then
+        redis.call('SADD', accounts_key, user)
+        linked = true
+    end
+    if linked then
+        local other = root_of(node)
+        if other ~= root then
+            root = union(root, other)
+            merges = merges + 1
+        end
+    else
+        saturated = saturated + 1
+    end
+end
+
+local result = cluster_stats(root)
+result[6] = redis.call('HGET', KEYS[2], user) or false
+result[7] = merges
+result[8] = saturated
+return result
+"""
+
+# KEYS: parent, user_risk. ARGV: prefix, user id, risk micro-units, high (0/1)
+RECORD_RISK_SCRIPT = CLUSTER_LUA + """
+local user = ARGV[2]
+local score = tonumber(ARGV[3])
+local high = tonumber(ARGV[4])
+local key = cluster_key(find('u:' .. user))
+if redis.call('EXISTS', key) == 0 then
+    return 0
+end
+
+local previous = redis.call('HGET', KEYS[2], user)
+if previous then
+    local previous_score, previous_high = string.match(previous, '^(-?%d+)|(%d)$')
+    redis.call('HINCRBY', key, 'risk_sum', score - tonumber(previous_score))
+    redis.call('HINCRBY', key, 'high', high - tonumber(previous_high))
+else
+    redis.call('HINCRBY', key, 'scored', 1)
+    redis.call('HINCRBY', key, 'risk_sum', score)
+    redis.call('HINCRBY', key, 'high', high)
+end
+redis.call('HSET', KEYS[2], user, score .. '|' .. high)
+return 1
+"""
+
+# KEYS: parent, user_risk. ARGV: prefix, user id
+# Returns root, users, scored, risk_sum, high, own risk value; nil if unknown
+READ_CLUSTER_SCRIPT = CLUSTER_LUA + """
+local root = find('u:' .. ARGV[2])
+if redis.call('EXISTS', cluster_key(root)) == 0 then
+    return nil
+end
+local result = cluster_stats(root)
+result[6] = redis.call('HGET', KEYS[2], ARGV[2]) or false
+return result
+"""
+
+
+def link_nodes(ip_address: Optional[str], device_fingerprint: Optional[str]) -> List[str]:
+    """Device and IP nodes an account links through; non-public IPs never link"""
+    nodes = []
+    if device_fingerprint:
+        nodes.append(f"d:{device_fingerprint}")
+    if ip_address:
+        try:
+            ip = ipaddress.ip_address(ip_address.strip())
+        except ValueError:
+            ip = None
+        if ip is not None and ip.is_global:
+            nodes.append(f"i:{ip.compressed}")
+    return nodes
+
+
+def _root(result: List) -> str:
+    root = result[0]
+    return root.decode() if isinstance(root, bytes) else root
+
+
+def _summary(result: List, id_key: bytes) -> Dict[str, Any]:
+    """
+    Cluster size and the risk of the other accounts in it. The cluster id is
+    an HMAC of the root node, which names another account, device or IP.
+    """
+    _, users, scored, risk_sum, high, own = result[:6]
+    if own:
+        own_score, own_high = own.decode().split("|") if isinstance(own, bytes) else own.split("|")
+        scored, risk_sum, high = scored - 1, risk_sum - int(own_score), high - int(own_high)
+    return {
+        "cluster_id": hmac.new(id_key, _root(result).encode(), hashlib.sha256).hexdigest()[:16],
+        "cluster_size": int(users),
+        "linked_accounts": int(users) - 1,
+        "linked_average_risk": risk_sum / scored / RISK_SCALE if scored > 0 else 0.0,
+        "linked_high_risk_accounts": int(high)
+    }
+
+
+class IdentityLinks:
+    """Union-find over user, device and IP nodes, persisted in Redis"""
+
+    def __init__(self, redis_client, prefix: str = DEFAULT_PREFIX, max_shared_accounts: int = 50):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.max_shared_accounts = max_shared_accounts
+        self.keys = [f"{prefix}parent", f"{prefix}user_risk"]
+        self.link_script = redis_client.register_script(LINK_SCRIPT)
+        self.record_risk_script = redis_client.register_script(RECORD_RISK_SCRIPT)
+        self.read_cluster_script = redis_client.register_script(READ_CLUSTER_SCRIPT)
+        self.id_key: Optional[bytes] = None
+        self.links = 0
+        self.merges = 0
+        self.saturated = 0
+
+    async def _id_key(self) -> bytes:
+        """Secret for cluster ids, created once and shared by every worker through Redis"""
+        if self.id_key is None:
+            key = f"{self.prefix}id_key"
+            await self.redis_client.set(key, secrets.token_hex(32), nx=True)
+            self.id_key = await self.redis_client.get(key)
+        return self.id_key
+
+    async def link(self, user_id: str, nodes: List[str]) -> Dict[str, Any]:
+        """Add the user's edges to the given nodes and return the user's cluster summary"""
+        result = await self.link_script(
+            keys=self.keys + [f"{self.prefix}accounts:{node}" for node in nodes],
+            args=[self.prefix, self.max_shared_accounts, user_id] + nodes
+        )
+        self.links += 1
+        self.merges += int(result[6])
+        self.saturated += int(result[7])
+        return _summary(result, await self._id_key())
+
+    async def record_risk(self, user_id: str, risk_score: float, high_risk: bool):
+        """Set the user's latest risk score in its cluster's aggregates"""
+        await self.record_risk_script(
+            keys=self.keys,
+            args=[self.prefix, user_id, round(risk_score * RISK_SCALE), int(high_risk)]
+        )
+
+    async def summary(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """The user's cluster summary without adding edges; None for an unknown user"""
+        result = await self.read_cluster_script(keys=self.keys, args=[self.prefix, user_id])
+        return _summary(result, await self._id_key()) if result is not None else None
+
+    async def cluster(self, user_id: str, limit: int = 100) -> Optional[Dict[str, Any]]:
+        """Cluster summary plus up to limit linked user ids; None for an unknown user"""
+        result = await self.read_cluster_script(keys=self.keys, args=[self.prefix, user_id])
+        if result is None:
+            return None
+
+        summary = _summary(result, await self._id_key())
+        members = set()
+        async for member in self.redis_client.sscan_iter(
+            f"{self.prefix}members:{_root(result)}", count=max(limit, 10)
+        ):
+            member = member.decode() if isinstance(member, bytes) else member
+            if member != user_id:
+                members.add(member)
+                if len(members) >= limit:
+                    break
+        summary["accounts"] = sorted(members)
+        summary["truncated"] = summary["linked_accounts"] > len(members)
+        return summary
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "links": self.links,
+            "merges": self.merges,
+            "saturated_links": self.saturated,
+            "max_shared_accounts": self.max_shared_accounts
+        }
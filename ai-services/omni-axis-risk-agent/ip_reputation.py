@@ -0,0 +1,254 @@
+"""
+IP reputation engine backed by local CIDR blocklists.
+
+Every *.txt / *.netset / *.ipset file in the blocklist directory is one
+category, named after the file stem (tor.txt -> "tor"). Lines hold an IP,
+a CIDR or a "start-end" range; "#" starts a comment.
+
+All lists are flattened into one sorted array of disjoint segments per
+address family, each carrying a bitmask of the categories that cover it,
+so a lookup is a single bisect that returns every matching category.
+"""
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+import ipaddress
+import logging
+import os
+import socket
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BLOCKLIST_EXTENSIONS = (".txt", ".netset", ".ipset")
+MAX_CATEGORIES = 32  # Segment masks are uint32
+
+
+def _parse_entry(line: str) -> Optional[Tuple[int, int, int]]:
+    """(version, first address, last address) for one blocklist line"""
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    # Fast path for the common plain IPv4 address / CIDR line
+    address, _, prefix = line.partition("/")
+    try:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+        prefix_length = int(prefix) if prefix else 32
+        if 0 <= prefix_length <= 32:
+            size = 1 << (32 - prefix_length)
+            first = value & ~(size - 1)
+            return 4, first, first + size - 1
+    except (OSError, ValueError):
+        pass
+
+    if "-" in line:
+        first, last = (ipaddress.ip_address(part.strip()) for part in line.split("-", 1))
+        if first.version != last.version or int(first) > int(last):
+            raise ValueError(f"Invalid range {line}")
+        return first.version, int(first), int(last)
+    network = ipaddress.ip_network(line, strict=False)
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def _build_segments(ranges_by_bit: Dict[int, Tuple[Sequence[int], Sequence[int]]], dtype) -> Tuple[np.ndarray, np.ndarray]:
+    """Flatten possibly overlapping ranges into disjoint (segment start, category mask) arrays"""
+    merged = {}
+    for bit, (starts, ends) in ranges_by_bit.items():
+        if not len(starts):
+            continue
+        starts = np.asarray(starts, dtype=dtype)
+        ends = np.asarray(ends, dtype=dtype)
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+
+        # A range opens a new run unless it touches or overlaps everything before it
+        reach = np.maximum.accumulate(ends)
+        opens = np.ones(len(starts), dtype=bool)
+        opens[1:] = starts[1:] > reach[:-1] + 1
+        run_ids = np.cumsum(opens) - 1
+        run_ends = np.zeros(int(run_ids[-1]) + 1, dtype=dtype)
+        np.maximum.at(run_ends, run_ids, ends)
+        merged[bit] = (starts[opens], run_ends)
+
+    if not merged:
+        return np.array([], dtype=dtype), np.array([], dtype=np.uint32)
+
+    boundaries = np.unique(np.concatenate(
+        [starts for starts, _ in merged.values()] + [ends + 1 for _, ends in merged.values()]
+    ))
+
+    masks = np.zeros(len(boundaries), dtype=np.uint32)
+    for bit, (starts, ends) in merged.items():
+        index = np.searchsorted(starts, boundaries, side="right") - 1
+        covered = (index >= 0) & (boundaries <= ends[np.maximum(index, 0)])
+        masks[covered] |= np.uint32(1 << bit)
+
+    # Drop boundaries that don't change the mask
+    keep = np.ones(len(masks), dtype=bool)
+    keep[1:] = masks[1:] != masks[:-1]
+    return boundaries[keep], masks[keep]
+
+
+class _ReputationIndex:
+    """Immutable segment arrays for both address families"""
+
+    def __init__(self, categories: List[str], v4_starts, v4_masks, v6_starts, v6_masks, entries: int):
+        self.categories = categories
+        self.v4_starts = v4_starts
+        self.v4_masks = v4_masks
+        self.v6_starts = v6_starts
+        self.v6_masks = v6_masks
+        self.entries = entries
+
+    @classmethod
+    def empty(cls) -> "_ReputationIndex":
+        return cls([], np.array([], dtype=np.uint32), np.array([], dtype=np.uint32),
+                   np.array([], dtype="S16"), np.array([], dtype=np.uint32), 0)
+
+    @classmethod
+    def from_directory(cls, directory: str) -> "_ReputationIndex":
+        files = sorted(
+            name for name in os.listdir(directory)
+            if name.endswith(BLOCKLIST_EXTENSIONS)
+        )
+        categories = []
+        # IPv4 bounds go into compact machine arrays to keep millions of entries cheap
+        v4_ranges: Dict[int, Tuple[array, array]] = {}
+        v6_ranges: Dict[int, Tuple[List[int], List[int]]] = {}
+        entries = 0
+
+        for name in files:
+            category = os.path.splitext(name)[0].lower()
+            if category not in categories:
+                if len(categories) == MAX_CATEGORIES:
+                    logger.warning(f"Ignoring blocklist {name}: more than {MAX_CATEGORIES} categories")
+                    continue
+                categories.append(category)
+            bit = categories.index(category)
+            v4 = v4_ranges.setdefault(bit, (array("Q"), array("Q")))
+            v6 = v6_ranges.setdefault(bit, ([], []))
+
+            with open(os.path.join(directory, name), encoding="utf-8", errors="replace") as f:
+                for line_number, line in enumerate(f, 1):
+                    try:
+                        entry = _parse_entry(line)
+                    except ValueError:
+                        logger.warning(f"Skipping invalid entry {name}:{line_number}")
+                        continue
+                    if entry is None:
+                        continue
+                    version, first, last = entry
+                    target = v4 if version == 4 else v6
+                    target[0].append(first)
+                    target[1].append(last)
+                    entries += 1
+
+        v4_starts, v4_masks = _build_segments(v4_ranges, np.uint64)
+        # IPv6 addresses don't fit a fixed-width integer dtype, so build on Python ints
+        v6_starts, v6_masks = _build_segments(v6_ranges, object)
+
+        # Segments starting past the address space only close the last range
+        in_range = v4_starts < 2 ** 32
+        v4_starts, v4_masks = v4_starts[in_range].astype(np.uint32), v4_masks[in_range]
+        in_range = np.array([start < 2 ** 128 for start in v6_starts], dtype=bool)
+        v6_starts = np.array([int(start).to_bytes(16, "big") for start in v6_starts[in_range]], dtype="S16")
+        v6_masks = v6_masks[in_range]
+
+        return cls(categories, v4_starts, v4_masks, v6_starts, v6_masks, entries)
+
+    def lookup(self, ip_address: str) -> List[str]:
+        ip_address = ip_address.strip()
+        try:
+            packed = socket.inet_pton(socket.AF_INET, ip_address)
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, ip_address.split("%", 1)[0])
+            except OSError:
+                return []
+            if packed[:12] == b"\0" * 10 + b"\xff\xff":
+                packed = packed[12:]
+
+        if len(packed) == 4:
+            starts, masks = self.v4_starts, self.v4_masks
+            key = np.uint32(int.from_bytes(packed, "big"))
+        else:
+            starts, masks = self.v6_starts, self.v6_masks
+            key = np.array(packed, dtype="S16")
+
+        index = int(np.searchsorted(starts, key, side="right")) - 1
+        if index < 0:
+            return []
+        mask = int(masks[index])
+        return [category for bit, category in enumerate(self.categories) if mask >> bit & 1]
+
+
+class IPReputationEngine:
+    """Blocklist index that rebuilds in a background thread when the lists change"""
+
+    def __init__(self, directory: str, refresh_interval: float = 60.0):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.rebuilds = 0
+        self._index = _ReputationIndex.empty()
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _directory_signature(self):
+        try:
+            return tuple(sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(BLOCKLIST_EXTENSIONS)
+            ))
+        except FileNotFoundError:
+            return None
+
+    def refresh(self) -> bool:
+        """Rebuild the index if the blocklists changed; returns True when swapped"""
+        signature = self._directory_signature()
+        if signature == self._signature:
+            return False
+
+        index = _ReputationIndex.from_directory(self.directory) if signature else _ReputationIndex.empty()
+        # Single reference swap; lookups in flight finish on the old index
+        self._index = index
+        self._signature = signature
+        self.rebuilds += 1
+        logger.info(f"IP reputation index built: {self.stats()}")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"IP reputation rebuild failed, keeping current index: {e}")
+
+    def start(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"IP reputation initial build failed: {e}")
+        self._thread = threading.Thread(target=self._run, name="ip-reputation-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def lookup(self, ip_address: str) -> List[str]:
+        """All blocklist categories covering the address"""
+        return self._index.lookup(ip_address)
+
+    def stats(self) -> Dict[str, object]:
+        index = self._index
+        return {
+            "categories": index.categories,
+            "entries": index.entries,
+            "ipv4_segments": len(index.v4_starts),
+            "ipv6_segments": len(index.v6_starts),
+            "index_bytes": int(index.v4_starts.nbytes + index.v4_masks.nbytes
+                               + index.v6_starts.nbytes + index.v6_masks.nbytes),
+            "rebuilds": self.rebuilds
+        }
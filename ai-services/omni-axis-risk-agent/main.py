@@ -1,19 +1,32 @@
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
 from typing import List, Optional, Dict
 import os
 import logging
 from datetime import datetime, timedelta
 import json
-import requests
+import asyncio
+import ipaddress
 
 import numpy as np
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-import joblib
-import redis
+import redis.asyncio as aioredis
+import httpx
+
+from ttl_cache import TTLCache
+from history_codec import APPEND_RECORD_LUA, RING_KEY_PREFIX, flags_to_bits, pack_record, to_epoch_us
+from geoip_db import GeoIPDatabase
+from anomaly_model import load_latest as load_anomaly_model
+from ip_reputation import IPReputationEngine
+from micro_batcher import BatcherSaturated, BatchWriteFailed, MicroBatcher
+from velocity import VelocityCounters
+from risk_rules import DEFAULT_RULES_PATH, Evaluation, RuleEngine, RuleSet, evaluate_transactions
+from result_cache import ResultCache, payload_hash
+from identity_links import IdentityLinks, link_nodes
+from risk_models import (
+    HISTORY_MAX_LENGTH, HISTORY_TTL, BatchRiskResponse, HealthResponse, IdentityCluster, RiskAssessment,
+    RiskResponse, TransactionRiskData, UserRiskData
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -37,60 +50,162 @@ app.add_middleware(
 # Security
 security = HTTPBearer()
 
-# Redis connection
-redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
+# Redis connection (async, pooled)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+redis_client = aioredis.from_url(
+    os.getenv("REDIS_URL", "redis://localhost:6379"),
+    max_connections=REDIS_MAX_CONNECTIONS
+)
+
+# Lifetime per-user aggregates, updated with every scored transaction
+RISK_STATS_EWMA_WINDOWS = (10, 100, 1000)  # Transactions; alpha = 2 / (N + 1)
+
+# Lua helper: fold one risk score into the aggregates hash at stats_key
+UPDATE_STATS_LUA = """
+local function update_stats(stats_key, score, high_threshold)
+    redis.call('HINCRBY', stats_key, 'count', 1)
+    redis.call('HINCRBYFLOAT', stats_key, 'sum', score)
+    redis.call('HINCRBYFLOAT', stats_key, 'sum_sq', score * score)
+    if score >= high_threshold then
+        redis.call('HINCRBY', stats_key, 'high_risk_count', 1)
+    end
+    for _, window in ipairs({%s}) do
+        local field = 'ewma_' .. window
+        local previous = tonumber(redis.call('HGET', stats_key, field))
+        local alpha = 2 / (window + 1)
+        local ewma = previous and (alpha * score + (1 - alpha) * previous) or score
+        redis.call('HSET', stats_key, field, string.format('%%.17g', ewma))
+    end
+end
+""" % ", ".join(str(window) for window in RISK_STATS_EWMA_WINDOWS)
+
+# Atomically record a scored transaction and update the user's aggregates.
+# KEYS: ring, stats. ARGV: capacity, ttl, high threshold, record, score
+RECORD_TRANSACTION_SCRIPT = APPEND_RECORD_LUA + UPDATE_STATS_LUA + """
+append_record(KEYS[1], ARGV[4], tonumber(ARGV[1]))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+update_stats(KEYS[2], tonumber(ARGV[5]), tonumber(ARGV[3]))
+return 1
+"""
+record_transaction_script = redis_client.register_script(RECORD_TRANSACTION_SCRIPT)
 
-# Initialize ML models
-isolation_forest = IsolationForest(contamination=0.1, random_state=42)
-scaler = StandardScaler()
+# Append one user's batch of packed records and fold their risk scores into
+# the aggregates, in order. KEYS: ring, stats, optionally one marker key per
+# record. ARGV: capacity, ttl, high threshold, n, records, scores, marker ttl.
+# A record whose marker already exists was recorded before and is skipped.
+RECORD_BATCH_SCRIPT = APPEND_RECORD_LUA + UPDATE_STATS_LUA + """
+local capacity = tonumber(ARGV[1])
+local high_threshold = tonumber(ARGV[3])
+local n = tonumber(ARGV[4])
+local recorded = 0
+for i = 1, n do
+    if #KEYS == 2 or redis.call('SET', KEYS[2 + i], 1, 'NX', 'EX', ARGV[4 + 2 * n + 1]) then
+        append_record(KEYS[1], ARGV[4 + i], capacity)
+        update_stats(KEYS[2], tonumber(ARGV[4 + n + i]), high_threshold)
+        recorded = recorded + 1
+    end
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return recorded
+"""
+record_batch_script = redis_client.register_script(RECORD_BATCH_SCRIPT)
+RECORD_MARKER_TTL = 86400  # Seconds a record marker outlives a write whose caller crashed
 
-# Risk thresholds
-RISK_THRESHOLDS = {
-    "low": 0.3,
-    "medium": 0.6,
-    "high": 0.8,
-    "critical": 0.95
+# Sliding-window velocity per user, IP and device (see velocity.py)
+VELOCITY_MAX_EVENTS = int(os.getenv("VELOCITY_MAX_EVENTS", "1000"))
+VELOCITY_MAX_CLOCK_SKEW = float(os.getenv("VELOCITY_MAX_CLOCK_SKEW", "300"))  # Seconds
+velocity_counters = VelocityCounters(
+    redis_client,
+    max_events=VELOCITY_MAX_EVENTS,
+    max_skew=VELOCITY_MAX_CLOCK_SKEW
+)
+
+# IP geolocation: in-process LRU in front of a Redis tier shared across workers
+GEO_CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", "86400"))
+GEO_NEGATIVE_CACHE_TTL = int(os.getenv("GEO_NEGATIVE_CACHE_TTL", "60"))
+GEO_CACHE_MAX_SIZE = int(os.getenv("GEO_CACHE_MAX_SIZE", "10000"))
+GEO_LOOKUP_BUDGET = float(os.getenv("GEO_LOOKUP_BUDGET", "0.25"))  # Seconds
+
+UNKNOWN_GEOLOCATION = {
+    "country": "Unknown",
+    "country_code": "XX",
+    "city": "Unknown",
+    "region": "Unknown",
+    "latitude": "0",
+    "longitude": "0"
 }
 
-# Pydantic models
-class UserRiskData(BaseModel):
-    user_id: str
-    ip_address: str
-    transaction_count: int
-    total_volume: float
-    geolocation: Optional[Dict[str, str]] = None
-    device_fingerprint: Optional[str] = None
-    kyc_status: str = "pending"
-    account_age_days: int = 0
-    failed_login_attempts: int = 0
-    suspicious_activity_count: int = 0
-
-class TransactionRiskData(BaseModel):
-    transaction_id: str
-    user_id: str
-    amount: float
-    asset_type: str
-    timestamp: datetime
-    ip_address: str
-    geolocation: Optional[Dict[str, str]] = None
-    payment_method: str
-    is_cross_border: bool = False
-
-class RiskAssessment(BaseModel):
-    risk_score: float
-    risk_level: str
-    flags: List[str]
-    recommendations: List[str]
-    confidence: float
-
-class RiskResponse(BaseModel):
-    assessment: RiskAssessment
-    timestamp: datetime
-    processing_time: float
-
-class HealthResponse(BaseModel):
-    status: str
-    timestamp: datetime
+geo_cache = TTLCache(maxsize=GEO_CACHE_MAX_SIZE, ttl=GEO_CACHE_TTL)
+geo_inflight: Dict[str, asyncio.Task] = {}
+geo_stats = {
+    "redis_hits": 0,
+    "upstream_requests": 0,
+    "upstream_errors": 0,
+    "coalesced": 0,
+    "timeouts": 0
+}
+http_client = httpx.AsyncClient(timeout=5.0)
+
+# Offline range database ("offline" backend) for nodes without outbound network
+GEO_BACKEND = os.getenv("GEO_BACKEND", "ipapi")
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", "/app/models/geoip.bin")
+geoip_db = None
+if GEO_BACKEND == "offline":
+    try:
+        geoip_db = GeoIPDatabase(GEOIP_DB_PATH)
+        logger.info(f"Offline GeoIP database loaded: {geoip_db.stats()}")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Offline GeoIP database unavailable at {GEOIP_DB_PATH}: {e}")
+
+# IP reputation blocklists (one file per category, e.g. tor.txt, vpn.txt)
+IP_REPUTATION_DIR = os.getenv("IP_REPUTATION_DIR", "/app/models/reputation")
+IP_REPUTATION_REFRESH_INTERVAL = float(os.getenv("IP_REPUTATION_REFRESH_INTERVAL", "60"))
+REPUTATION_CATEGORY_SCORES = {
+    "malicious": 0.1,
+    "tor": 0.2,
+    "proxy": 0.3,
+    "vpn": 0.4,
+    "hosting": 0.4
+}
+reputation_engine = IPReputationEngine(IP_REPUTATION_DIR, refresh_interval=IP_REPUTATION_REFRESH_INTERVAL)
+
+# Anomaly model (trained offline with `python anomaly_model.py train`)
+ANOMALY_MODEL_DIR = os.getenv("ANOMALY_MODEL_DIR", "/app/models/anomaly")
+try:
+    anomaly_model = load_anomaly_model(ANOMALY_MODEL_DIR)
+    if anomaly_model is not None:
+        logger.info(f"Anomaly model {anomaly_model.version} loaded")
+except Exception as e:
+    logger.warning(f"Failed to load anomaly model from {ANOMALY_MODEL_DIR}: {e}")
+    anomaly_model = None
+
+# Factor tables, thresholds and velocity limits (hot-reloaded, see risk_rules.py)
+RISK_RULES_PATH = os.getenv("RISK_RULES_PATH", DEFAULT_RULES_PATH)
+RISK_RULES_CHECK_INTERVAL = float(os.getenv("RISK_RULES_CHECK_INTERVAL", "5"))
+rule_engine = RuleEngine(RISK_RULES_PATH, check_interval=RISK_RULES_CHECK_INTERVAL)
+logger.info(f"Risk rules version {rule_engine.current().version} loaded from {RISK_RULES_PATH}")
+
+# Accounts linked through shared devices and public IPs (see identity_links.py)
+IDENTITY_MAX_SHARED_ACCOUNTS = int(os.getenv("IDENTITY_MAX_SHARED_ACCOUNTS", "50"))
+IDENTITY_KEY_PREFIX = os.getenv("IDENTITY_KEY_PREFIX", "identity:")  # Hash-tag it on Redis Cluster
+identity_links = IdentityLinks(
+    redis_client,
+    prefix=IDENTITY_KEY_PREFIX,
+    max_shared_accounts=IDENTITY_MAX_SHARED_ACCOUNTS
+)
+
+# /evaluate-user results, keyed on a hash of the payload and the rules version
+USER_RISK_CACHE_SCHEMA = "3"  # Bump when the cached result shape changes
+USER_RISK_CACHE_TTL = int(os.getenv("USER_RISK_CACHE_TTL", "300"))
+USER_RISK_CACHE_LOCAL_TTL = float(os.getenv("USER_RISK_CACHE_LOCAL_TTL", "30"))
+USER_RISK_CACHE_MAX_SIZE = int(os.getenv("USER_RISK_CACHE_MAX_SIZE", "10000"))
+user_risk_cache = ResultCache(
+    redis_client,
+    prefix="user_risk_cache:",
+    ttl=USER_RISK_CACHE_TTL,
+    local_ttl=USER_RISK_CACHE_LOCAL_TTL,
+    local_maxsize=USER_RISK_CACHE_MAX_SIZE
+)
 
 # Authentication dependency
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -101,278 +216,307 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
     return credentials.credentials
 
-def get_ip_geolocation(ip_address: str) -> Dict[str, str]:
-    """Get geolocation data for IP address using free service"""
+def parse_geolocation(data: Dict) -> Dict[str, str]:
+    """Normalize an ipapi.co response into our geolocation shape"""
+    return {
+        "country": data.get("country_name", "Unknown"),
+        "country_code": data.get("country_code", "XX"),
+        "city": data.get("city", "Unknown"),
+        "region": data.get("region", "Unknown"),
+        "latitude": str(data.get("latitude", 0)),
+        "longitude": str(data.get("longitude", 0))
+    }
+
+async def fetch_ip_geolocation(ip_address: str) -> Optional[Dict[str, str]]:
+    """Resolve geolocation through the Redis tier, then the external service"""
+    redis_key = f"geo:{ip_address}"
+    try:
+        cached = await redis_client.get(redis_key)
+        if cached is not None:
+            geo_stats["redis_hits"] += 1
+            return json.loads(cached)
+    except Exception as e:
+        logger.warning(f"Geolocation cache read failed for IP {ip_address}: {e}")
+
+    geo_stats["upstream_requests"] += 1
     try:
         # Use ipapi.co free service (1000 requests/day)
-        response = requests.get(f"https://ipapi.co/{ip_address}/json/", timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            return {
-                "country": data.get("country_name", "Unknown"),
-                "country_code": data.get("country_code", "XX"),
-                "city": data.get("city", "Unknown"),
-                "region": data.get("region", "Unknown"),
-                "latitude": str(data.get("latitude", 0)),
-                "longitude": str(data.get("longitude", 0))
-            }
+        response = await http_client.get(f"https://ipapi.co/{ip_address}/json/")
+        if response.status_code != 200:
+            geo_stats["upstream_errors"] += 1
+            return None
+        geo_data = parse_geolocation(response.json())
     except Exception as e:
+        geo_stats["upstream_errors"] += 1
         logger.warning(f"Failed to get geolocation for IP {ip_address}: {e}")
-    
-    return {
-        "country": "Unknown",
-        "country_code": "XX",
-        "city": "Unknown",
-        "region": "Unknown",
-        "latitude": "0",
-        "longitude": "0"
-    }
+        return None
+
+    try:
+        await redis_client.set(redis_key, json.dumps(geo_data), ex=GEO_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Geolocation cache write failed for IP {ip_address}: {e}")
+    return geo_data
+
+async def resolve_ip_geolocation(ip_address: str) -> Optional[Dict[str, str]]:
+    """Run one lookup for an IP and publish the outcome to the local cache"""
+    try:
+        geo_data = await fetch_ip_geolocation(ip_address)
+        if geo_data is not None:
+            geo_cache.set(ip_address, geo_data)
+        else:
+            # Short negative entry so a failing upstream isn't hammered
+            geo_cache.set(ip_address, UNKNOWN_GEOLOCATION, ttl=GEO_NEGATIVE_CACHE_TTL)
+        return geo_data
+    finally:
+        geo_inflight.pop(ip_address, None)
+
+async def get_ip_geolocation(ip_address: str) -> Dict[str, str]:
+    """Get geolocation data for IP address, cached and within a strict latency budget"""
+    if GEO_BACKEND == "offline":
+        geo_data = geoip_db.lookup(ip_address) if geoip_db is not None else None
+        return geo_data if geo_data is not None else dict(UNKNOWN_GEOLOCATION)
+
+    geo_data = geo_cache.get(ip_address)
+    if geo_data is not None:
+        return dict(geo_data)
+
+    # Coalesce concurrent lookups for the same IP onto one task
+    task = geo_inflight.get(ip_address)
+    if task is None:
+        task = asyncio.create_task(resolve_ip_geolocation(ip_address))
+        geo_inflight[ip_address] = task
+    else:
+        geo_stats["coalesced"] += 1
+
+    try:
+        # Shield so a timed-out caller leaves the lookup running to warm the cache
+        geo_data = await asyncio.wait_for(asyncio.shield(task), timeout=GEO_LOOKUP_BUDGET)
+    except asyncio.TimeoutError:
+        geo_stats["timeouts"] += 1
+        geo_data = None
+    except Exception as e:
+        logger.warning(f"Failed to get geolocation for IP {ip_address}: {e}")
+        geo_data = None
+
+    return dict(geo_data) if geo_data is not None else dict(UNKNOWN_GEOLOCATION)
 
 def check_ip_reputation(ip_address: str) -> Dict[str, any]:
-    """Check IP reputation using free services"""
+    """Check IP reputation against the local blocklist index"""
     try:
-        # Simple checks for common patterns
+        categories = reputation_engine.lookup(ip_address)
         reputation = {
-            "is_tor": False,
-            "is_vpn": False,
-            "is_proxy": False,
-            "is_malicious": False,
+            "is_tor": "tor" in categories,
+            "is_vpn": "vpn" in categories or "hosting" in categories,
+            "is_proxy": "proxy" in categories,
+            "is_malicious": "malicious" in categories,
+            "categories": categories,
             "reputation_score": 0.5  # Neutral by default
         }
-        
-        # Check for private/local IPs
-        if ip_address.startswith(("192.168.", "10.", "172.")) or ip_address == "127.0.0.1":
-            reputation["reputation_score"] = 0.8  # Higher trust for local IPs
-        
+
+        if categories:
+            # The worst listing wins; unknown list names count as suspicious
+            reputation["reputation_score"] = min(
+                REPUTATION_CATEGORY_SCORES.get(category, 0.3) for category in categories
+            )
+        else:
+            ip = ipaddress.ip_address(ip_address.strip())
+            if ip.is_private or ip.is_loopback:
+                reputation["reputation_score"] = 0.8  # Higher trust for local IPs
+
         return reputation
     except Exception as e:
         logger.warning(f"Failed to check IP reputation for {ip_address}: {e}")
         return {"reputation_score": 0.5}
 
-def calculate_user_risk_score(user_data: UserRiskData) -> RiskAssessment:
+async def link_user_identity(user_data: UserRiskData) -> Optional[IdentityCluster]:
+    """Add the user's device and IP edges to the linking index; None if Redis is unavailable"""
+    try:
+        cluster = await identity_links.link(
+            user_data.user_id, link_nodes(user_data.ip_address, user_data.device_fingerprint)
+        )
+        return IdentityCluster(**cluster)
+    except Exception as e:
+        logger.warning(f"Identity linking failed for user {user_data.user_id}: {e}")
+        return None
+
+async def identity_unchanged(user_id: str, cached_cluster: Optional[Dict]) -> bool:
+    """Whether the user's cluster still matches a cached one; True if Redis is unavailable"""
+    try:
+        cluster = await identity_links.summary(user_id)
+    except Exception as e:
+        logger.warning(f"Identity cluster read failed for user {user_id}: {e}")
+        return True
+    return cached_cluster == (IdentityCluster(**cluster).model_dump() if cluster is not None else None)
+
+async def calculate_user_risk_score(
+    user_data: UserRiskData,
+    identity_cluster: Optional[IdentityCluster] = None
+) -> RiskAssessment:
     """Calculate risk score for a user"""
-    flags = []
-    recommendations = []
-    risk_factors = []
-    
     # IP and geolocation analysis
     if user_data.geolocation:
         geo_data = user_data.geolocation
     else:
-        geo_data = get_ip_geolocation(user_data.ip_address)
+        geo_data = await get_ip_geolocation(user_data.ip_address)
     
     ip_reputation = check_ip_reputation(user_data.ip_address)
     
-    # Risk factor 1: IP reputation
     ip_risk = 1.0 - ip_reputation.get("reputation_score", 0.5)
-    risk_factors.append(ip_risk * 0.2)  # 20% weight
-    
-    if ip_risk > 0.7:
-        flags.append("Suspicious IP address")
-        recommendations.append("Verify user identity through additional channels")
-    
-    # Risk factor 2: Account age
-    if user_data.account_age_days < 1:
-        account_age_risk = 0.8
-        flags.append("New account (less than 1 day old)")
-        recommendations.append("Apply enhanced monitoring for new accounts")
-    elif user_data.account_age_days < 7:
-        account_age_risk = 0.6
-    elif user_data.account_age_days < 30:
-        account_age_risk = 0.3
-    else:
-        account_age_risk = 0.1
-    
-    risk_factors.append(account_age_risk * 0.15)  # 15% weight
-    
-    # Risk factor 3: Transaction patterns
-    if user_data.transaction_count > 50:
-        tx_risk = 0.7  # High frequency trading
-        flags.append("High frequency trading pattern")
-    elif user_data.transaction_count > 20:
-        tx_risk = 0.4
-    else:
-        tx_risk = 0.1
-    
-    risk_factors.append(tx_risk * 0.2)  # 20% weight
-    
-    # Risk factor 4: Volume analysis
-    if user_data.total_volume > 100000:  # $100k+
-        volume_risk = 0.6
-        flags.append("High volume transactions")
-        recommendations.append("Verify source of funds")
-    elif user_data.total_volume > 50000:
-        volume_risk = 0.4
-    else:
-        volume_risk = 0.1
-    
-    risk_factors.append(volume_risk * 0.15)  # 15% weight
-    
-    # Risk factor 5: Failed login attempts
-    if user_data.failed_login_attempts > 5:
-        login_risk = 0.8
-        flags.append("Multiple failed login attempts")
-        recommendations.append("Require password reset and 2FA")
-    elif user_data.failed_login_attempts > 2:
-        login_risk = 0.4
-    else:
-        login_risk = 0.1
-    
-    risk_factors.append(login_risk * 0.1)  # 10% weight
-    
-    # Risk factor 6: KYC status
-    if user_data.kyc_status == "rejected":
-        kyc_risk = 0.9
-        flags.append("KYC verification failed")
-        recommendations.append("Manual review required")
-    elif user_data.kyc_status == "pending":
-        kyc_risk = 0.5
-        flags.append("KYC verification pending")
-    else:
-        kyc_risk = 0.1
-    
-    risk_factors.append(kyc_risk * 0.2)  # 20% weight
-    
-    # Calculate final risk score
-    risk_score = sum(risk_factors)
-    risk_score = min(max(risk_score, 0.0), 1.0)  # Clamp between 0 and 1
-    
-    # Determine risk level
-    if risk_score >= RISK_THRESHOLDS["critical"]:
-        risk_level = "critical"
-    elif risk_score >= RISK_THRESHOLDS["high"]:
-        risk_level = "high"
-    elif risk_score >= RISK_THRESHOLDS["medium"]:
-        risk_level = "medium"
-    else:
-        risk_level = "low"
-    
-    # Add general recommendations based on risk level
-    if risk_level in ["high", "critical"]:
-        recommendations.append("Block transactions until manual review")
-        recommendations.append("Escalate to compliance team")
-    elif risk_level == "medium":
-        recommendations.append("Apply enhanced monitoring")
-        recommendations.append("Require additional verification")
-    
-    confidence = 0.8  # Base confidence, could be improved with more data
-    
+
+    # Factor tables from the current rule file (risk_rules.json)
+    evaluation = rule_engine.current().user.evaluate({
+        "ip_risk": [ip_risk],
+        "account_age_days": [user_data.account_age_days],
+        "transaction_count": [user_data.transaction_count],
+        "total_volume": [user_data.total_volume],
+        "failed_login_attempts": [user_data.failed_login_attempts],
+        "kyc_status": [user_data.kyc_status],
+        "linked_accounts": [identity_cluster.linked_accounts if identity_cluster else 0],
+        "linked_high_risk_accounts": [identity_cluster.linked_high_risk_accounts if identity_cluster else 0]
+    })
+    return build_assessment(evaluation, 0)
+
+def build_assessment(evaluation: Evaluation, i: int) -> RiskAssessment:
+    """RiskAssessment for row i of an evaluated rule table"""
     return RiskAssessment(
-        risk_score=risk_score,
-        risk_level=risk_level,
-        flags=flags,
-        recommendations=recommendations,
-        confidence=confidence
+        risk_score=float(evaluation.scores[i]),
+        risk_level=str(evaluation.risk_levels[i]),
+        flags=evaluation.flags(i),
+        recommendations=evaluation.recommendations(i),
+        confidence=evaluation.confidence
     )
 
-def calculate_transaction_risk_score(tx_data: TransactionRiskData) -> RiskAssessment:
-    """Calculate risk score for a transaction"""
-    flags = []
-    recommendations = []
-    risk_factors = []
-    
-    # Get user's recent transaction history
-    user_history_key = f"user_tx_history:{tx_data.user_id}"
-    recent_transactions = redis_client.lrange(user_history_key, 0, 9)  # Last 10 transactions
-    
-    # Risk factor 1: Transaction amount
-    if tx_data.amount > 50000:
-        amount_risk = 0.8
-        flags.append("Large transaction amount")
-        recommendations.append("Verify source of funds")
-    elif tx_data.amount > 10000:
-        amount_risk = 0.5
-    else:
-        amount_risk = 0.2
-    
-    risk_factors.append(amount_risk * 0.3)  # 30% weight
-    
-    # Risk factor 2: Transaction frequency
-    if len(recent_transactions) >= 5:  # 5+ transactions recently
-        frequency_risk = 0.7
-        flags.append("High transaction frequency")
-    elif len(recent_transactions) >= 3:
-        frequency_risk = 0.4
-    else:
-        frequency_risk = 0.1
-    
-    risk_factors.append(frequency_risk * 0.2)  # 20% weight
-    
-    # Risk factor 3: Cross-border transaction
-    if tx_data.is_cross_border:
-        cross_border_risk = 0.6
-        flags.append("Cross-border transaction")
-        recommendations.append("Verify compliance with international regulations")
-    else:
-        cross_border_risk = 0.2
-    
-    risk_factors.append(cross_border_risk * 0.15)  # 15% weight
-    
-    # Risk factor 4: Time-based analysis
-    current_hour = tx_data.timestamp.hour
-    if current_hour < 6 or current_hour > 22:  # Outside business hours
-        time_risk = 0.5
-        flags.append("Transaction outside business hours")
-    else:
-        time_risk = 0.1
-    
-    risk_factors.append(time_risk * 0.1)  # 10% weight
-    
-    # Risk factor 5: Payment method
-    if tx_data.payment_method in ["crypto", "anonymous"]:
-        payment_risk = 0.6
-        flags.append("High-risk payment method")
-    elif tx_data.payment_method in ["credit_card", "bank_transfer"]:
-        payment_risk = 0.2
-    else:
-        payment_risk = 0.3
-    
-    risk_factors.append(payment_risk * 0.15)  # 15% weight
-    
-    # Risk factor 6: Asset type
-    high_risk_assets = ["art", "luxury", "collectibles"]
-    if tx_data.asset_type in high_risk_assets:
-        asset_risk = 0.5
-        flags.append("High-risk asset type")
-    else:
-        asset_risk = 0.2
-    
-    risk_factors.append(asset_risk * 0.1)  # 10% weight
-    
-    # Calculate final risk score
-    risk_score = sum(risk_factors)
-    risk_score = min(max(risk_score, 0.0), 1.0)
-    
-    # Determine risk level
-    if risk_score >= RISK_THRESHOLDS["critical"]:
-        risk_level = "critical"
-    elif risk_score >= RISK_THRESHOLDS["high"]:
-        risk_level = "high"
-    elif risk_score >= RISK_THRESHOLDS["medium"]:
-        risk_level = "medium"
-    else:
-        risk_level = "low"
-    
-    # Store transaction in history
-    tx_record = {
-        "amount": tx_data.amount,
-        "timestamp": tx_data.timestamp.isoformat(),
-        "risk_score": risk_score
-    }
-    redis_client.lpush(user_history_key, json.dumps(tx_record))
-    redis_client.ltrim(user_history_key, 0, 19)  # Keep last 20 transactions
-    redis_client.expire(user_history_key, 86400 * 30)  # Expire after 30 days
-    
-    confidence = 0.75
-    
-    return RiskAssessment(
-        risk_score=risk_score,
-        risk_level=risk_level,
-        flags=flags,
-        recommendations=recommendations,
-        confidence=confidence
+async def score_transactions(transactions: List[TransactionRiskData], rules: RuleSet) -> List[RiskAssessment]:
+    """
+    Score transactions with the transaction rule table. A single request and
+    a batch take the same path, so a transaction scores the same either way.
+    Records the transactions in the velocity windows.
+    """
+    counts, amounts = await velocity_counters.observe([
+        (tx.transaction_id, tx.user_id, tx.ip_address, tx.device_fingerprint, tx.amount, tx.timestamp)
+        for tx in transactions
+    ])
+    epoch_us = np.array([to_epoch_us(tx.timestamp) for tx in transactions], dtype=np.int64)
+    evaluation = evaluate_transactions(
+        rules,
+        {
+            "amount": [tx.amount for tx in transactions],
+            "is_cross_border": [tx.is_cross_border for tx in transactions],
+            # Hour as submitted, in the timestamp's own offset; the anomaly features use UTC
+            "hour": [tx.timestamp.hour for tx in transactions],
+            "payment_method": [tx.payment_method for tx in transactions],
+            "asset_type": [tx.asset_type for tx in transactions]
+        },
+        epoch_us,
+        counts,
+        amounts,
+        anomaly_model
+    )
+    return [build_assessment(evaluation, i) for i in range(len(transactions))]
+
+def history_record(tx_data: TransactionRiskData, assessment: RiskAssessment) -> bytes:
+    """Packed transaction history entry"""
+    return pack_record(tx_data.amount, tx_data.timestamp, assessment.risk_score, flags_to_bits(assessment.flags))
+
+async def calculate_transaction_risk_score(tx_data: TransactionRiskData) -> RiskAssessment:
+    """Calculate risk score for a transaction and record it in the user's history"""
+    rules = rule_engine.current()
+    assessment = (await score_transactions([tx_data], rules))[0]
+
+    await record_transaction_script(
+        keys=[f"{RING_KEY_PREFIX}{tx_data.user_id}", f"user_risk_stats:{tx_data.user_id}"],
+        args=[HISTORY_MAX_LENGTH, HISTORY_TTL, rules.thresholds["high"],
+              history_record(tx_data, assessment), repr(assessment.risk_score)]
     )
 
+    return assessment
+
+async def store_batch_history(
+    transactions: List[TransactionRiskData],
+    assessments: List[RiskAssessment],
+    high_threshold: float,
+    record_markers: Optional[List[str]] = None
+):
+    """
+    Append a scored batch to the users' transaction histories in one round
+    trip. With record_markers (one Redis key per transaction), a transaction
+    is recorded only if its marker does not exist yet, and the marker is set.
+    """
+    user_records: Dict[str, List[bytes]] = {}
+    user_scores: Dict[str, List[str]] = {}
+    user_markers: Dict[str, List[str]] = {}
+    for i, (tx_data, assessment) in enumerate(zip(transactions, assessments)):
+        user_records.setdefault(tx_data.user_id, []).append(history_record(tx_data, assessment))
+        user_scores.setdefault(tx_data.user_id, []).append(repr(assessment.risk_score))
+        if record_markers is not None:
+            user_markers.setdefault(tx_data.user_id, []).append(record_markers[i])
+
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id, records in user_records.items():
+        await record_batch_script(
+            keys=[f"{RING_KEY_PREFIX}{user_id}", f"user_risk_stats:{user_id}"] + user_markers.get(user_id, []),
+            args=[HISTORY_MAX_LENGTH, HISTORY_TTL, high_threshold, len(records)]
+                + records + user_scores[user_id] + [RECORD_MARKER_TTL],
+            client=pipe
+        )
+
+    await pipe.execute()
+
+async def calculate_transaction_risk_scores_batch(
+    transactions: List[TransactionRiskData],
+    record_markers: Optional[List[str]] = None
+) -> List[RiskAssessment]:
+    """
+    Batch counterpart of calculate_transaction_risk_score: scores the whole
+    batch in one vectorized evaluation and stores it in one round trip.
+    record_markers make the history writes idempotent (see store_batch_history).
+    Without them a failed history write raises BatchWriteFailed: some users'
+    records may already be stored, so the batch must not be retried item by
+    item. Scoring only touches the velocity windows, which are keyed on
+    transaction id, so a failure before the history write is safe to retry.
+    """
+    if not transactions:
+        return []
+
+    rules = rule_engine.current()
+    assessments = await score_transactions(transactions, rules)
+    try:
+        await store_batch_history(transactions, assessments, rules.thresholds["high"], record_markers)
+    except Exception as e:
+        if record_markers is not None:
+            raise
+        raise BatchWriteFailed(f"History write failed: {e}") from e
+
+    return assessments
+
+# Concurrent /evaluate-transaction calls are grouped into vectorized batches;
+# a window of 0 scores every request on its own
+MICRO_BATCH_WINDOW_MS = float(os.getenv("MICRO_BATCH_WINDOW_MS", "2"))
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", "128"))
+MICRO_BATCH_MAX_INFLIGHT = int(os.getenv("MICRO_BATCH_MAX_INFLIGHT", "4"))
+MICRO_BATCH_MAX_PENDING = int(os.getenv("MICRO_BATCH_MAX_PENDING", "2048"))  # Waiting requests before 429
+transaction_batcher = MicroBatcher(
+    calculate_transaction_risk_scores_batch,
+    max_wait=MICRO_BATCH_WINDOW_MS / 1000,
+    max_batch_size=MICRO_BATCH_MAX_SIZE,
+    max_inflight_batches=MICRO_BATCH_MAX_INFLIGHT,
+    max_pending=MICRO_BATCH_MAX_PENDING
+) if MICRO_BATCH_WINDOW_MS > 0 else None
+
+@app.on_event("startup")
+async def start_background_services():
+    reputation_engine.start()
+    user_risk_cache.start()
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    reputation_engine.stop()
+    await user_risk_cache.stop()
+    if transaction_batcher is not None:
+        await transaction_batcher.stop()
+    await http_client.aclose()
+    await redis_client.aclose()
+
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint"""
@@ -394,15 +538,44 @@ async def evaluate_user_risk(
     try:
         logger.info(f"Evaluating risk for user {user_data.user_id}")
         
-        # Calculate risk assessment
-        assessment = calculate_user_risk_score(user_data)
+        # Identical payloads under the same rules get the same assessment as
+        # long as the user's identity cluster is unchanged. The same payload
+        # adds the same edges, but other accounts may have joined the cluster
+        # or been scored again since; then the hit is scored again.
+        rules = rule_engine.current()
+        cache_key = payload_hash(user_data.model_dump(mode="json"), salt=f"{USER_RISK_CACHE_SCHEMA}:{rules.version}")
+        cached = await user_risk_cache.get(user_data.user_id, cache_key)
+        if cached is not None and await identity_unchanged(user_data.user_id, cached["identity_cluster"]):
+            return RiskResponse(
+                assessment=RiskAssessment(**cached["assessment"]),
+                identity_cluster=cached["identity_cluster"],
+                timestamp=datetime.now(),
+                processing_time=(datetime.now() - start_time).total_seconds(),
+                cached=True
+            )
+        
+        # Link shared devices and IPs, then score with the cluster as input
+        identity_cluster = await link_user_identity(user_data)
+        assessment = await calculate_user_risk_score(user_data, identity_cluster)
+        if identity_cluster is not None:
+            try:
+                await identity_links.record_risk(
+                    user_data.user_id, assessment.risk_score, assessment.risk_score >= rules.thresholds["high"]
+                )
+            except Exception as e:
+                logger.warning(f"Failed to record cluster risk for user {user_data.user_id}: {e}")
         
         processing_time = (datetime.now() - start_time).total_seconds()
+        await user_risk_cache.set(user_data.user_id, cache_key, {
+            "assessment": assessment.model_dump(),
+            "identity_cluster": identity_cluster.model_dump() if identity_cluster is not None else None
+        }, processing_time)
         
         logger.info(f"User risk evaluation completed: {assessment.risk_level} ({assessment.risk_score:.3f})")
         
         return RiskResponse(
             assessment=assessment,
+            identity_cluster=identity_cluster,
             timestamp=datetime.now(),
             processing_time=processing_time
         )
@@ -414,6 +587,48 @@ async def evaluate_user_risk(
             detail="Failed to evaluate user risk"
         )
 
+@app.delete("/evaluate-user/cache/{user_id}")
+async def invalidate_user_risk_cache(
+    user_id: str,
+    token: str = Depends(verify_token)
+):
+    """Drop cached /evaluate-user results for a user on every worker"""
+    try:
+        await user_risk_cache.invalidate(user_id)
+        return {"user_id": user_id, "invalidated": True}
+    except Exception as e:
+        logger.error(f"Error invalidating user risk cache: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to invalidate user risk cache"
+        )
+
+@app.get("/linked-accounts/{user_id}")
+async def get_linked_accounts(
+    user_id: str,
+    limit: int = 100,
+    token: str = Depends(verify_token)
+):
+    """Accounts linked to a user through shared devices or IP addresses"""
+    try:
+        cluster = await identity_links.cluster(user_id, limit=max(1, min(limit, 1000)))
+    except Exception as e:
+        logger.error(f"Error getting linked accounts: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to get linked accounts"
+        )
+
+    if cluster is None:
+        return {
+            "user_id": user_id,
+            "cluster_size": 0,
+            "linked_accounts": 0,
+            "accounts": [],
+            "truncated": False
+        }
+    return {"user_id": user_id, **cluster}
+
 @app.post("/evaluate-transaction", response_model=RiskResponse)
 async def evaluate_transaction_risk(
     tx_data: TransactionRiskData,
@@ -428,7 +643,10 @@ async def evaluate_transaction_risk(
         logger.info(f"Evaluating transaction risk for {tx_data.transaction_id}")
         
         # Calculate risk assessment
-        assessment = calculate_transaction_risk_score(tx_data)
+        if transaction_batcher is not None:
+            assessment = await transaction_batcher.submit(tx_data)
+        else:
+            assessment = await calculate_transaction_risk_score(tx_data)
         
         processing_time = (datetime.now() - start_time).total_seconds()
         
@@ -440,6 +658,12 @@ async def evaluate_transaction_risk(
             processing_time=processing_time
         )
         
+    except BatcherSaturated:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many transactions waiting to be scored, retry later",
+            headers={"Retry-After": "1"}
+        )
     except Exception as e:
         logger.error(f"Error evaluating transaction risk: {e}")
         raise HTTPException(
@@ -447,17 +671,51 @@ async def evaluate_transaction_risk(
             detail="Failed to evaluate transaction risk"
         )
 
+@app.post("/evaluate-transactions/batch", response_model=BatchRiskResponse)
+async def evaluate_transaction_risk_batch(
+    transactions: List[TransactionRiskData],
+    token: str = Depends(verify_token)
+):
+    """
+    Evaluate risk scores for a batch of transactions in one request
+    """
+    start_time = datetime.now()
+
+    try:
+        logger.info(f"Evaluating transaction risk for batch of {len(transactions)}")
+
+        assessments = await calculate_transaction_risk_scores_batch(transactions)
+
+        processing_time = (datetime.now() - start_time).total_seconds()
+        throughput = len(transactions) / processing_time if processing_time > 0 else 0.0
+
+        logger.info(f"Batch risk evaluation completed: {len(transactions)} transactions in {processing_time:.3f}s ({throughput:.0f} tx/s)")
+
+        return BatchRiskResponse(
+            assessments=assessments,
+            count=len(assessments),
+            timestamp=datetime.now(),
+            processing_time=processing_time,
+            throughput=throughput
+        )
+
+    except Exception as e:
+        logger.error(f"Error evaluating transaction batch risk: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to evaluate transaction batch risk"
+        )
+
 @app.get("/risk-stats/{user_id}")
 async def get_user_risk_stats(
     user_id: str,
     token: str = Depends(verify_token)
 ):
-    """Get risk statistics for a user"""
+    """Get lifetime risk statistics for a user from the running aggregates"""
     try:
-        history_key = f"user_tx_history:{user_id}"
-        transactions = redis_client.lrange(history_key, 0, -1)
+        stats = await redis_client.hgetall(f"user_risk_stats:{user_id}")
         
-        if not transactions:
+        if not stats:
             return {
                 "user_id": user_id,
                 "transaction_count": 0,
@@ -465,23 +723,22 @@ async def get_user_risk_stats(
                 "high_risk_transactions": 0
             }
         
-        risk_scores = []
-        high_risk_count = 0
-        
-        for tx_json in transactions:
-            tx_data = json.loads(tx_json)
-            risk_score = tx_data.get("risk_score", 0.0)
-            risk_scores.append(risk_score)
-            
-            if risk_score >= RISK_THRESHOLDS["high"]:
-                high_risk_count += 1
+        stats = {key.decode(): float(value) for key, value in stats.items()}
+        count = int(stats["count"])
+        mean = stats["sum"] / count
+        variance = max(stats["sum_sq"] / count - mean * mean, 0.0)
+        ewma = {str(window): stats[f"ewma_{window}"] for window in RISK_STATS_EWMA_WINDOWS}
+        short_ewma = ewma[str(RISK_STATS_EWMA_WINDOWS[0])]
+        long_ewma = ewma[str(RISK_STATS_EWMA_WINDOWS[-1])]
         
         return {
             "user_id": user_id,
-            "transaction_count": len(transactions),
-            "average_risk_score": np.mean(risk_scores) if risk_scores else 0.0,
-            "high_risk_transactions": high_risk_count,
-            "risk_trend": "increasing" if len(risk_scores) > 1 and risk_scores[0] > risk_scores[-1] else "stable"
+            "transaction_count": count,
+            "average_risk_score": mean,
+            "risk_score_std": variance ** 0.5,
+            "high_risk_transactions": int(stats.get("high_risk_count", 0)),
+            "ewma_risk_score": ewma,
+            "risk_trend": "increasing" if short_ewma > long_ewma + 1e-9 else "stable"
         }
         
     except Exception as e:
@@ -491,6 +748,26 @@ async def get_user_risk_stats(
             detail="Failed to get risk statistics"
         )
 
+@app.get("/metrics")
+async def get_metrics(token: str = Depends(verify_token)):
+    """Cache and lookup counters for this worker"""
+    return {
+        "geolocation": {
+            "local_cache": geo_cache.stats(),
+            "inflight": len(geo_inflight),
+            "backend": GEO_BACKEND,
+            "offline_database": geoip_db.stats() if geoip_db is not None else None,
+            **geo_stats
+        },
+        "ip_reputation": reputation_engine.stats(),
+        "anomaly_model": anomaly_model.version if anomaly_model is not None else None,
+        "risk_rules": rule_engine.stats(),
+        "user_risk_cache": user_risk_cache.stats(),
+        "identity_links": identity_links.stats(),
+        "micro_batching": transaction_batcher.stats() if transaction_batcher is not None else None,
+        "timestamp": datetime.now()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
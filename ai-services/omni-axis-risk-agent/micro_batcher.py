@@ -0,0 +1,225 @@
+"""
+In-process micro-batching for request/response scoring.
+
+Concurrent callers submit single items; items that arrive within a short
+window (or until the batch is full) are handed to one vectorized batch
+function and every caller's future is resolved with its own result.
+
+The window trades a bounded amount of added latency for fewer, larger
+batches; stats() reports queue depth, batch sizes and the time items spent
+waiting so the window can be tuned against p99.
+
+At most max_pending items wait for a batch; past that, submit() raises
+BatcherSaturated instead of letting the queue grow without bound. If a
+batch fails before it writes anything, its items are retried one per
+call, so one bad item fails only its own caller. A batch function whose
+writes are not idempotent raises BatchWriteFailed once it has started
+writing; that batch fails as a whole, since a retry could apply its
+writes twice.
+"""
+from bisect import bisect_left
+from typing import Awaitable, Callable, Dict, Generic, List, Optional, Set, Tuple, TypeVar
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Upper bounds of the added-latency histogram, in milliseconds
+WAIT_BUCKETS_MS = (0.5, 1.0, 2.0, 5.0, 10.0, 25.0, 50.0, 100.0)
+
+
+class BatcherSaturated(Exception):
+    """max_pending items are already waiting for a batch"""
+
+
+class BatchWriteFailed(Exception):
+    """The batch failed after it started writing; its items must not be retried"""
+
+
+class MicroBatcher(Generic[T, R]):
+    """Groups concurrent submit() calls into calls of process_batch"""
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[T]], Awaitable[List[R]]],
+        max_wait: float = 0.002,
+        max_batch_size: int = 128,
+        max_inflight_batches: int = 4,
+        max_pending: int = 2048
+    ):
+        self.process_batch = process_batch
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_inflight_batches = max_inflight_batches
+        self.max_pending = max_pending
+
+        self._pending: List[Tuple[T, asyncio.Future, float]] = []
+        self._arrived: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+        # Power-of-two batch size buckets up to max_batch_size
+        self._size_bounds = []
+        bound = 1
+        while bound < max_batch_size:
+            self._size_bounds.append(bound)
+            bound *= 2
+        self._size_bounds.append(max_batch_size)
+        self._size_counts = [0] * len(self._size_bounds)
+        self._wait_counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self.failed_items = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.process_seconds_total = 0.0
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._arrived = asyncio.Event()
+            self._full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_inflight_batches)
+            self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, item: T) -> R:
+        """Queue one item and wait for its result from the next batch"""
+        self._ensure_started()
+        if len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            raise BatcherSaturated(f"{len(self._pending)} items already waiting")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future, time.perf_counter()))
+        self._arrived.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._arrived.wait()
+            # The window runs from the oldest queued item's arrival
+            remaining = self._pending[0][2] + self.max_wait - time.perf_counter()
+            if len(self._pending) < self.max_batch_size and remaining > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            # Back-pressure: items keep accumulating while all slots are busy
+            await self._slots.acquire()
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            if not self._pending:
+                self._arrived.clear()
+            if len(self._pending) < self.max_batch_size:
+                self._full.clear()
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[Tuple[T, asyncio.Future, float]]):
+        started = time.perf_counter()
+        try:
+            for _, _, submitted in batch:
+                self._record_wait(started - submitted)
+            self._size_counts[bisect_left(self._size_bounds, len(batch))] += 1
+            self.batches += 1
+            self.items += len(batch)
+
+            try:
+                results = await self.process_batch([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    # The batch ran to completion, writes included
+                    raise BatchWriteFailed(f"Batch of {len(batch)} produced {len(results)} results")
+            except Exception as e:
+                self.failed_batches += 1
+                logger.error(f"Micro-batch of {len(batch)} failed: {e}")
+                if len(batch) == 1 or isinstance(e, BatchWriteFailed):
+                    for _, future, _ in batch:
+                        self._fail(future, e)
+                    return
+                # Retry one item per call so the failure stays with the item that caused it
+                results = await asyncio.gather(
+                    *(self.process_batch([item]) for item, _, _ in batch), return_exceptions=True
+                )
+                for (_, future, _), result in zip(batch, results):
+                    if isinstance(result, BaseException):
+                        self._fail(future, result)
+                    elif len(result) != 1:
+                        self._fail(future, RuntimeError(f"Batch of 1 produced {len(result)} results"))
+                    elif not future.done():
+                        future.set_result(result[0])
+                return
+
+            # Callers that gave up (e.g. client disconnects) are simply skipped
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.process_seconds_total += time.perf_counter() - started
+            self._slots.release()
+
+    def _fail(self, future: asyncio.Future, error: BaseException):
+        self.failed_items += 1
+        if not future.done():
+            future.set_exception(error)
+
+    def _record_wait(self, seconds: float):
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        self._wait_counts[bisect_left(WAIT_BUCKETS_MS, seconds * 1000)] += 1
+
+    async def stop(self):
+        """Stop batching; items still queued are scored before returning"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            await self._slots.acquire()
+            await self._dispatch(batch)
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def stats(self) -> Dict[str, object]:
+        wait_labels = [f"le_{bound:g}ms" for bound in WAIT_BUCKETS_MS] + ["inf"]
+        return {
+            "window_ms": self.max_wait * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": len(self._pending),
+            "inflight_batches": len(self._inflight),
+            "batches": self.batches,
+            "items": self.items,
+            "failed_batches": self.failed_batches,
+            "failed_items": self.failed_items,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "average_batch_size": self.items / self.batches if self.batches else 0.0,
+            "batch_size_histogram": {
+                f"le_{bound}": count for bound, count in zip(self._size_bounds, self._size_counts)
+            },
+            "added_latency_ms": {
+                "average": self.wait_seconds_total / self.items * 1000 if self.items else 0.0,
+                "max": self.wait_seconds_max * 1000,
+                "histogram": dict(zip(wait_labels, self._wait_counts))
+            },
+            "average_batch_processing_ms": (
+                self.process_seconds_total / self.batches * 1000 if self.batches else 0.0
+            )
+        }
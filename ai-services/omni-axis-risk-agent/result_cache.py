@@ -0,0 +1,166 @@
+"""
+Two-tier cache for endpoint results keyed on a hash of the request payload.
+
+Each result is its own Redis string, <prefix>{<owner>}:<payload hash>, with
+its own expiry, so an owner (e.g. a user_id) who stays active does not
+collect stale results. An owner's results are stamped with its generation,
+<prefix>{<owner>}:gen; invalidating the owner is a single INCR, after which
+the older results no longer match and simply expire. The generation key
+is refreshed with every write, so it outlives every result stamped with it.
+The owner sits in a hash tag, so its keys share a Redis Cluster slot.
+
+Each worker keeps the owner's most recently used result in an in-process
+TTLCache in front of Redis; invalidations are published on a channel so
+every worker drops its local copy too.
+"""
+from typing import Any, Dict, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# KEYS: generation, entry. ARGV: value, ttl.
+# Stores the value stamped with the owner's current generation ("<gen>|<value>").
+SET_SCRIPT = """
+local generation = redis.call('GET', KEYS[1]) or '0'
+redis.call('SET', KEYS[2], generation .. '|' .. ARGV[1], 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def payload_hash(payload: Dict[str, Any], salt: str = "") -> str:
+    """SHA-256 of the canonical JSON form of a payload"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{salt}\n{canonical}".encode()).hexdigest()
+
+
+class ResultCache:
+    """In-process + Redis cache of JSON-serializable results with hit and latency counters"""
+
+    def __init__(self, redis_client, prefix: str, ttl: int, local_ttl: float = 30.0, local_maxsize: int = 10000):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.channel = f"{prefix}invalidate"
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.local = TTLCache(maxsize=local_maxsize, ttl=local_ttl)
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+        self.latency_saved = 0.0
+        self._listener: Optional[asyncio.Task] = None
+        self.set_script = redis_client.register_script(SET_SCRIPT)
+
+    def _generation_key(self, owner: str) -> str:
+        return f"{self.prefix}{{{owner}}}:gen"
+
+    def _entry_key(self, owner: str, key: str) -> str:
+        return f"{self.prefix}{{{owner}}}:{key}"
+
+    async def get(self, owner: str, key: str) -> Optional[Any]:
+        """Cached result for the owner's payload hash, or None on a miss"""
+        started = time.perf_counter()
+        entry = self.local.get(owner)
+        if entry is not None and entry[0] == key:
+            self.local_hits += 1
+            return self._hit(entry[1], started)
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(self._generation_key(owner))
+            pipe.get(self._entry_key(owner, key))
+            generation, raw = await pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Result cache read failed for {owner}: {e}")
+            generation, raw = None, None
+        stamp, _, data = (raw or b"").partition(b"|")
+        # Results from before the owner's last invalidation no longer match
+        if raw is not None and stamp == (generation or b"0"):
+            value = json.loads(data)
+            remaining = value["expires_at"] - time.time()
+            if remaining > 0:
+                self.local.set(owner, (key, value), ttl=min(self.local_ttl, remaining))
+                self.redis_hits += 1
+                return self._hit(value, started)
+
+        self.misses += 1
+        return None
+
+    def _hit(self, value: Dict[str, Any], started: float) -> Any:
+        self.latency_saved += max(value["compute_seconds"] - (time.perf_counter() - started), 0.0)
+        return value["result"]
+
+    async def set(self, owner: str, key: str, result: Any, compute_seconds: float):
+        value = {"result": result, "compute_seconds": compute_seconds, "expires_at": time.time() + self.ttl}
+        self.local.set(owner, (key, value))
+        try:
+            await self.set_script(
+                keys=[self._generation_key(owner), self._entry_key(owner, key)],
+                args=[json.dumps(value), self.ttl]
+            )
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Result cache write failed for {owner}: {e}")
+
+    async def invalidate(self, owner: str):
+        """Drop every cached result for the owner, on all workers"""
+        self.local.delete(owner)
+        self.invalidations += 1
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.incr(self._generation_key(owner))
+        pipe.expire(self._generation_key(owner), self.ttl)
+        pipe.publish(self.channel, owner)
+        await pipe.execute()
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    owner = message["data"]
+                    self.local.delete(owner.decode() if isinstance(owner, bytes) else owner)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Entries still expire after local_ttl while the channel is down
+                logger.warning(f"Result cache invalidation listener failed, retrying: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self):
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.local_hits + self.redis_hits
+        lookups = hits + self.misses
+        return {
+            "local_size": len(self.local),
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+            "latency_saved_seconds": self.latency_saved,
+            "average_latency_saved_ms": self.latency_saved / hits * 1000 if hits else 0.0
+        }
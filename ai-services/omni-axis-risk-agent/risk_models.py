@@ -0,0 +1,76 @@
+"""
+Request and response models and history settings shared by the risk agent
+service and its offline tools (stream worker, model training, history
+migration). Importing this module has no side effects.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# Transaction history
+HISTORY_MAX_LENGTH = 20  # Transactions kept per user
+HISTORY_TTL = 86400 * 30  # Expire after 30 days
+
+
+class UserRiskData(BaseModel):
+    user_id: str
+    ip_address: str
+    transaction_count: int
+    total_volume: float
+    geolocation: Optional[Dict[str, str]] = None
+    device_fingerprint: Optional[str] = None
+    kyc_status: str = "pending"
+    account_age_days: int = 0
+    failed_login_attempts: int = 0
+    suspicious_activity_count: int = 0
+
+
+class TransactionRiskData(BaseModel):
+    transaction_id: str
+    user_id: str
+    amount: float
+    asset_type: str
+    timestamp: datetime
+    ip_address: str
+    geolocation: Optional[Dict[str, str]] = None
+    payment_method: str
+    is_cross_border: bool = False
+    device_fingerprint: Optional[str] = None
+
+
+class RiskAssessment(BaseModel):
+    risk_score: float
+    risk_level: str
+    flags: List[str]
+    recommendations: List[str]
+    confidence: float
+
+
+class IdentityCluster(BaseModel):
+    cluster_id: str  # Opaque; changes when the cluster merges with another one
+    cluster_size: int  # Accounts in the cluster, including this one
+    linked_accounts: int
+    linked_average_risk: float  # Mean latest risk score of the scored linked accounts
+    linked_high_risk_accounts: int
+
+
+class RiskResponse(BaseModel):
+    assessment: RiskAssessment
+    timestamp: datetime
+    processing_time: float
+    cached: bool = False  # Served from the result cache
+    identity_cluster: Optional[IdentityCluster] = None  # /evaluate-user only
+
+
+class BatchRiskResponse(BaseModel):
+    assessments: List[RiskAssessment]  # Same order as the submitted transactions
+    count: int
+    timestamp: datetime
+    processing_time: float
+    throughput: float  # Transactions scored per second
+
+
+class HealthResponse(BaseModel):
+    status: str
+    timestamp: datetime
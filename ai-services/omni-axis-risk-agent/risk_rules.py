@@ -0,0 +1,309 @@
+"""
+Declarative risk rule tables.
+
+The factor tables for user and transaction scoring live in a versioned
+JSON file (risk_rules.json next to this module by default). Each factor
+maps one input to a level, either with numeric breakpoints, evaluated with
+np.digitize exactly like a ladder of `<` (right=false) or `>` (right=true)
+comparisons, or with a category -> level map. Every level has a score (or
+"input" to use the input value itself), flags and recommendations, and
+the factor contributes score * weight.
+
+Tables are compiled into NumPy arrays and always evaluated on arrays, so a
+single request and a batch go through the same code. RuleEngine reloads
+the file when it changes and swaps the compiled RuleSet in one
+assignment; a request keeps using the RuleSet it started with.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from anomaly_model import transaction_features
+from velocity import DIMENSIONS, VELOCITY_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "risk_rules.json")
+RISK_LEVELS = ("low", "medium", "high", "critical")
+
+FlagMasks = List[Tuple[str, np.ndarray]]
+
+# Rule flags the anomaly model uses as features
+HIGH_RISK_PAYMENT_FLAG = "High-risk payment method"
+HIGH_RISK_ASSET_FLAG = "High-risk asset type"
+
+
+class _Factor:
+    """One compiled factor: input -> level -> score, flags, recommendations"""
+
+    def __init__(self, spec: Dict):
+        self.name = spec["name"]
+        self.input = spec["input"]
+        self.weight = float(spec["weight"])
+        levels = spec["levels"]
+        if not levels:
+            raise ValueError(f"Factor {self.name} has no levels")
+
+        self.categories: Optional[Dict[str, int]] = spec.get("categories")
+        if self.categories is not None:
+            self.default_level = int(spec.get("default_level", 0))
+            level_ids = list(self.categories.values()) + [self.default_level]
+            if min(level_ids) < 0 or max(level_ids) >= len(levels):
+                raise ValueError(f"Factor {self.name} maps a category to a missing level")
+        else:
+            self.breakpoints = np.asarray(spec["breakpoints"], dtype=np.float64)
+            self.right = bool(spec.get("right", False))
+            if len(levels) != len(self.breakpoints) + 1:
+                raise ValueError(f"Factor {self.name} needs one more level than breakpoints")
+            if np.any(np.diff(self.breakpoints) <= 0):
+                raise ValueError(f"Factor {self.name} breakpoints must be increasing")
+
+        # NaN marks levels that score the input value itself
+        self.scores = np.array([
+            np.nan if level["score"] == "input" else float(level["score"]) for level in levels
+        ])
+        self.flags = [tuple(level.get("flags", ())) for level in levels]
+        self.recommendations = [tuple(level.get("recommendations", ())) for level in levels]
+
+    def levels(self, values) -> np.ndarray:
+        if self.categories is not None:
+            return np.fromiter(
+                (self.categories.get(value, self.default_level) for value in values),
+                dtype=np.int64, count=len(values)
+            )
+        return np.digitize(np.asarray(values, dtype=np.float64), self.breakpoints, right=self.right)
+
+    def contributions(self, values, levels: np.ndarray) -> np.ndarray:
+        scores = self.scores[levels]
+        if np.isnan(self.scores).any():
+            scores = np.where(np.isnan(scores), np.asarray(values, dtype=np.float64), scores)
+        return scores * self.weight
+
+
+class Evaluation:
+    """Scores, risk levels and per-row flags for one evaluated batch"""
+
+    def __init__(self, table: "_Table", scores: np.ndarray, risk_levels: np.ndarray,
+                 factor_levels: List[np.ndarray], extra_flags: Dict[str, FlagMasks]):
+        self.table = table
+        self.scores = scores
+        self.risk_levels = risk_levels
+        self.factor_levels = factor_levels
+        self.extra_flags = extra_flags
+        self.confidence = table.confidence
+
+    def flags(self, i: int) -> List[str]:
+        flags = []
+        for factor, levels in zip(self.table.factors, self.factor_levels):
+            flags.extend(factor.flags[levels[i]])
+            for flag, mask in self.extra_flags.get(factor.name, ()):
+                if mask[i]:
+                    flags.append(flag)
+        return flags
+
+    def flag_lists(self) -> List[List[str]]:
+        """flags(i) for every row, built once per distinct combination of levels and flag masks"""
+        # One mixed-radix code per row over every factor level and flag mask
+        codes = np.zeros(len(self.scores), dtype=np.int64)
+        for factor, levels in zip(self.table.factors, self.factor_levels):
+            codes = codes * len(factor.scores) + levels
+            for _, mask in self.extra_flags.get(factor.name, ()):
+                codes = codes * 2 + mask
+        _, first_rows, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        flag_lists = [self.flags(i) for i in first_rows]
+        return [flag_lists[k] for k in inverse]
+
+    def recommendations(self, i: int) -> List[str]:
+        recommendations = []
+        for factor, levels in zip(self.table.factors, self.factor_levels):
+            recommendations.extend(factor.recommendations[levels[i]])
+        recommendations.extend(self.table.level_recommendations.get(str(self.risk_levels[i]), ()))
+        return recommendations
+
+
+class _Table:
+    def __init__(self, spec: Dict, level_breakpoints: np.ndarray):
+        self.factors = [_Factor(factor) for factor in spec["factors"]]
+        self.confidence = float(spec["confidence"])
+        self.level_recommendations = {
+            level: tuple(recommendations)
+            for level, recommendations in spec.get("level_recommendations", {}).items()
+        }
+        unknown = set(self.level_recommendations) - set(RISK_LEVELS)
+        if unknown:
+            raise ValueError(f"Unknown risk levels {sorted(unknown)}")
+        self.level_breakpoints = level_breakpoints
+        self.inputs = [factor.input for factor in self.factors]
+
+    def evaluate(self, inputs: Dict[str, Sequence], extra_flags: Optional[Dict[str, FlagMasks]] = None) -> Evaluation:
+        """Score every row of the input columns; extra_flags are listed after a factor's own flags"""
+        n = len(inputs[self.inputs[0]])
+        scores = np.zeros(n, dtype=np.float64)
+        factor_levels = []
+        # Factors are summed in table order, so a row scores the same in any batch
+        for factor in self.factors:
+            values = inputs[factor.input]
+            levels = factor.levels(values)
+            scores += factor.contributions(values, levels)
+            factor_levels.append(levels)
+        scores = np.clip(scores, 0.0, 1.0)
+
+        risk_levels = np.array(RISK_LEVELS)[np.digitize(scores, self.level_breakpoints)]
+        return Evaluation(self, scores, risk_levels, factor_levels, extra_flags or {})
+
+    def flag_mask(self, flag: str, inputs: Dict[str, Sequence]) -> np.ndarray:
+        """Rows whose factor levels raise the given flag"""
+        n = len(inputs[self.inputs[0]])
+        mask = np.zeros(n, dtype=bool)
+        for factor in self.factors:
+            flagged = [flag in level_flags for level_flags in factor.flags]
+            if any(flagged):
+                mask |= np.asarray(flagged)[factor.levels(inputs[factor.input])]
+        return mask
+
+
+class _VelocityRules:
+    """(elevated, high) limits per dimension and window, as broadcastable arrays"""
+
+    def __init__(self, spec: Dict):
+        self.count_limits = self._limit_arrays(spec.get("count_limits", {}))
+        self.amount_limits = self._limit_arrays(spec.get("amount_limits", {}))
+        self.flags = [spec["flags"][dimension] for dimension in DIMENSIONS]
+        self.volume_flag = spec["flags"]["volume"]
+
+    @staticmethod
+    def _limit_arrays(limits: Dict[str, Dict[str, Sequence[float]]]) -> np.ndarray:
+        arrays = np.full((2, len(DIMENSIONS), len(VELOCITY_WINDOWS)), np.inf)
+        window_names = [window for window, _ in VELOCITY_WINDOWS]
+        for dimension, windows in limits.items():
+            for window, (elevated, high) in windows.items():
+                if elevated > high:
+                    raise ValueError(f"Velocity limit {dimension}/{window}: elevated above high")
+                arrays[:, DIMENSIONS.index(dimension), window_names.index(window)] = (elevated, high)
+        return arrays
+
+    def levels(self, counts: np.ndarray, amounts: np.ndarray) -> Tuple[np.ndarray, FlagMasks]:
+        """Velocity level (0 normal, 1 elevated, 2 high) per row, plus (flag, mask) pairs"""
+        count_levels = counts[None] >= self.count_limits[:, None]
+        amount_levels = amounts[None] >= self.amount_limits[:, None]
+        elevated = count_levels[0].any(axis=(1, 2)) | amount_levels[0].any(axis=(1, 2))
+        high_by_dimension = count_levels[1].any(axis=2)
+        high_volume = amount_levels[1].any(axis=(1, 2))
+
+        level = np.where(high_by_dimension.any(axis=1) | high_volume, 2, np.where(elevated, 1, 0))
+        flag_masks = [(flag, high_by_dimension[:, d]) for d, flag in enumerate(self.flags)]
+        flag_masks.append((self.volume_flag, high_volume))
+        return level, flag_masks
+
+
+class RuleSet:
+    """One compiled version of the rule file"""
+
+    def __init__(self, config: Dict):
+        self.version = str(config["version"])
+        self.thresholds = {level: float(config["thresholds"][level]) for level in RISK_LEVELS}
+        level_breakpoints = np.array([self.thresholds[level] for level in RISK_LEVELS[1:]])
+        if np.any(np.diff(level_breakpoints) <= 0):
+            raise ValueError("Risk level thresholds must be increasing")
+
+        self.user = _Table(config["user"], level_breakpoints)
+        self.transaction = _Table(config["transaction"], level_breakpoints)
+        self.velocity = _VelocityRules(config["velocity"])
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleSet":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+
+class RuleEngine:
+    """Rule file that is recompiled and swapped in when it changes on disk"""
+
+    def __init__(self, path: str = DEFAULT_RULES_PATH, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.failed_reloads = 0
+        self._signature = self._file_signature()
+        self._rules = RuleSet.from_file(path)
+        self._next_check = time.monotonic() + check_interval
+        self._reload_lock = threading.Lock()
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            signature = self._file_signature()
+            if signature != self._signature:
+                rules = RuleSet.from_file(self.path)
+                # Only once it compiled: a bad file is tried again at the next check
+                self._signature = signature
+                previous = self._rules.version
+                self._rules = rules
+                self.reloads += 1
+                logger.info(f"Risk rules reloaded: version {previous} -> {rules.version}")
+        except Exception as e:
+            # Any malformed file, e.g. a list where an object belongs, keeps the previous rules
+            self.failed_reloads += 1
+            logger.error(f"Risk rules reload failed, keeping version {self._rules.version}: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def current(self) -> RuleSet:
+        """The RuleSet to use for one whole evaluation"""
+        self._maybe_reload()
+        return self._rules
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "path": self.path,
+            "version": self._rules.version,
+            "reloads": self.reloads,
+            "failed_reloads": self.failed_reloads
+        }
+
+
+def evaluate_transactions(
+    rules: RuleSet,
+    columns: Dict[str, Sequence],
+    epoch_us: Sequence[int],
+    velocity_counts: np.ndarray,
+    velocity_amounts: np.ndarray,
+    anomaly_model=None
+) -> Evaluation:
+    """
+    Evaluate the transaction table for a batch. Shared by the service and the
+    offline backfill, so both score a transaction identically.
+
+    columns: amount, is_cross_border, hour, payment_method, asset_type.
+    velocity_counts/amounts: windows of earlier transactions, shaped
+    (rows, DIMENSIONS, VELOCITY_WINDOWS).
+    """
+    velocity_level, velocity_flags = rules.velocity.levels(velocity_counts, velocity_amounts)
+    inputs = dict(columns, velocity_level=velocity_level)
+
+    if anomaly_model is None:
+        inputs["anomaly_score"] = np.zeros(len(velocity_level))
+    else:
+        scores = anomaly_model.score(transaction_features(
+            inputs["amount"],
+            epoch_us,
+            inputs["is_cross_border"],
+            rules.transaction.flag_mask(HIGH_RISK_PAYMENT_FLAG, inputs),
+            rules.transaction.flag_mask(HIGH_RISK_ASSET_FLAG, inputs)
+        ))
+        # Only outliers contribute
+        inputs["anomaly_score"] = np.where(scores >= anomaly_model.anomaly_threshold, scores, 0.0)
+
+    return rules.transaction.evaluate(inputs, extra_flags={"velocity": velocity_flags})
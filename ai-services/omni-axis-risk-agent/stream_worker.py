@@ -0,0 +1,254 @@
+"""
+Redis Streams ingestion for the risk agent.
+
+Producers XADD transactions to the input stream with one field, "data",
+holding the same JSON object accepted by POST /evaluate-transaction. Every
+worker process joins one consumer group, scores what it reads in batches
+on the same vectorized path as /evaluate-transactions/batch, and writes
+one entry per transaction to the output stream:
+
+    transaction_id, user_id, source_id (input entry id), assessment (JSON)
+
+The output entries and the XACK for a batch go out in one MULTI/EXEC, so a
+crash leaves a batch either fully published or still pending. Pending
+entries idle for longer than the reclaim timeout (e.g. from a dead worker)
+are taken over with XAUTOCLAIM and scored again, one at a time, so delivery
+is at-least-once and one bad entry cannot hold back the rest of its batch.
+Entries that can't be parsed, and entries that have failed to score on
+MAX_DELIVERIES deliveries, go to a dead-letter stream.
+
+Scoring a redelivered entry must not record it in the user's history and
+risk aggregates twice. Each entry's history write sets a marker key,
+<input stream>:recorded:<entry id>, in the same script call, and skips the
+write when the marker already exists. The markers are deleted together with
+the ack; one left behind by a crash expires after RECORD_MARKER_TTL. Velocity
+windows are keyed on transaction id and need no marker.
+
+Throughput scales by starting more processes; each one is a separate
+consumer in the group and Redis spreads new entries across them.
+
+Usage:
+    REDIS_URL=redis://... python stream_worker.py [--consumer NAME]
+"""
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+from pydantic import ValidationError
+from redis.exceptions import ResponseError
+
+from main import calculate_transaction_risk_scores_batch, redis_client
+from risk_models import TransactionRiskData
+
+logger = logging.getLogger("stream_worker")
+
+INPUT_STREAM = os.getenv("RISK_STREAM_INPUT", "risk:transactions")
+OUTPUT_STREAM = os.getenv("RISK_STREAM_OUTPUT", "risk:assessments")
+DEAD_LETTER_STREAM = os.getenv("RISK_STREAM_DEAD_LETTER", "risk:transactions:dead")
+CONSUMER_GROUP = os.getenv("RISK_STREAM_GROUP", "risk-agent")
+BATCH_SIZE = int(os.getenv("RISK_STREAM_BATCH_SIZE", "256"))
+BLOCK_MS = int(os.getenv("RISK_STREAM_BLOCK_MS", "1000"))
+RECLAIM_IDLE_MS = int(os.getenv("RISK_STREAM_RECLAIM_IDLE_MS", "60000"))
+MAX_DELIVERIES = int(os.getenv("RISK_STREAM_MAX_DELIVERIES", "5"))  # Then dead-lettered
+OUTPUT_MAXLEN = int(os.getenv("RISK_STREAM_OUTPUT_MAXLEN", "1000000"))
+METRICS_INTERVAL = float(os.getenv("RISK_STREAM_METRICS_INTERVAL", "10"))
+METRICS_KEY_PREFIX = "risk:stream_metrics:"
+MARKER_KEY_PREFIX = f"{INPUT_STREAM}:recorded:"
+
+Entry = Tuple[bytes, Dict[bytes, bytes]]
+
+
+class StreamWorker:
+    """One consumer in the risk agent's stream consumer group"""
+
+    def __init__(self, consumer: str):
+        self.consumer = consumer
+        self.stopping = asyncio.Event()
+        self.processed = 0
+        self.dead_lettered = 0
+        self.reclaimed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self._interval_processed = 0
+        self._interval_started = time.monotonic()
+
+    async def ensure_group(self):
+        try:
+            await redis_client.xgroup_create(INPUT_STREAM, CONSUMER_GROUP, id="0", mkstream=True)
+            logger.info(f"Created consumer group {CONSUMER_GROUP} on {INPUT_STREAM}")
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def reclaim(self) -> List[Entry]:
+        """Take over entries other consumers left pending for too long"""
+        entries: List[Entry] = []
+        start_id = "0-0"
+        while len(entries) < BATCH_SIZE:
+            result = await redis_client.xautoclaim(
+                INPUT_STREAM, CONSUMER_GROUP, self.consumer,
+                min_idle_time=RECLAIM_IDLE_MS, start_id=start_id, count=BATCH_SIZE - len(entries)
+            )
+            start_id, claimed = result[0], result[1]
+            # Entries trimmed from the stream while pending come back as None
+            entries.extend(entry for entry in claimed if entry[1] is not None)
+            if start_id in (b"0-0", "0-0"):
+                break
+        if not entries:
+            return entries
+        self.reclaimed += len(entries)
+        logger.info(f"Reclaimed {len(entries)} pending entries")
+
+        # XAUTOCLAIM has already counted this delivery
+        pipe = redis_client.pipeline(transaction=False)
+        for entry_id, _ in entries:
+            pipe.xpending_range(INPUT_STREAM, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1)
+        deliveries = [pending[0]["times_delivered"] if pending else 1 for pending in await pipe.execute()]
+        exhausted = [entry for entry, delivered in zip(entries, deliveries) if delivered > MAX_DELIVERIES]
+        if exhausted:
+            logger.warning(f"Dead-lettering {len(exhausted)} entries that failed {MAX_DELIVERIES} deliveries")
+            await self.dead_letter(exhausted, f"Failed to score in {MAX_DELIVERIES} deliveries")
+        return [entry for entry, delivered in zip(entries, deliveries) if delivered <= MAX_DELIVERIES]
+
+    async def dead_letter(self, entries: List[Entry], error: str):
+        pipe = redis_client.pipeline(transaction=True)
+        for entry_id, fields in entries:
+            pipe.xadd(DEAD_LETTER_STREAM, {**fields, b"source_id": entry_id, b"error": error},
+                      maxlen=OUTPUT_MAXLEN, approximate=True)
+        pipe.xack(INPUT_STREAM, CONSUMER_GROUP, *[entry_id for entry_id, _ in entries])
+        pipe.delete(*[f"{MARKER_KEY_PREFIX}{entry_id.decode()}" for entry_id, _ in entries])
+        await pipe.execute()
+        self.dead_lettered += len(entries)
+
+    async def read(self) -> List[Entry]:
+        response = await redis_client.xreadgroup(
+            CONSUMER_GROUP, self.consumer, {INPUT_STREAM: ">"}, count=BATCH_SIZE, block=BLOCK_MS
+        )
+        return response[0][1] if response else []
+
+    async def process(self, entries: List[Entry]):
+        transactions: List[TransactionRiskData] = []
+        entry_ids: List[bytes] = []
+        invalid: List[Entry] = []
+        for entry_id, fields in entries:
+            try:
+                transactions.append(TransactionRiskData.model_validate_json(fields[b"data"]))
+                entry_ids.append(entry_id)
+            except (KeyError, ValidationError) as e:
+                logger.warning(f"Dead-lettering stream entry {entry_id!r}: {e}")
+                invalid.append((entry_id, fields))
+
+        markers = [f"{MARKER_KEY_PREFIX}{entry_id.decode()}" for entry_id in entry_ids]
+        try:
+            assessments = await calculate_transaction_risk_scores_batch(transactions, markers)
+        except Exception as e:
+            # Left pending; reclaimed and retried after RECLAIM_IDLE_MS, up to MAX_DELIVERIES times
+            self.failed_batches += 1
+            logger.error(f"Failed to score batch of {len(transactions)}: {e}")
+            return
+
+        pipe = redis_client.pipeline(transaction=True)
+        for entry_id, tx_data, assessment in zip(entry_ids, transactions, assessments):
+            pipe.xadd(OUTPUT_STREAM, {
+                "transaction_id": tx_data.transaction_id,
+                "user_id": tx_data.user_id,
+                "source_id": entry_id,
+                "assessment": assessment.model_dump_json()
+            }, maxlen=OUTPUT_MAXLEN, approximate=True)
+        for entry_id, fields in invalid:
+            pipe.xadd(DEAD_LETTER_STREAM, {**fields, b"source_id": entry_id}, maxlen=OUTPUT_MAXLEN, approximate=True)
+        pipe.xack(INPUT_STREAM, CONSUMER_GROUP, *[entry_id for entry_id, _ in entries])
+        if markers:
+            pipe.delete(*markers)
+        await pipe.execute()
+
+        self.batches += 1
+        self.processed += len(transactions)
+        self.dead_lettered += len(invalid)
+        self._interval_processed += len(entries)
+
+    async def report_metrics(self):
+        now = time.monotonic()
+        elapsed = now - self._interval_started
+        throughput = self._interval_processed / elapsed if elapsed > 0 else 0.0
+        self._interval_processed = 0
+        self._interval_started = now
+
+        lag = pending = None
+        for group in await redis_client.xinfo_groups(INPUT_STREAM):
+            name = group["name"]
+            if (name.decode() if isinstance(name, bytes) else name) == CONSUMER_GROUP:
+                lag, pending = group.get("lag"), group.get("pending")
+
+        metrics = {
+            "consumer": self.consumer,
+            "throughput": round(throughput, 1),
+            "processed": self.processed,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "reclaimed": self.reclaimed,
+            "dead_lettered": self.dead_lettered,
+            "group_lag": lag if lag is not None else -1,
+            "group_pending": pending if pending is not None else -1,
+            "updated_at": int(time.time())
+        }
+        logger.info(f"Stream metrics: {json.dumps(metrics)}")
+        key = f"{METRICS_KEY_PREFIX}{self.consumer}"
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping=metrics)
+        pipe.expire(key, int(METRICS_INTERVAL * 6))
+        await pipe.execute()
+
+    async def run(self):
+        await self.ensure_group()
+        logger.info(f"Consumer {self.consumer} reading {INPUT_STREAM} (group {CONSUMER_GROUP})")
+        next_reclaim = 0.0
+        next_metrics = time.monotonic() + METRICS_INTERVAL
+
+        while not self.stopping.is_set():
+            try:
+                now = time.monotonic()
+                if now >= next_reclaim:
+                    next_reclaim = now + RECLAIM_IDLE_MS / 1000
+                    for entry in await self.reclaim():
+                        await self.process([entry])
+
+                entries = await self.read()
+                if entries:
+                    await self.process(entries)
+
+                if time.monotonic() >= next_metrics:
+                    next_metrics = time.monotonic() + METRICS_INTERVAL
+                    await self.report_metrics()
+            except Exception as e:
+                logger.error(f"Stream worker error: {e}")
+                await asyncio.sleep(1)
+
+        logger.info(f"Consumer {self.consumer} stopped after {self.processed} transactions")
+
+
+async def run_worker(consumer: str):
+    worker = StreamWorker(consumer)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stopping.set)
+    try:
+        await worker.run()
+    finally:
+        await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Score transactions from a Redis Stream")
+    parser.add_argument("--consumer", default=os.getenv("RISK_STREAM_CONSUMER", f"{socket.gethostname()}-{os.getpid()}"))
+    args = parser.parse_args()
+
+    asyncio.run(run_worker(args.consumer))
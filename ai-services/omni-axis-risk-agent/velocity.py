@@ -0,0 +1,291 @@
+"""
+Sliding-window transaction velocity per user, IP address and device.
+
+Every entity (dimension + identifier) keeps its recent transactions in a
+Redis sorted set of transaction ids scored by event time in milliseconds
+(velocity:<dimension>:z:{<id>}), their amounts in a hash
+(velocity:<dimension>:a:{<id>}) and the amount total of every window in a
+second hash (velocity:<dimension>:w:{<id>}). The id sits in a hash tag, so
+an entity's three keys share a Redis Cluster slot, and after the fixed
+dimension and key type, so no identifier can name another entity's keys.
+Each set is trimmed to the longest window and capped at max_events
+members, so memory per entity is bounded no matter how busy it is; a
+capped entity reports at least max_events, which is far above every rule
+limit.
+
+One Lua call per entity records a transaction and returns the count and
+amount of the entity's previously recorded transactions in every window;
+the calls of a batch go out in one pipeline, so scoring reads all windows
+in one round trip. Counts are a ZCOUNT per window. Amounts come from the
+running window totals: each total covers the members scored after its
+window's mark (server clock - window), and a member leaves it once, when
+the mark passes it. Only the members between the mark and the event's own
+window start (the client/server clock difference) are read to correct the
+total, so a call costs O(log n) plus the members that expired since the
+last call, not the size of the window. Re-submitting a transaction id
+moves its entry and replaces its amount instead of counting twice.
+
+Event times come from the client, so the script clamps them to the Redis
+server clock +/- max_skew and trims by the server clock: a future-dated
+transaction cannot trim away the entity's history, and a backdated one
+still sees every transaction recorded since its window start.
+"""
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from history_codec import to_epoch_us
+
+# (name, length in seconds), shortest first
+VELOCITY_WINDOWS: Tuple[Tuple[str, int], ...] = (("1m", 60), ("1h", 3600), ("24h", 86400))
+DIMENSIONS = ("user", "ip", "device")
+
+KEY_PREFIX = "velocity:"
+
+# KEYS: sorted set, amounts hash and window totals hash of one entity.
+# ARGV: event time (ms), transaction id, amount, max events, ttl, max clock
+# skew (ms), window lengths (ms)...
+# Returns count, amount per window of the transactions recorded before this one.
+VELOCITY_SCRIPT = """
+local key, amounts_key, totals_key = KEYS[1], KEYS[2], KEYS[3]
+local member = ARGV[2]
+local amount = tonumber(ARGV[3]) or 0
+local max_events = tonumber(ARGV[4])
+local ttl = tonumber(ARGV[5])
+local max_skew = tonumber(ARGV[6])
+local windows = {}
+for i = 7, #ARGV do
+    windows[#windows + 1] = tonumber(ARGV[i])
+end
+local longest = windows[#windows]
+
+-- Client event time, clamped to the server clock
+local time = redis.call('TIME')
+local server_now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local now = math.min(math.max(tonumber(ARGV[1]), server_now - max_skew), server_now + max_skew)
+-- Oldest event any accepted event time can still need
+local cutoff = server_now - max_skew - longest
+
+-- Window totals: sums[w] is the amount of the members scored after marks[w]
+local fields = {}
+for w = 1, #windows do
+    fields[#fields + 1] = 'mark:' .. w
+    fields[#fields + 1] = 'sum:' .. w
+end
+local state = redis.call('HMGET', totals_key, unpack(fields))
+local marks = {}
+local sums = {}
+for w = 1, #windows do
+    marks[w] = tonumber(state[2 * w - 1]) or (server_now - windows[w])
+    sums[w] = tonumber(state[2 * w]) or 0
+end
+
+-- Ids, scores and amounts of a ZRANGE ... WITHSCORES reply
+local function entries(reply)
+    local ids = {}
+    local scores = {}
+    for i = 1, #reply, 2 do
+        ids[#ids + 1] = reply[i]
+        scores[#scores + 1] = tonumber(reply[i + 1])
+    end
+    local values = {}
+    for i = 1, #ids, 1000 do
+        local chunk = redis.call('HMGET', amounts_key, unpack(ids, i, math.min(i + 999, #ids)))
+        for j = 1, #chunk do
+            values[#values + 1] = tonumber(chunk[j]) or 0
+        end
+    end
+    return ids, scores, values
+end
+
+-- Amount of the members scored in (low, high]
+local function range_sum(low, high)
+    local _, _, values = entries(redis.call('ZRANGEBYSCORE', key, '(' .. low, high, 'WITHSCORES'))
+    local total = 0
+    for i = 1, #values do
+        total = total + values[i]
+    end
+    return total
+end
+
+-- Take members out of the set, the amounts hash and the totals counting them
+local function forget(ids, scores, values)
+    for i = 1, #ids do
+        for w = 1, #windows do
+            if scores[i] > marks[w] then
+                sums[w] = sums[w] - values[i]
+            end
+        end
+    end
+    for i = 1, #ids, 1000 do
+        local last = math.min(i + 999, #ids)
+        redis.call('ZREM', key, unpack(ids, i, last))
+        redis.call('HDEL', amounts_key, unpack(ids, i, last))
+    end
+end
+
+-- A re-submitted transaction replaces its earlier entry
+local previous = redis.call('ZSCORE', key, member)
+if previous then
+    forget({member}, {tonumber(previous)}, {tonumber(redis.call('HGET', amounts_key, member)) or 0})
+end
+
+-- Move every mark up to the server clock, dropping what it passes from its total
+for w = 1, #windows do
+    local mark = server_now - windows[w]
+    if mark > marks[w] then
+        local _, _, values = entries(redis.call('ZRANGEBYSCORE', key, '(' .. marks[w], mark, 'WITHSCORES'))
+        for i = 1, #values do
+            sums[w] = sums[w] - values[i]
+        end
+        marks[w] = mark
+    end
+    -- An empty window starts again from an exact zero
+    if redis.call('ZCOUNT', key, '(' .. marks[w], '+inf') == 0 then
+        sums[w] = 0
+    end
+end
+
+-- Events older than every window (all behind the marks, so in no total)
+local expired = redis.call('ZRANGEBYSCORE', key, '-inf', '(' .. cutoff)
+for i = 1, #expired, 1000 do
+    redis.call('HDEL', amounts_key, unpack(expired, i, math.min(i + 999, #expired)))
+end
+redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. cutoff)
+
+-- Events recorded with a later time than this one count as current
+local result = {}
+for w = 1, #windows do
+    local start = now - windows[w]
+    local total = sums[w]
+    if start > marks[w] then
+        total = total - range_sum(marks[w], start)
+    elseif start < marks[w] then
+        total = total + range_sum(start, marks[w])
+    end
+    result[#result + 1] = redis.call('ZCOUNT', key, '(' .. start, '+inf')
+    result[#result + 1] = string.format('%.17g', total)
+end
+
+redis.call('ZADD', key, now, member)
+redis.call('HSET', amounts_key, member, ARGV[3])
+for w = 1, #windows do
+    if now > marks[w] then
+        sums[w] = sums[w] + amount
+    end
+end
+forget(entries(redis.call('ZRANGE', key, 0, -max_events - 1, 'WITHSCORES')))
+
+fields = {}
+for w = 1, #windows do
+    fields[#fields + 1] = 'mark:' .. w
+    fields[#fields + 1] = string.format('%.17g', marks[w])
+    fields[#fields + 1] = 'sum:' .. w
+    fields[#fields + 1] = string.format('%.17g', sums[w])
+end
+redis.call('HSET', totals_key, unpack(fields))
+redis.call('PEXPIRE', key, ttl)
+redis.call('PEXPIRE', amounts_key, ttl)
+redis.call('PEXPIRE', totals_key, ttl)
+return result
+"""
+
+
+def entity_keys(dimension: str, entity_id: str) -> List[str]:
+    """Sorted set, amounts hash and window totals hash of one entity"""
+    return [f"{KEY_PREFIX}{dimension}:{kind}:{{{entity_id}}}" for kind in ("z", "a", "w")]
+
+
+class VelocityCounters:
+    """Records transactions and reads their windowed velocity from Redis"""
+
+    def __init__(self, redis_client, max_events: int = 1000, max_skew: float = 300.0):
+        self.redis_client = redis_client
+        self.max_events = max_events
+        self.max_skew_ms = int(max_skew * 1000)
+        self.script = redis_client.register_script(VELOCITY_SCRIPT)
+        self.window_args = [seconds * 1000 for _, seconds in VELOCITY_WINDOWS]
+        self.ttl_ms = self.window_args[-1] + self.max_skew_ms + 60_000
+
+    async def observe(
+        self,
+        events: Sequence[Tuple[str, str, Optional[str], Optional[str], float, datetime]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Record (transaction_id, user_id, ip_address, device_fingerprint,
+        amount, timestamp) events in order, in one round trip.
+
+        Returns counts (int64) and amounts (float64), both shaped
+        (events, DIMENSIONS, VELOCITY_WINDOWS), of each entity's earlier
+        transactions in every window.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        calls = []  # (event, dimension) of each script call
+        for i, (transaction_id, user_id, ip_address, device_fingerprint, amount, timestamp) in enumerate(events):
+            for d, (dimension, entity_id) in enumerate(zip(DIMENSIONS, (user_id, ip_address, device_fingerprint))):
+                if not entity_id:
+                    continue
+                await self.script(
+                    keys=entity_keys(dimension, entity_id),
+                    args=[to_epoch_us(timestamp) // 1000, transaction_id, repr(float(amount)),
+                          self.max_events, self.ttl_ms, self.max_skew_ms] + self.window_args,
+                    client=pipe
+                )
+                calls.append((i, d))
+        results = await pipe.execute()
+
+        shape = (len(events), len(DIMENSIONS), len(VELOCITY_WINDOWS))
+        counts = np.zeros(shape, dtype=np.int64)
+        amounts = np.zeros(shape, dtype=np.float64)
+        for (i, d), result in zip(calls, results):
+            values = np.array(result, dtype=object).reshape(len(VELOCITY_WINDOWS), 2)
+            counts[i, d] = values[:, 0].astype(np.int64)
+            amounts[i, d] = values[:, 1].astype(np.float64)
+        return counts, amounts
+
+
+def window_velocity(
+    codes: np.ndarray,
+    epoch_ms: np.ndarray,
+    amounts: np.ndarray,
+    max_events: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Offline equivalent of VELOCITY_SCRIPT for one dimension.
+
+    Rows must be in processing order (timestamp order); codes identify the
+    entity of each row, -1 where it has none. Returns counts and amounts
+    shaped (rows, VELOCITY_WINDOWS) of each entity's earlier rows in every
+    window, keeping only its max_events most recent rows like the capped
+    sorted sets do.
+    """
+    n = len(codes)
+    counts = np.zeros((n, len(VELOCITY_WINDOWS)), dtype=np.int64)
+    sums = np.zeros((n, len(VELOCITY_WINDOWS)), dtype=np.float64)
+    present = np.flatnonzero(codes >= 0)
+    if not len(present):
+        return counts, sums
+
+    # Group rows by entity, keeping processing order within each entity, and
+    # lay the groups out on one increasing key so a single searchsorted
+    # finds every window start without crossing into the previous entity
+    order = present[np.argsort(codes[present], kind="stable")]
+    group_codes = codes[order]
+    times = epoch_ms[order].astype(np.int64)
+    longest = VELOCITY_WINDOWS[-1][1] * 1000
+    stride = int(times.max() - times.min()) + longest + 1
+    group_rank = np.cumsum(np.concatenate(([0], group_codes[1:] != group_codes[:-1])))
+    if (int(group_rank[-1]) + 1) * stride >= 2 ** 62:
+        raise ValueError("Time span too large for one velocity partition")
+    keys = group_rank * stride + (times - times.min())
+
+    positions = np.arange(len(order))
+    cumulative = np.concatenate(([0.0], np.cumsum(amounts[order].astype(np.float64))))
+    for w, (_, seconds) in enumerate(VELOCITY_WINDOWS):
+        # Earlier rows of the same entity with age < window
+        starts = np.searchsorted(keys, keys - seconds * 1000, side="right")
+        starts = np.maximum(starts, positions - max_events)
+        counts[order, w] = positions - starts
+        sums[order, w] = cumulative[positions] - cumulative[starts]
+    return counts, sums